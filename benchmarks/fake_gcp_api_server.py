@@ -0,0 +1,371 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+r"""In-memory stand-in for the Google Cloud APIs used by `--gcp-client=rest`.
+
+Serves, on one port, the GKE calls on clusters, node pools and operations,
+the Compute Engine reservation calls and the Cloud Monitoring dashboard list.
+Node pool creates and deletes return an operation that finishes after
+`--node-pool-latency` seconds and fails with a transient error with
+probability `--node-pool-failure-rate`.
+
+  python3 benchmarks/fake_gcp_api_server.py --port 8002 --clusters c &
+  PATH=benchmarks/fakebin:$PATH python3 xpk.py cluster create --cluster c \
+      --tpu-type=v5litepod-16 --num-slices=64 --on-demand \
+      --gcp-client=rest --gcp-api-endpoint=http://127.0.0.1:8002
+"""
+
+import argparse
+import http.server
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+location_path = r'/v1/projects/(?P<project>[^/]+)/locations/(?P<location>[^/]+)'
+cluster_path = location_path + r'/clusters/(?P<cluster>[^/]+)'
+
+
+class FakeGcpState:
+  """Clusters, node pools, operations, reservations and dashboards."""
+
+  def __init__(self, node_pool_latency=0.0, node_pool_failure_rate=0.0):
+    self.node_pool_latency = node_pool_latency
+    self.node_pool_failure_rate = node_pool_failure_rate
+    # Cluster name to {node pool name: node pool}.
+    self.clusters = {}
+    self.operations = {}
+    self.reservations = {}
+    self.dashboards = []
+    self.operation_ids = itertools.count(1)
+    self.lock = threading.Lock()
+
+  def add_cluster(self, name):
+    with self.lock:
+      self.clusters.setdefault(
+          name,
+          {'default-pool': {'name': 'default-pool', 'status': 'RUNNING'}},
+      )
+
+  def start_operation(self, operation_type, cluster, node_pool, apply):
+    """Returns a new operation that calls `apply` once it is done."""
+    with self.lock:
+      operation = {
+          'name': f'operation-{next(self.operation_ids)}',
+          'operationType': operation_type,
+          'status': 'RUNNING',
+          'targetLink': f'clusters/{cluster}/nodePools/{node_pool}',
+      }
+      self.operations[operation['name']] = (
+          operation,
+          time.monotonic() + self.node_pool_latency,
+          random.random() < self.node_pool_failure_rate,
+          apply,
+      )
+      return dict(operation)
+
+  def get_operation(self, name) -> dict | None:
+    """Returns an operation, finishing it if its time has come."""
+    with self.lock:
+      if name not in self.operations:
+        return None
+      operation, done_at, fails, apply = self.operations[name]
+      if operation['status'] != 'DONE' and time.monotonic() >= done_at:
+        operation['status'] = 'DONE'
+        if fails:
+          operation['error'] = {
+              'code': 14,
+              'message': 'UNAVAILABLE: please try again later.',
+          }
+        else:
+          apply()
+      return dict(operation)
+
+
+class FakeGcpApiHandler(http.server.BaseHTTPRequestHandler):
+  """Request handler of FakeGcpApiServer."""
+
+  protocol_version = 'HTTP/1.1'
+  # Replies are written in several sends, do not let Nagle delay them.
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+  @property
+  def state(self) -> FakeGcpState:
+    return self.server.state
+
+  def send_json(self, status, body):
+    payload = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def send_error_json(self, status, reason, message):
+    self.send_json(
+        status,
+        {'error': {'code': status, 'status': reason, 'message': message}},
+    )
+
+  def read_body(self) -> dict:
+    body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    return json.loads(body) if body else {}
+
+  def route(self, method):
+    """Dispatches a request to the handler whose pattern matches its path.
+
+    Handlers get the JSON body and the groups of the pattern, in order.
+    """
+    self.server.request_count += 1
+    path = urllib.parse.urlsplit(self.path).path
+    body = self.read_body() if method in ('POST', 'PATCH') else {}
+    for route_method, pattern, handler in self.routes:
+      match = re.fullmatch(pattern, path)
+      if route_method == method and match:
+        handler(self, body, *match.groups())
+        return
+    self.send_error_json(404, 'NOT_FOUND', f'No route for {method} {path}')
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    self.route('GET')
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    self.route('POST')
+
+  def do_DELETE(self):  # pylint: disable=invalid-name
+    self.route('DELETE')
+
+  def list_clusters(self, _, _project, location):
+    """Lists the clusters, which all are in every location."""
+    with self.state.lock:
+      clusters = [
+          {
+              'name': name,
+              'location': location,
+              'status': 'RUNNING',
+              'createTime': '2024-01-01T00:00:00+00:00',
+          }
+          for name in self.state.clusters
+      ]
+    self.send_json(200, {'clusters': clusters})
+
+  def list_node_pools(self, _, _project, _location, cluster):
+    with self.state.lock:
+      node_pools = self.state.clusters.get(cluster)
+      node_pools = None if node_pools is None else list(node_pools.values())
+    if node_pools is None:
+      self.send_error_json(404, 'NOT_FOUND', f'Cluster {cluster} not found.')
+      return
+    self.send_json(200, {'nodePools': node_pools})
+
+  def create_node_pool(self, body, _project, _location, cluster):
+    """Starts an operation that adds the node pool once it is done."""
+    node_pool = dict(body.get('nodePool') or {}, status='RUNNING')
+    name = node_pool.get('name')
+    with self.state.lock:
+      node_pools = self.state.clusters.get(cluster)
+    if node_pools is None:
+      self.send_error_json(404, 'NOT_FOUND', f'Cluster {cluster} not found.')
+      return
+    if name in node_pools:
+      self.send_error_json(
+          409, 'ALREADY_EXISTS', f'Node pool {name} already exists.'
+      )
+      return
+    self.send_json(
+        200,
+        self.state.start_operation(
+            'CREATE_NODE_POOL',
+            cluster,
+            name,
+            lambda: node_pools.__setitem__(name, node_pool),
+        ),
+    )
+
+  def delete_node_pool(self, _, _project, _location, cluster, node_pool):
+    with self.state.lock:
+      node_pools = self.state.clusters.get(cluster) or {}
+    if node_pool not in node_pools:
+      self.send_error_json(
+          404, 'NOT_FOUND', f'Node pool {node_pool} not found.'
+      )
+      return
+    self.send_json(
+        200,
+        self.state.start_operation(
+            'DELETE_NODE_POOL',
+            cluster,
+            node_pool,
+            lambda: node_pools.pop(node_pool, None),
+        ),
+    )
+
+  def get_operation(self, _, _project, _location, operation):
+    reply = self.state.get_operation(operation)
+    if reply is None:
+      self.send_error_json(
+          404, 'NOT_FOUND', f'Operation {operation} not found.'
+      )
+      return
+    self.send_json(200, reply)
+
+  def list_operations(self, _, _project, _location):
+    with self.state.lock:
+      names = list(self.state.operations)
+    self.send_json(
+        200, {'operations': [self.state.get_operation(n) for n in names]}
+    )
+
+  def get_reservation(self, _, _project, zone, reservation):
+    with self.state.lock:
+      reply = self.state.reservations.get((zone, reservation))
+    if reply is None:
+      self.send_error_json(
+          404, 'NOT_FOUND', f'Reservation {reservation} was not found.'
+      )
+      return
+    self.send_json(200, reply)
+
+  def list_reservations(self, _, _project):
+    items = {}
+    with self.state.lock:
+      for (zone, _), reservation in self.state.reservations.items():
+        items.setdefault(f'zones/{zone}', {'reservations': []})[
+            'reservations'
+        ].append(reservation)
+    self.send_json(200, {'items': items})
+
+  def list_dashboards(self, _, _project):
+    self.send_json(200, {'dashboards': self.state.dashboards})
+
+  routes = (
+      ('GET', location_path + '/clusters', list_clusters),
+      ('GET', cluster_path + '/nodePools', list_node_pools),
+      ('POST', cluster_path + '/nodePools', create_node_pool),
+      (
+          'DELETE',
+          cluster_path + r'/nodePools/(?P<node_pool>[^/]+)',
+          delete_node_pool,
+      ),
+      (
+          'GET',
+          location_path + r'/operations/(?P<operation>[^/]+)',
+          get_operation,
+      ),
+      ('GET', location_path + '/operations', list_operations),
+      (
+          'GET',
+          r'/compute/v1/projects/(?P<project>[^/]+)/zones/(?P<zone>[^/]+)'
+          r'/reservations/(?P<reservation>[^/]+)',
+          get_reservation,
+      ),
+      (
+          'GET',
+          r'/compute/v1/projects/(?P<project>[^/]+)/aggregated/reservations',
+          list_reservations,
+      ),
+      ('GET', r'/v1/projects/(?P<project>[^/]+)/dashboards', list_dashboards),
+  )
+
+
+class FakeGcpApiServer(http.server.ThreadingHTTPServer):
+  """Fake Google Cloud API server holding its state in memory."""
+
+  daemon_threads = True
+
+  def __init__(self, port=0, node_pool_latency=0.0, node_pool_failure_rate=0.0):
+    super().__init__(('127.0.0.1', port), FakeGcpApiHandler)
+    self.state = FakeGcpState(node_pool_latency, node_pool_failure_rate)
+    self.request_count = 0
+
+  @property
+  def url(self) -> str:
+    return f'http://127.0.0.1:{self.server_address[1]}'
+
+  def start(self) -> 'FakeGcpApiServer':
+    """Serves requests on a background thread."""
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def seed_reservation(self, zone, name, count=64):
+    """Adds a specific reservation."""
+    with self.state.lock:
+      self.state.reservations[(zone, name)] = {
+          'name': name,
+          'zone': f'https://www.googleapis.com/compute/v1/projects/p/zones/{zone}',
+          'specificReservation': {'count': str(count), 'inUseCount': '0'},
+          'status': 'READY',
+      }
+
+  def seed_dashboards(self):
+    """Adds the TPU monitoring and logging dashboards."""
+    self.state.dashboards = [
+        {
+            'name': 'projects/0/dashboards/fake-monitoring-dashboard',
+            'displayName': 'GKE - TPU Monitoring Dashboard',
+        },
+        {
+            'name': 'projects/0/dashboards/fake-logging-dashboard',
+            'displayName': 'GKE - TPU Logging Dashboard',
+        },
+    ]
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='In-memory fake GKE, Compute Engine and Monitoring APIs.'
+  )
+  parser.add_argument('--port', type=int, default=8002)
+  parser.add_argument(
+      '--clusters', nargs='*', default=[], help='Existing cluster names.'
+  )
+  parser.add_argument(
+      '--reservations',
+      nargs='*',
+      default=[],
+      help='Existing reservations as <ZONE>/<NAME>.',
+  )
+  parser.add_argument('--node-pool-latency', type=float, default=0.0)
+  parser.add_argument('--node-pool-failure-rate', type=float, default=0.0)
+  args = parser.parse_args()
+  server = FakeGcpApiServer(
+      args.port, args.node_pool_latency, args.node_pool_failure_rate
+  )
+  for cluster in args.clusters:
+    server.state.add_cluster(cluster)
+  for reservation in args.reservations:
+    zone, name = reservation.split('/', 1)
+    server.seed_reservation(zone, name)
+  server.seed_dashboards()
+  print(f'Serving fake Google Cloud APIs on {server.url}', flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
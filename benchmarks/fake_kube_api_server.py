@@ -0,0 +1,420 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+r"""In-memory stand-in for the Kubernetes API server, for xpk's native client.
+
+Serves get, list (with label selectors and pagination), server-side apply,
+delete and watch for any resource path over plain HTTP with keep-alive. It
+does not parse YAML: objects applied as YAML are stored with the identity
+taken from the request path.
+
+Point the fake kubectl of benchmarks/fakebin at it through
+XPK_FAKE_KUBE_API, so `kubectl config view` hands its address to xpk:
+
+  python3 benchmarks/fake_kube_api_server.py --port 8001 --workloads 5000 &
+  XPK_FAKE_KUBE_API=http://127.0.0.1:8001 PATH=benchmarks/fakebin:$PATH \
+      python3 xpk.py workload list --cluster c --project p \
+      --zone us-central2-b --kube-client=native
+"""
+
+import argparse
+import datetime
+import http.server
+import json
+import threading
+import urllib.parse
+import uuid
+
+
+class ObjectStore:
+  """Objects keyed by collection path and name, with a log of changes."""
+
+  def __init__(self):
+    self.collections = {}
+    self.events = []
+    self.resource_version = 0
+    self.condition = threading.Condition()
+
+  def put(self, collection, name, obj) -> tuple[dict, bool]:
+    """Stores an object, returning it and whether it was created."""
+    with self.condition:
+      objects = self.collections.setdefault(collection, {})
+      created = name not in objects
+      self.resource_version += 1
+      metadata = obj.setdefault('metadata', {})
+      metadata['name'] = name
+      metadata['resourceVersion'] = str(self.resource_version)
+      if created:
+        metadata['uid'] = str(uuid.uuid4())
+        metadata['creationTimestamp'] = (
+            datetime.datetime.now(datetime.timezone.utc)
+            .replace(microsecond=0)
+            .isoformat()
+            .replace('+00:00', 'Z')
+        )
+      else:
+        previous = objects[name]['metadata']
+        metadata['uid'] = previous['uid']
+        metadata['creationTimestamp'] = previous['creationTimestamp']
+      objects[name] = obj
+      self.events.append((
+          self.resource_version,
+          collection,
+          'ADDED' if created else 'MODIFIED',
+          obj,
+      ))
+      self.condition.notify_all()
+      return obj, created
+
+  def delete(self, collection, name) -> dict | None:
+    """Removes an object and the objects it owns.
+
+    Returns:
+      The removed object, or None if it did not exist.
+    """
+    with self.condition:
+      obj = self.collections.get(collection, {}).pop(name, None)
+      if obj is None:
+        return None
+      self.resource_version += 1
+      self.events.append((self.resource_version, collection, 'DELETED', obj))
+      # Garbage collect dependents, as the API server does in the background.
+      for dependent_collection, objects in self.collections.items():
+        for dependent_name, dependent in list(objects.items()):
+          if any(
+              owner.get('kind') == obj.get('kind')
+              and owner.get('name') == name
+              for owner in dependent['metadata'].get('ownerReferences') or []
+          ):
+            del objects[dependent_name]
+            self.resource_version += 1
+            self.events.append((
+                self.resource_version,
+                dependent_collection,
+                'DELETED',
+                dependent,
+            ))
+      self.condition.notify_all()
+      return obj
+
+  def get(self, collection, name) -> dict | None:
+    """Returns an object, or None if it does not exist."""
+    with self.condition:
+      return self.collections.get(collection, {}).get(name)
+
+  def list(self, collection) -> tuple[list[dict], int]:
+    """Returns the objects of a collection and the current version."""
+    with self.condition:
+      return (
+          list(self.collections.get(collection, {}).values()),
+          self.resource_version,
+      )
+
+
+def matches_label_selector(obj, label_selector) -> bool:
+  """Supports `key`, `!key`, `key=value` and `key!=value` requirements."""
+  labels = obj.get('metadata', {}).get('labels') or {}
+  for requirement in filter(None, label_selector.split(',')):
+    if '!=' in requirement:
+      key, value = requirement.split('!=', 1)
+      if labels.get(key) == value:
+        return False
+    elif '=' in requirement:
+      key, value = requirement.split('=', 1)
+      if labels.get(key.rstrip('=')) != value.lstrip('='):
+        return False
+    elif requirement.startswith('!'):
+      if requirement[1:] in labels:
+        return False
+    elif requirement not in labels:
+      return False
+  return True
+
+
+def parse_path(path) -> tuple[str, str | None]:
+  """Splits an API path into its collection path and object name."""
+  parts = [urllib.parse.unquote(part) for part in path.strip('/').split('/')]
+  prefix_length = 2 if parts[0] == 'api' else 3
+  rest = parts[prefix_length:]
+  if len(rest) >= 3 and rest[0] == 'namespaces':
+    collection_length = prefix_length + 3
+  else:
+    collection_length = prefix_length + 1
+  collection = '/' + '/'.join(parts[:collection_length])
+  name = parts[collection_length] if len(parts) > collection_length else None
+  return collection, name
+
+
+class FakeKubernetesApiHandler(http.server.BaseHTTPRequestHandler):
+  """Request handler of FakeKubernetesApiServer."""
+
+  protocol_version = 'HTTP/1.1'
+  # Replies are written in several sends, do not let Nagle delay them.
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+  @property
+  def store(self) -> ObjectStore:
+    return self.server.store
+
+  def send_json(self, status, body):
+    payload = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def send_status(self, status, reason, message):
+    self.send_json(status, {
+        'kind': 'Status',
+        'apiVersion': 'v1',
+        'status': 'Failure',
+        'reason': reason,
+        'message': message,
+        'code': status,
+    })
+
+  def read_body(self) -> bytes:
+    return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    """Gets an object, lists a collection by pages or watches it."""
+    url = urllib.parse.urlsplit(self.path)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    collection, name = parse_path(url.path)
+    self.server.request_count += 1
+    if name is not None:
+      obj = self.store.get(collection, name)
+      if obj is None:
+        self.send_status(404, 'NotFound', f'{name} not found')
+      else:
+        self.send_json(200, obj)
+      return
+    if params.get('watch') in ('true', '1'):
+      self.watch(collection, params)
+      return
+    objects, resource_version = self.store.list(collection)
+    if params.get('labelSelector'):
+      objects = [
+          obj
+          for obj in objects
+          if matches_label_selector(obj, params['labelSelector'])
+      ]
+    start = int(params.get('continue') or 0)
+    limit = int(params.get('limit') or 0) or len(objects)
+    page = objects[start : start + limit]
+    metadata = {'resourceVersion': str(resource_version)}
+    if start + limit < len(objects):
+      metadata['continue'] = str(start + limit)
+    self.send_json(
+        200,
+        {'kind': 'List', 'apiVersion': 'v1', 'metadata': metadata,
+         'items': page},
+    )
+
+  def watch(self, collection, params):
+    """Streams the changes of a collection as chunked JSON lines."""
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+    label_selector = params.get('labelSelector', '')
+    since = int(params.get('resourceVersion') or 0)
+    deadline = (
+        datetime.datetime.now().timestamp()
+        + int(params.get('timeoutSeconds') or 300)
+    )
+    if not since:
+      objects, since = self.store.list(collection)
+      for obj in objects:
+        if matches_label_selector(obj, label_selector):
+          self.write_chunk({'type': 'ADDED', 'object': obj})
+    while True:
+      with self.store.condition:
+        events = [e for e in self.store.events if e[0] > since]
+        if not events:
+          remaining = deadline - datetime.datetime.now().timestamp()
+          if remaining <= 0 or self.server.shutting_down:
+            break
+          self.store.condition.wait(min(remaining, 1))
+          continue
+      for resource_version, event_collection, event_type, obj in events:
+        since = resource_version
+        if event_collection == collection and matches_label_selector(
+            obj, label_selector
+        ):
+          self.write_chunk({'type': event_type, 'object': obj})
+    self.wfile.write(b'0\r\n\r\n')
+
+  def write_chunk(self, event):
+    payload = json.dumps(event).encode() + b'\n'
+    self.wfile.write(f'{len(payload):x}\r\n'.encode() + payload + b'\r\n')
+    self.wfile.flush()
+
+  def do_PATCH(self):  # pylint: disable=invalid-name
+    """Server-side applies an object, always as if forced."""
+    url = urllib.parse.urlsplit(self.path)
+    collection, name = parse_path(url.path)
+    self.server.request_count += 1
+    body = self.read_body()
+    try:
+      obj = json.loads(body)
+    except ValueError:
+      # YAML is not parsed, only the identity from the path is stored.
+      obj = {'metadata': {}, 'yaml': body.decode(errors='replace')}
+    if '/namespaces/' in collection:
+      obj.setdefault('metadata', {})['namespace'] = collection.split('/')[-2]
+    obj, created = self.store.put(collection, name, obj)
+    self.send_json(201 if created else 200, obj)
+
+  def do_DELETE(self):  # pylint: disable=invalid-name
+    url = urllib.parse.urlsplit(self.path)
+    self.read_body()
+    collection, name = parse_path(url.path)
+    self.server.request_count += 1
+    if self.store.delete(collection, name) is None:
+      self.send_status(404, 'NotFound', f'{name} not found')
+      return
+    self.send_json(
+        200, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success'}
+    )
+
+
+class FakeKubernetesApiServer(http.server.ThreadingHTTPServer):
+  """Fake API server holding its objects in memory."""
+
+  daemon_threads = True
+
+  def __init__(self, port=0):
+    super().__init__(('127.0.0.1', port), FakeKubernetesApiHandler)
+    self.store = ObjectStore()
+    self.request_count = 0
+    self.shutting_down = False
+
+  @property
+  def url(self) -> str:
+    return f'http://127.0.0.1:{self.server_address[1]}'
+
+  def start(self) -> 'FakeKubernetesApiServer':
+    """Serves requests on a background thread."""
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.shutting_down = True
+    self.shutdown()
+    self.server_close()
+
+  def seed_workloads(self, count, namespace='default'):
+    """Adds `count` JobSets and their Kueue Workloads."""
+    for i in range(count):
+      name = f'bench-workload-{i}'
+      self.store.put(
+          f'/apis/jobset.x-k8s.io/v1alpha2/namespaces/{namespace}/jobsets',
+          name,
+          {
+              'apiVersion': 'jobset.x-k8s.io/v1alpha2',
+              'kind': 'JobSet',
+              'metadata': {
+                  'namespace': namespace,
+                  'labels': {'xpk.google.com/workload': name},
+              },
+          },
+      )
+      self.store.put(
+          f'/apis/kueue.x-k8s.io/v1beta1/namespaces/{namespace}/workloads',
+          f'jobset-{name}',
+          {
+              'apiVersion': 'kueue.x-k8s.io/v1beta1',
+              'kind': 'Workload',
+              'metadata': {
+                  'namespace': namespace,
+                  'labels': {'xpk.google.com/workload': name},
+                  'ownerReferences': [{'kind': 'JobSet', 'name': name}],
+              },
+              'spec': {'priorityClassName': 'medium', 'podSets': [{'count': 4}]},
+              'status': {
+                  'admission': {'podSetAssignments': [{'count': 4}]},
+                  'conditions': [{
+                      'type': 'Finished' if i % 3 == 0 else 'Admitted',
+                      'message': 'Admitted by ClusterQueue cluster-queue',
+                      'lastTransitionTime': '2024-01-01T00:00:00Z',
+                  }],
+              },
+          },
+      )
+
+  def seed_nodes(self, count, accelerator='tpu-v5-lite-podslice'):
+    """Adds `count` TPU nodes."""
+    for i in range(count):
+      self.store.put(
+          '/api/v1/nodes',
+          f'gke-bench-node-{i}',
+          {
+              'apiVersion': 'v1',
+              'kind': 'Node',
+              'metadata': {
+                  'labels': {'cloud.google.com/gke-tpu-accelerator': accelerator}
+              },
+          },
+      )
+
+  def seed_configmap(self, name, data, namespace='default'):
+    """Adds a ConfigMap."""
+    self.store.put(
+        f'/api/v1/namespaces/{namespace}/configmaps',
+        name,
+        {
+            'apiVersion': 'v1',
+            'kind': 'ConfigMap',
+            'metadata': {'namespace': namespace},
+            'data': data,
+        },
+    )
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='In-memory fake Kubernetes API server.'
+  )
+  parser.add_argument('--port', type=int, default=8001)
+  parser.add_argument('--workloads', type=int, default=0)
+  parser.add_argument('--nodes', type=int, default=0)
+  parser.add_argument(
+      '--configmap',
+      default=None,
+      help='Creates <NAME>-resources-configmap for v5litepod-16, e.g. `c`.',
+  )
+  args = parser.parse_args()
+  server = FakeKubernetesApiServer(args.port)
+  server.seed_workloads(args.workloads)
+  server.seed_nodes(args.nodes)
+  if args.configmap:
+    server.seed_configmap(
+        f'{args.configmap}-resources-configmap', {'v5litepod-16': '4096'}
+    )
+  print(f'Serving a fake Kubernetes API on {server.url}', flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,53 @@
+#!/bin/sh
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shared behaviour of the fake gcloud, kubectl and docker binaries, sourced
+# after setting FAKE_TOOL. Configured through the environment:
+#   XPK_FAKE_CALL_LOG             file that gets one line per invocation.
+#   XPK_FAKE_LATENCY              seconds every invocation takes, default 0.
+#   XPK_FAKE_<TOOL>_LATENCY       overrides XPK_FAKE_LATENCY for one tool.
+#   XPK_FAKE_<TOOL>_FAILURE_RATE  probability in [0, 1] that an invocation
+#                                 fails with a transient error, default 0.
+
+fake_upper_tool=$(echo "$FAKE_TOOL" | tr '[:lower:]' '[:upper:]')
+
+if [ -n "$XPK_FAKE_CALL_LOG" ]; then
+  echo "$FAKE_TOOL $*" >> "$XPK_FAKE_CALL_LOG"
+fi
+
+# fake_sleep SECONDS: sleeps unless SECONDS is empty or zero.
+fake_sleep() {
+  case "$1" in
+    ''|0|0.0) ;;
+    *) sleep "$1" ;;
+  esac
+}
+
+# fake_maybe_fail RATE: exits with a transient error with probability RATE.
+fake_maybe_fail() {
+  case "$1" in
+    ''|0|0.0) return 0 ;;
+  esac
+  if awk -v rate="$1" -v seed="$$$(date +%N)" \
+      'BEGIN { srand(seed % 2147483647); exit !(rand() < rate) }'; then
+    echo "ERROR: ($FAKE_TOOL) RESOURCE_EXHAUSTED: Quota exceeded, please try again later." >&2
+    exit 1
+  fi
+}
+
+eval "fake_latency=\${XPK_FAKE_${fake_upper_tool}_LATENCY:-\${XPK_FAKE_LATENCY:-0}}"
+eval "fake_failure_rate=\${XPK_FAKE_${fake_upper_tool}_FAILURE_RATE:-0}"
+fake_sleep "$fake_latency"
+fake_maybe_fail "$fake_failure_rate"
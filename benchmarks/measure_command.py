@@ -0,0 +1,56 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+r"""Runs a command and writes its wall time, exit code and peak RSS as JSON.
+
+The peak RSS that wait4 reports for a child also counts the memory of the
+process that forked it, and run_benchmarks.py grows with the fake API servers
+it seeds. The runner therefore starts xpk through this small process, which
+keeps the measurement to xpk itself.
+
+Example usage:
+  python3 benchmarks/measure_command.py /tmp/result.json python3 xpk.py version
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def main() -> int:
+  result_path, *command = sys.argv[1:]
+  start = time.perf_counter()
+  with subprocess.Popen(command) as child:
+    # wait4 also returns the resource usage of the child.
+    _, status, rusage = os.wait4(child.pid, 0)
+    child.returncode = os.waitstatus_to_exitcode(status)
+  wall_seconds = time.perf_counter() - start
+  with open(result_path, 'w', encoding='utf-8') as f:
+    json.dump(
+        {
+            'exit_code': child.returncode,
+            'wall_seconds': wall_seconds,
+            'peak_rss_kib': rusage.ru_maxrss,
+        },
+        f,
+    )
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
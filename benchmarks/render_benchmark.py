@@ -0,0 +1,157 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+r"""Microbenchmark of the render throughput of the workload manifests of xpk.
+
+For every entry of UserFacingNameToSystemCharacteristics, renders `--variants`
+JobSets that only differ by their workload name, in two ways:
+  build:    builds the JobSet as Python objects, validates it and serializes
+            it, as `workload create` does for one workload.
+  template: serializes the JobSet once as a ManifestTemplate and renders the
+            workload name into it, the path for bulk submission.
+
+xpk.py runs its command line when it is loaded. Without a subcommand it only
+prints its help, which is discarded.
+
+Example usage:
+  python3 benchmarks/render_benchmark.py --variants 1000
+"""
+
+import argparse
+import collections
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import time
+
+xpk_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'xpk.py'
+)
+
+
+def load_xpk():
+  """Returns xpk.py loaded as a module."""
+  argv = sys.argv
+  sys.argv = [xpk_path]
+  try:
+    spec = importlib.util.spec_from_file_location('xpk', xpk_path)
+    xpk = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+      spec.loader.exec_module(xpk)
+  finally:
+    sys.argv = argv
+  return xpk
+
+
+def get_workload_args(xpk, device_type):
+  """Returns the parsed `workload create` arguments for `device_type`."""
+  args = xpk.parser.parse_args([
+      'workload',
+      'create',
+      '--cluster=bench-cluster',
+      '--workload=bench-workload-0',
+      '--command=python3 train.py',
+      f'--device-type={device_type}',
+      '--num-slices=4',
+  ])
+  xpk.add_env_config(args)
+  return args
+
+
+def render_build(xpk, args, system, names) -> int:
+  size = 0
+  for name in names:
+    args.workload = name
+    manifest = xpk.get_workload_manifest(
+        args, system, 'gcr.io/bench/image', args.command
+    )
+    assert not xpk.get_manifest_errors(manifest)
+    size += len(xpk.serialize_manifests(manifest))
+  return size
+
+
+def render_template(xpk, args, system, names) -> int:
+  template = xpk.get_workload_manifest_template(
+      args, system, 'gcr.io/bench/image', args.command
+  )
+  return sum(len(template.render(workload=name)) for name in names)
+
+
+modes = {
+    'build': render_build,
+    'template': render_template,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Render throughput of the workload manifests of xpk.'
+  )
+  parser.add_argument(
+      '--variants',
+      type=int,
+      default=200,
+      help='Workload names rendered per system characteristics entry.',
+  )
+  args = parser.parse_args()
+
+  xpk = load_xpk()
+  accelerator_names = {value: key for key, value in xpk.AcceleratorType.items()}
+  names = [f'bench-workload-{i}' for i in range(args.variants)]
+  systems = xpk.UserFacingNameToSystemCharacteristics
+  workload_args = {
+      device_type: get_workload_args(xpk, device_type)
+      for device_type in systems
+  }
+
+  print(
+      f'{"Mode":<10} {"Accelerator":<12} {"Renders/s":>12} {"us/render":>10}'
+      f' {"KiB/render":>11}'
+  )
+  for mode, render in modes.items():
+    seconds = collections.Counter()
+    renders = collections.Counter()
+    size = collections.Counter()
+    for device_type, system in systems.items():
+      accelerator = accelerator_names[system.accelerator_type]
+      start = time.perf_counter()
+      size[accelerator] += render(
+          xpk, workload_args[device_type], system, names
+      )
+      seconds[accelerator] += time.perf_counter() - start
+      renders[accelerator] += len(names)
+    for accelerator in [*sorted(seconds), 'all']:
+      if accelerator == 'all':
+        total_seconds = sum(seconds.values())
+        total_renders = sum(renders.values())
+        total_size = sum(size.values())
+      else:
+        total_seconds = seconds[accelerator]
+        total_renders = renders[accelerator]
+        total_size = size[accelerator]
+      print(
+          f'{mode:<10} {accelerator:<12}'
+          f' {total_renders / total_seconds:>12.0f}'
+          f' {1e6 * total_seconds / total_renders:>10.1f}'
+          f' {total_size / total_renders / 1024:>11.2f}'
+      )
+  print(f'{len(systems)} system characteristics, {args.variants} variants each.')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,487 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+r"""End-to-end benchmarks of xpk driven by fake gcloud, kubectl and docker.
+
+Every scenario runs xpk.py in a fresh HOME and TMPDIR with the binaries of
+benchmarks/fakebin first on PATH, and reports the wall time, the number of
+gcloud/kubectl/docker invocations and the peak RSS. Results are compared with
+benchmarks/baseline.json and the run fails if any scenario regressed.
+
+Example usages:
+  # Run all scenarios and compare them with the baseline.
+  python3 benchmarks/run_benchmarks.py
+  # Only run the cluster create scenarios, three times each.
+  python3 benchmarks/run_benchmarks.py --scenarios cluster-create --repeat 3
+  # Make 5% of the node pool operations fail with a transient error.
+  python3 benchmarks/run_benchmarks.py --scenarios cluster-create \
+      --fake-env XPK_FAKE_NODE_POOL_FAILURE_RATE=0.05
+  # Record new baseline numbers for this machine.
+  python3 benchmarks/run_benchmarks.py --update-baseline
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from dataclasses import asdict, dataclass, field
+
+from fake_gcp_api_server import FakeGcpApiServer
+from fake_kube_api_server import FakeKubernetesApiServer
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+default_xpk_path = os.path.join(os.path.dirname(benchmarks_dir), 'xpk.py')
+default_baseline_path = os.path.join(benchmarks_dir, 'baseline.json')
+fakebin_dir = os.path.join(benchmarks_dir, 'fakebin')
+measure_command_path = os.path.join(benchmarks_dir, 'measure_command.py')
+default_tolerance = 0.25
+# Wall time differences below this many seconds are treated as noise.
+default_wall_slack_seconds = 0.5
+
+shared_xpk_args = [
+    '--cluster=bench-cluster',
+    '--project=fake-project',
+    '--zone=us-central2-b',
+]
+
+
+@dataclass
+class Scenario:
+  """One xpk invocation to benchmark.
+
+  `env` holds the settings of the fake binaries, see fakebin/fake_common.sh.
+  With `kube_api_workloads` set, xpk uses its native Kubernetes client
+  against a fake API server holding that many workloads. With `gcp_api`, xpk
+  uses its REST client against a fake Google Cloud API server where the
+  cluster exists, and node pool operations follow the node pool settings of
+  `env`. A `warm` scenario is measured on its second run, once the first
+  one filled the cluster context cache of xpk.
+  """
+  name: str
+  argv: list[str]
+  env: dict[str, str] = field(default_factory=dict)
+  kube_api_workloads: int | None = None
+  gcp_api: bool = False
+  warm: bool = False
+
+
+@dataclass
+class Measurement:
+  """Outcome of one scenario run."""
+  wall_seconds: float
+  commands: int
+  peak_rss_kib: int
+
+
+def get_scenarios() -> list[Scenario]:
+  """Returns all the benchmark scenarios."""
+  scenarios = []
+  for num_slices in (4, 64, 256, 1024):
+    scenarios.append(
+        Scenario(
+            f'cluster-create-{num_slices}',
+            [
+                'cluster',
+                'create',
+                '--tpu-type=v5litepod-16',
+                f'--num-slices={num_slices}',
+                '--on-demand',
+            ],
+            {'XPK_FAKE_NODE_POOL_LATENCY': '0.1'},
+        )
+    )
+  cluster_create_scenarios = scenarios[-4:]
+  # The cluster create scenarios again, with gcloud --async node pool
+  # operations and with the Google Cloud REST client.
+  for scenario in cluster_create_scenarios:
+    scenarios.append(
+        Scenario(
+            f'{scenario.name}-async',
+            scenario.argv
+            + ['--node-pool-async', '--node-pool-poll-interval=0.1'],
+            scenario.env,
+        )
+    )
+  for scenario in cluster_create_scenarios:
+    scenarios.append(
+        Scenario(
+            f'{scenario.name}-rest',
+            scenario.argv
+            + ['--gcp-client=rest', '--node-pool-poll-interval=0.1'],
+            scenario.env,
+            gcp_api=True,
+        )
+    )
+  scenarios.append(
+      Scenario(
+          'workload-create-5000',
+          [
+              'workload',
+              'create',
+              '--workload=bench-new-workload',
+              '--tpu-type=v5litepod-16',
+              '--num-slices=4',
+              '--command=echo hello',
+          ],
+          {'XPK_FAKE_WORKLOADS': '5000'},
+      )
+  )
+  scenarios.append(
+      Scenario(
+          'workload-list-5000',
+          ['workload', 'list'],
+          {'XPK_FAKE_WORKLOADS': '5000'},
+      )
+  )
+  scenarios.append(
+      Scenario(
+          'workload-delete-2000',
+          ['workload', 'delete', '--force'],
+          {'XPK_FAKE_WORKLOADS': '2000'},
+      )
+  )
+  workload_scenarios = scenarios[-3:]
+  # The workload create and list scenarios again, with the cluster context
+  # cached by a previous run.
+  for scenario in workload_scenarios[:2]:
+    scenarios.append(
+        Scenario(
+            f'{scenario.name}-warm', scenario.argv, scenario.env, warm=True
+        )
+    )
+  # The workload scenarios again, with the native Kubernetes client.
+  for scenario in workload_scenarios:
+    scenarios.append(
+        Scenario(
+            f'{scenario.name}-native',
+            scenario.argv + ['--kube-client=native'],
+            kube_api_workloads=int(scenario.env['XPK_FAKE_WORKLOADS']),
+        )
+    )
+  # Workload create where every command takes 0.2s, so the time depends on
+  # which of its checks and docker commands overlap.
+  scenarios.append(
+      Scenario(
+          'workload-create-latency',
+          workload_scenarios[0].argv,
+          {'XPK_FAKE_WORKLOADS': '5000', 'XPK_FAKE_LATENCY': '0.2'},
+      )
+  )
+  # Workload create on a cluster with 50000 workloads, mostly finished ones.
+  scenarios.append(
+      Scenario(
+          'workload-create-50000',
+          workload_scenarios[0].argv,
+          {'XPK_FAKE_WORKLOADS': '50000'},
+      )
+  )
+  scenarios.append(
+      Scenario(
+          'workload-create-50000-native',
+          workload_scenarios[0].argv + ['--kube-client=native'],
+          kube_api_workloads=50000,
+      )
+  )
+  return scenarios
+
+
+def run_scenario(scenario, xpk_path, fake_env=None) -> Measurement:
+  """Runs xpk once for `scenario`.
+
+  Args:
+    scenario: Scenario to run.
+    xpk_path: path of the xpk.py under test.
+    fake_env: settings of the fake binaries overriding those of the scenario.
+
+  Returns:
+    Measurement of the run.
+
+  Raises:
+    RuntimeError: if xpk failed.
+  """
+  with tempfile.TemporaryDirectory(prefix='xpk-bench-') as tmp_dir:
+    work_dir = os.path.join(tmp_dir, 'work')
+    os.mkdir(work_dir)
+    call_log = os.path.join(tmp_dir, 'calls.log')
+    output_path = os.path.join(tmp_dir, 'output.log')
+    result_path = os.path.join(tmp_dir, 'result.json')
+    env = dict(os.environ)
+    env.update({
+        'PATH': fakebin_dir + os.pathsep + env.get('PATH', ''),
+        'HOME': tmp_dir,
+        'TMPDIR': tmp_dir,
+        'XPK_FAKE_CALL_LOG': call_log,
+    })
+    env.update(scenario.env)
+    env.update(fake_env or {})
+    kube_api_server = None
+    if scenario.kube_api_workloads is not None:
+      kube_api_server = FakeKubernetesApiServer().start()
+      kube_api_server.seed_workloads(scenario.kube_api_workloads)
+      kube_api_server.seed_configmap(
+          'bench-cluster-resources-configmap', {'v5litepod-16': '4096'}
+      )
+      env['XPK_FAKE_KUBE_API'] = kube_api_server.url
+    argv = [*scenario.argv, *shared_xpk_args]
+    gcp_api_server = None
+    if scenario.gcp_api:
+      gcp_api_server = FakeGcpApiServer(
+          node_pool_latency=float(env.get('XPK_FAKE_NODE_POOL_LATENCY', 0)),
+          node_pool_failure_rate=float(
+              env.get('XPK_FAKE_NODE_POOL_FAILURE_RATE', 0)
+          ),
+      ).start()
+      gcp_api_server.state.add_cluster('bench-cluster')
+      gcp_api_server.seed_dashboards()
+      argv.append(f'--gcp-api-endpoint={gcp_api_server.url}')
+    # A warm scenario first runs xpk unmeasured in the same HOME.
+    for _ in range(2 if scenario.warm else 1):
+      if os.path.exists(call_log):
+        os.remove(call_log)
+      with open(output_path, 'wb') as output:
+        subprocess.run(
+            [
+                sys.executable,
+                measure_command_path,
+                result_path,
+                sys.executable,
+                xpk_path,
+                *argv,
+            ],
+            cwd=work_dir,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+      with open(result_path, 'r', encoding='utf-8') as f:
+        result = json.load(f)
+      if result['exit_code'] != 0:
+        break
+    if kube_api_server is not None:
+      kube_api_server.stop()
+    if gcp_api_server is not None:
+      gcp_api_server.stop()
+    if result['exit_code'] != 0:
+      with open(output_path, 'r', encoding='utf-8', errors='replace') as f:
+        tail = ''.join(f.readlines()[-20:])
+      raise RuntimeError(
+          f'{scenario.name} failed with code {result["exit_code"]}:\n{tail}'
+      )
+    commands = 0
+    if os.path.exists(call_log):
+      with open(call_log, 'r', encoding='utf-8', errors='replace') as f:
+        commands = sum(1 for _ in f)
+    # The peak RSS is the largest of xpk or any command it waited for, which
+    # is xpk itself since the fakes are shell scripts.
+    return Measurement(
+        result['wall_seconds'], commands, result['peak_rss_kib']
+    )
+
+
+def find_regressions(
+    name, measurement, baseline, tolerance, wall_slack_seconds
+) -> list[str]:
+  """Compares a measurement with its baseline.
+
+  The number of commands is deterministic with the default fake settings, so
+  any increase is a regression. Wall time and peak RSS may grow by
+  `tolerance`, and wall time by at least `wall_slack_seconds`.
+
+  Args:
+    name: name of the scenario.
+    measurement: Measurement of this run.
+    baseline: baseline Measurement of the scenario.
+    tolerance: allowed relative increase.
+    wall_slack_seconds: allowed absolute increase of the wall time.
+
+  Returns:
+    A description of each regression, empty if there are none.
+  """
+  regressions = []
+  allowed_wall = max(
+      baseline.wall_seconds * (1 + tolerance),
+      baseline.wall_seconds + wall_slack_seconds,
+  )
+  if measurement.wall_seconds > allowed_wall:
+    regressions.append(
+        f'{name}: wall time {measurement.wall_seconds:.2f}s exceeds'
+        f' {allowed_wall:.2f}s (baseline {baseline.wall_seconds:.2f}s)'
+    )
+  if measurement.commands > baseline.commands:
+    regressions.append(
+        f'{name}: ran {measurement.commands} commands, baseline'
+        f' {baseline.commands}'
+    )
+  allowed_rss = baseline.peak_rss_kib * (1 + tolerance)
+  if measurement.peak_rss_kib > allowed_rss:
+    regressions.append(
+        f'{name}: peak RSS {measurement.peak_rss_kib} KiB exceeds'
+        f' {allowed_rss:.0f} KiB (baseline {baseline.peak_rss_kib} KiB)'
+    )
+  return regressions
+
+
+def load_baseline(path) -> dict[str, Measurement]:
+  """Loads baseline measurements, keyed by scenario name."""
+  if not os.path.exists(path):
+    return {}
+  with open(path, 'r', encoding='utf-8') as f:
+    return {
+        name: Measurement(**values) for name, values in json.load(f).items()
+    }
+
+
+def save_baseline(path, baseline):
+  """Writes baseline measurements, keyed by scenario name."""
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(
+        {
+            name: dict(
+                asdict(measurement),
+                wall_seconds=round(measurement.wall_seconds, 3),
+            )
+            for name, measurement in sorted(baseline.items())
+        },
+        f,
+        indent=2,
+    )
+    f.write('\n')
+
+
+def format_change(value, base_value) -> str:
+  """Returns the relative change of `value` over `base_value`."""
+  if not base_value:
+    return ''
+  return f' ({100 * (value - base_value) / base_value:+.0f}%)'
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(
+      description='End-to-end xpk benchmarks with fake gcloud/kubectl/docker.'
+  )
+  parser.add_argument(
+      '--scenarios',
+      nargs='*',
+      default=None,
+      help='Only run scenarios whose name starts with one of these prefixes.',
+  )
+  parser.add_argument(
+      '--repeat',
+      type=int,
+      default=1,
+      help='Runs each scenario this many times and keeps the best run.',
+  )
+  parser.add_argument(
+      '--fake-env',
+      action='append',
+      default=[],
+      metavar='KEY=VALUE',
+      help=(
+          'Setting of the fake binaries applied to every scenario, e.g.'
+          ' XPK_FAKE_LATENCY=0.05. Can be repeated.'
+      ),
+  )
+  parser.add_argument(
+      '--xpk', default=default_xpk_path, help='Path of the xpk.py to measure.'
+  )
+  parser.add_argument(
+      '--baseline',
+      default=default_baseline_path,
+      help='Baseline file to compare with or to update.',
+  )
+  parser.add_argument(
+      '--update-baseline',
+      action='store_true',
+      help='Stores the results as the new baseline instead of comparing.',
+  )
+  parser.add_argument(
+      '--tolerance',
+      type=float,
+      default=default_tolerance,
+      help='Allowed relative increase of wall time and peak RSS.',
+  )
+  parser.add_argument(
+      '--wall-slack-seconds',
+      type=float,
+      default=default_wall_slack_seconds,
+      help='Allowed absolute increase of wall time.',
+  )
+  args = parser.parse_args()
+
+  scenarios = [
+      scenario
+      for scenario in get_scenarios()
+      if not args.scenarios
+      or any(scenario.name.startswith(prefix) for prefix in args.scenarios)
+  ]
+  fake_env = dict(setting.split('=', 1) for setting in args.fake_env)
+  baseline = load_baseline(args.baseline)
+  results = {}
+  regressions = []
+  print(
+      f'{"Scenario":<28} {"Wall (s)":>16} {"Commands":>16}'
+      f' {"Peak RSS (MiB)":>18}'
+  )
+  for scenario in scenarios:
+    runs = [run_scenario(scenario, args.xpk, fake_env) for _ in range(args.repeat)]
+    measurement = Measurement(
+        min(run.wall_seconds for run in runs),
+        min(run.commands for run in runs),
+        min(run.peak_rss_kib for run in runs),
+    )
+    results[scenario.name] = measurement
+    base = baseline.get(scenario.name)
+    print(
+        f'{scenario.name:<28}'
+        f' {measurement.wall_seconds:>8.2f}'
+        f'{format_change(measurement.wall_seconds, base and base.wall_seconds):>8}'
+        f' {measurement.commands:>8}'
+        f'{format_change(measurement.commands, base and base.commands):>8}'
+        f' {measurement.peak_rss_kib / 1024:>10.1f}'
+        f'{format_change(measurement.peak_rss_kib, base and base.peak_rss_kib):>8}',
+        flush=True,
+    )
+    if base is not None and not args.update_baseline:
+      regressions.extend(
+          find_regressions(
+              scenario.name,
+              measurement,
+              base,
+              args.tolerance,
+              args.wall_slack_seconds,
+          )
+      )
+
+  if args.update_baseline:
+    baseline.update(results)
+    save_baseline(args.baseline, baseline)
+    print(f'Updated baseline {args.baseline}')
+    return 0
+  if regressions:
+    print('Regressions compared with the baseline:')
+    for regression in regressions:
+      print(f'  {regression}')
+    return 1
+  print('No regressions compared with the baseline.')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
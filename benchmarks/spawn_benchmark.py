@@ -0,0 +1,127 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+r"""Microbenchmark of the process spawn throughput of xpk's command paths.
+
+Compares the ways xpk has run a `kubectl` lookup and counted its output:
+  shell-pipeline: `sh -c 'kubectl ... | wc -l'`, the count done by wc.
+  shell:          `sh -c 'kubectl ...'`, the count done in Python.
+  argv:           `kubectl ...` executed directly, the count done in Python.
+
+By default the fake kubectl of benchmarks/fakebin is used, so the numbers
+show the overhead of launching processes rather than of kubectl itself.
+
+Example usage:
+  python3 benchmarks/spawn_benchmark.py --count 1000 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import os
+import shlex
+import subprocess
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+default_command = (
+    f'{os.path.join(benchmarks_dir, "fakebin", "kubectl")} get node'
+    ' --no-headers=true --selector=cloud.google.com/gke-tpu-accelerator'
+)
+
+
+async def run_shell_pipeline(command) -> int:
+  child = await asyncio.create_subprocess_shell(
+      f'{command} | wc -l', stdout=subprocess.PIPE
+  )
+  stdout, _ = await child.communicate()
+  return int(stdout)
+
+
+async def run_shell(command) -> int:
+  child = await asyncio.create_subprocess_shell(
+      command, stdout=subprocess.PIPE
+  )
+  stdout, _ = await child.communicate()
+  return len(stdout.splitlines())
+
+
+async def run_argv(command) -> int:
+  child = await asyncio.create_subprocess_exec(
+      *shlex.split(command), stdout=subprocess.PIPE
+  )
+  stdout, _ = await child.communicate()
+  return len(stdout.splitlines())
+
+
+modes = {
+    'shell-pipeline': run_shell_pipeline,
+    'shell': run_shell,
+    'argv': run_argv,
+}
+
+
+async def measure(run, command, count, concurrency) -> float:
+  """Runs `command` `count` times and returns the elapsed seconds.
+
+  Args:
+    run: coroutine function running the command once.
+    command: command line to run.
+    count: number of runs.
+    concurrency: maximum number of runs in flight.
+
+  Returns:
+    Seconds taken by all the runs.
+  """
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def run_one():
+    async with semaphore:
+      await run(command)
+
+  start = time.perf_counter()
+  await asyncio.gather(*(run_one() for _ in range(count)))
+  return time.perf_counter() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Process spawn throughput of shell and argv execution.'
+  )
+  parser.add_argument(
+      '--command', default=default_command, help='Command line to spawn.'
+  )
+  parser.add_argument(
+      '--count', type=int, default=500, help='Number of spawns per mode.'
+  )
+  parser.add_argument(
+      '--concurrency',
+      type=int,
+      default=8,
+      help='Spawns in flight, 8 is the kubectl limit of xpk.',
+  )
+  args = parser.parse_args()
+
+  print(f'{"Mode":<16} {"Spawns/s":>10} {"ms/spawn":>10}')
+  for name, run in modes.items():
+    seconds = asyncio.run(measure(run, args.command, args.count, args.concurrency))
+    print(
+        f'{name:<16} {args.count / seconds:>10.1f}'
+        f' {1000 * seconds / args.count:>10.2f}'
+    )
+
+
+if __name__ == '__main__':
+  main()
@@ -327,23 +327,31 @@ echo python3 xpk.py cluster create \
   --cluster "${CLUSTER}" --tpu-type=v5litepod-256 \
   --num-slices="${NUMSLICES}" \
   --host-maintenance-interval=PERIODIC \
+  --registry-mirror \
   --custom-cluster-arguments="${CLUSTER_ARGUMENTS}" \
   --custom-tpu-nodepool-arguments="${TPU_NODEPOOL_ARGUMENTS}"
 
 # python3 xpk.py cluster create --cluster NAME \
 #  --tpu-type=v5litepod-256 --num-slices=64 \
+#  --registry-mirror \
 #  --host-maintenance-interval=PERIODIC \
 # --custom-cluster-arguments=  --network=NETWORK  --subnetwork=SUBNET  --scopes=storage-full,gke-default  --enable-ip-alias  --enable-private-nodes  --master-ipv4-cidr 172.16.0.32/28  --cluster-ipv4-cidr=10.224.0.0/12  --no-enable-master-authorized-networks
 # --custom-tpu-nodepool-arguments=  --scopes=storage-full,gke-default  --enable-gvnic  --max-pods-per-node 15  --disk-size=50
 
 ##### 5C #####################
 # Scale up to NUMSLICES (64 in the provided case) V5e-256s.
+# --registry-mirror deploys a pull-through cache of gcr.io in the cluster so
+# that thousands of nodes pulling the same image hit the cache instead of
+# the registry. Nodes fall back to gcr.io if the mirror is unavailable. Use
+# --registry-mirror-upstream for an Artifact Registry host such as
+# us-docker.pkg.dev, and --registry-mirror-replicas to size the cache.
 ##### 5C #####################
 
 python3 xpk.py cluster create \
   --cluster "${CLUSTER}" --tpu-type=v5litepod-256 \
   --num-slices="${NUMSLICES}" \
   --host-maintenance-interval=PERIODIC \
+  --registry-mirror \
   --custom-cluster-arguments="${CLUSTER_ARGUMENTS}" \
   --custom-tpu-nodepool-arguments="${TPU_NODEPOOL_ARGUMENTS}"
 
@@ -480,24 +488,35 @@ bash docker_upload_runner.sh CLOUD_IMAGE_NAME="${USER}"_runner
 ##### 7C #####################
 # Cluster cacheimage to enable faster start times.
 # XPK offers cacheimage as a wrapper around daemonset.
+# With --registry-mirror (5C), the nodes pull the image through the mirror in
+# the cluster, so only the first pull of each layer reaches gcr.io.
 ##### 7C #####################
 cd ../xpk
 python3 xpk.py cluster cacheimage \
  --cluster ${CLUSTER} --docker-image gcr.io/"${PROJECT}"/"${USER}"_runner \
- --tpu-type=v5litepod-256
+ --tpu-type=v5litepod-256 --wait
+
+# Rerunning cacheimage with a new image updates the daemonset in place: each
+# node keeps the previous image until it pulled the new one. --wait returns once
+# every node cached the image, or lists the nodes still pulling it after
+# --wait-timeout seconds. Use --max-surge to limit how many nodes pull at once.
+# --docker-image takes several images, e.g. the base and code images of the
+# next runs, which are pulled by init containers so that each cache key only
+# keeps a small pause container per node. Delete the cache keys you no longer
+# need with `python3 xpk.py cluster cacheimage-gc --cluster ${CLUSTER}`.
 
 # [XPK] Starting xpk
 # [XPK] Starting cluster cacheimage for cluster: xpk-test
 # [XPK] Working on args.project='PROJECT' and us-central2-b
-# [XPK] Task: `Deleting Cached Image` is implemented by `kubectl delete -f /tmp/tmpypvl4dn_ --ignore-not-found=true`, streaming output live.
-# [XPK] Waiting for `Deleting Cached Image`, for 0 seconds
-# [XPK] Waiting for `Deleting Cached Image`, for 1 seconds
-# daemonset.apps "containerimage" deleted
-# [XPK] Task: `Deleting Cached Image` terminated with code `0`
-# [XPK] Task: `Creating Cached Image` is implemented by `kubectl apply -f /tmp/tmpypvl4dn_`, streaming output live.
-# [XPK] Waiting for `Creating Cached Image`, for 0 seconds
-# daemonset.apps/containerimage created
-# [XPK] Task: `Creating Cached Image` terminated with code `0`
+# [XPK] Caching gcr.io/PROJECT/USER_runner as gcr.io/PROJECT/USER_runner@sha256:...
+# [XPK] Task: `Updating Cached Image` is implemented by `kubectl apply -f /tmp/tmpypvl4dn_`, streaming output live.
+# daemonset.apps/containerimage configured
+# [XPK] Task: `Updating Cached Image` terminated with code `0`
+# [XPK] [t=0.00, Cache Image] 0/4096 nodes cached
+# [XPK] Node gke-xpk-test-np-0-1a2b3c4d-x1y2 cached the image in 38.2s
+# ...
+# [XPK] [t=120.41, Cache Image] 4096/4096 nodes cached
+# [XPK] All 4096 nodes cached the image. Pull time median 41.7s, slowest 97.3s.
 # [XPK] Exiting XPK cleanly
 
 ##### 7D #####################
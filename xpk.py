@@ -32,15 +32,32 @@ Next Steps:
 """
 
 import argparse
+import asyncio
+import atexit
+import base64
+import collections
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
+import heapq
+import http.client
+import json
 import os
+import posixpath
 import random
 import re
-import string
+import shlex
+import shutil
+import signal
+import ssl
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import urllib.parse
+from collections.abc import Callable
 from dataclasses import dataclass
 
 ################### Compatibility Check ###################
@@ -64,63 +81,151 @@ if (
 ################### Internally used constants ##############
 
 default_docker_image = 'python:3.10'
+# Length of the tags derived from the hash of a docker build context.
+docker_context_tag_length = 20
 default_script_dir = os.getcwd()
 default_gke_version="1.28.3-gke.1286000"
+kueue_manifest_url = 'https://github.com/kubernetes-sigs/kueue/releases/download/v0.4.1/manifests.yaml'
+jobset_manifest_url = 'https://github.com/kubernetes-sigs/jobset/releases/download/v0.3.1/manifests.yaml'
+# Images of the registry mirror and of the helper containers of xpk, from the
+# Docker Hub cache of Google so that nodes without internet access can pull
+# them.
+registry_mirror_image = 'mirror.gcr.io/library/registry:2.8.3'
+busybox_image = 'mirror.gcr.io/library/busybox:1.36'
+# How often `cluster cacheimage --wait` checks which nodes cached the image.
+cache_image_poll_interval_seconds = 10
+# Local state kept by xpk between invocations, such as step journals.
+xpk_state_dir = os.path.join(os.path.expanduser('~'), '.xpk')
+# How often long running commands print a progress update.
+progress_interval_seconds = 1
+# Maximum number of commands of the same tool run concurrently by
+# `run_command_async`, across all the threads of xpk. Batched node pool
+# commands have their own limit.
+max_concurrent_commands_per_tool = {'gcloud': 4, 'kubectl': 8}
+default_max_concurrent_commands_per_tool = 8
+_tool_semaphores = {}
+_tool_semaphores_lock = threading.Lock()
+# Words that start a command line without being the tool it runs.
+command_prefix_words = frozenset(
+    ['cd', 'command', 'env', 'exec', 'export', 'set', 'unset']
+)
+# Characters that need a shell when they appear outside of quotes. Commands
+# without them are split into an argv and executed directly.
+shell_special_chars = frozenset('|&;<>()$`\\*?[]{}~!#\n')
+# Commands started by any thread that may still be running, so that a step
+# graph can terminate them when failing fast.
+_running_commands = set()
+_running_commands_lock = threading.Lock()
+_print_lock = threading.Lock()
+# Logs of batched commands are kept in one directory per xpk run. Each log is
+# capped and compressed once its command finishes, and only the most recent
+# runs are kept.
+xpk_log_root = os.path.join(tempfile.gettempdir(), 'xpk-logs')
+max_command_log_bytes = 10 * 1024 * 1024
+command_log_tail_lines = 40
+log_retention_runs = 50
+log_retention_days = 7
+# Run directories modified more recently than this are never pruned.
+log_retention_grace_seconds = 60 * 60
+_run_log_dir = None
+# The native Kubernetes client (`--kube-client=native`) talks to the API server
+# over one connection per xpk run instead of launching kubectl.
+kubernetes_field_manager = 'xpk'
+kubernetes_api_timeout_seconds = 60
+kubernetes_list_page_size = 500
+# Names of objects and containers, label values and names of environment
+# variables, checked by `get_manifest_errors` before manifests are submitted.
+kubernetes_name_pattern = r'[a-z0-9]([-a-z0-9.]*[a-z0-9])?'
+kubernetes_container_name_pattern = r'[a-z0-9]([-a-z0-9]*[a-z0-9])?'
+kubernetes_label_value_pattern = r'([A-Za-z0-9]([-A-Za-z0-9_.]*[A-Za-z0-9])?)?'
+env_var_pattern = r'[-._a-zA-Z][-._a-zA-Z0-9]*'
+# Integer fields of the manifests xpk builds, which the API server rejects
+# when given as strings.
+kubernetes_integer_fields = frozenset([
+    'backoffLimit',
+    'completions',
+    'containerPort',
+    'maxRestarts',
+    'parallelism',
+    'replicas',
+    'terminationGracePeriodSeconds',
+])
+_kubernetes_client = None
+_kubernetes_client_lock = threading.Lock()
+# The REST client (`--gcp-client=rest`) calls the GKE, Compute Engine and Cloud
+# Monitoring APIs over pooled connections instead of launching gcloud.
+gcp_api_endpoints = {
+    'container': 'https://container.googleapis.com',
+    'compute': 'https://compute.googleapis.com',
+    'monitoring': 'https://monitoring.googleapis.com',
+}
+gcp_api_timeout_seconds = 60
+gcp_operation_poll_seconds = 5
+# Node pool operations still running after this many seconds fail the step,
+# and so do submitted operations that GKE does not list for this many polls.
+node_pool_operation_timeout_seconds = 2 * 60 * 60
+max_missing_operation_polls = 6
+# OAuth scopes of the gcloud `--scopes=storage-full,gke-default` aliases.
+node_pool_oauth_scopes = (
+    'https://www.googleapis.com/auth/devstorage.full_control',
+    'https://www.googleapis.com/auth/logging.write',
+    'https://www.googleapis.com/auth/monitoring',
+    'https://www.googleapis.com/auth/servicecontrol',
+    'https://www.googleapis.com/auth/service.management.readonly',
+    'https://www.googleapis.com/auth/trace.append',
+)
+_gcp_client = None
+_gcp_client_lock = threading.Lock()
+# Cluster contexts cache the setup of workload and cluster commands across
+# runs, see ClusterContextCache.
+cluster_context_dir = os.path.join(xpk_state_dir, 'contexts')
+default_context_cache_ttl_seconds = 3600
+_context_cache = None
+_context_cache_lock = threading.Lock()
+# TraceRecorder of this xpk run, set by `--trace-file`.
+_tracer = None
+# RunProfiler of this xpk run, set by `--profile`.
+_profiler = None
+# Errors of node pool create and delete commands showing that GKE is
+# overloaded by concurrent operations, which lower the node pool parallelism.
+node_pool_congestion_errors = (
+    r'incompatible operation',
+    r'operation .*already in progress',
+    r'already has an operation in progress',
+    r'RESOURCE_EXHAUSTED',
+    r'rateLimitExceeded',
+    r'Quota exceeded',
+    r'Too many requests',
+    r'\b429\b',
+)
+# Errors of node pool create and delete commands that are worth retrying:
+# concurrent operations on the cluster, rate limiting and stockouts.
+node_pool_retryable_errors = (
+    r'incompatible operation',
+    r'operation .*already in progress',
+    r'already has an operation in progress',
+    r'please try again',
+    r'try again later',
+    r'RESOURCE_EXHAUSTED',
+    r'rateLimitExceeded',
+    r'Quota exceeded',
+    r'Too many requests',
+    r'\b429\b',
+    r'STOCKOUT',
+    r'does not have enough resources available',
+    r'ZONE_RESOURCE_POOL_EXHAUSTED',
+    r'\bUNAVAILABLE\b',
+)
 
-workload_create_yaml = """apiVersion: jobset.x-k8s.io/v1alpha2
-kind: JobSet
-metadata:
-  name: {args.workload}
-  labels:
-    kueue.x-k8s.io/queue-name: multislice-queue  # Name of the LocalQueue
-    xpk.google.com/workload: {args.workload}
-  annotations:
-    alpha.jobset.sigs.k8s.io/exclusive-topology: cloud.google.com/gke-nodepool # 1:1 job replica to node pool assignment
-spec:
-  failurePolicy:
-    maxRestarts: {args.max_restarts}
-  replicatedJobs:
-    - name: slice-job
-      replicas: {args.num_slices}
-      template:
-        spec:
-          parallelism: {system.vms_per_slice}    # Equal to the number of VMs per slice
-          completions: {system.vms_per_slice}    # Same as the above.
-          backoffLimit: 0   # When any pod fails, the job is failed
-          template:
-            metadata:
-              labels:
-                xpk.google.com/workload: {args.workload}
-            spec:
-              schedulerName: {args.scheduler}
-              restartPolicy: Never
-              {affinity}
-              nodeSelector:
-                {accelerator_label}
-                {machine_label}
-              priorityClassName: {args.priority}
-              hostNetwork: true
-              dnsPolicy: ClusterFirstWithHostNet
-              terminationGracePeriodSeconds: {args.termination_grace_period_seconds}
-              containers:
-              {container}
-                {env}
-                volumeMounts:
-                - mountPath: /dev/shm
-                  name: dshm-2
-              volumes:
-              - emptyDir:
-                  medium: Memory
-                name: dshm-2
-"""
-
-workload_delete_yaml = """apiVersion: jobset.x-k8s.io/v1alpha2
-kind: JobSet
-metadata:
-  name: {args.workload}
-  annotations:
-    alpha.jobset.sigs.k8s.io/exclusive-topology: cloud.google.com/gke-nodepool # 1:1 job replica to node pool assignment
-"""
+# Kubernetes priority classes of `workload create --priority`, as name, value
+# and description.
+workload_priority_classes = (
+    ('very-low', 100, 'Very Low'),
+    ('low', 250, 'Low'),
+    ('medium', 500, 'Medium'),
+    ('high', 750, 'High'),
+    ('very-high', 1000, 'Very High'),
+)
 
 script_dir_dockerfile = """FROM {base_docker_image}
 
@@ -133,81 +238,10 @@ COPY . .
 WORKDIR /app
 """
 
-cluster_set_crd_yaml = """apiVersion: kueue.x-k8s.io/v1beta1
-kind: ResourceFlavor
-metadata:
-  name: {cluster_hardware_name}
-spec:
-  nodeLabels:
-    {accelerator_label}
-    {machine_label}
----
-apiVersion: kueue.x-k8s.io/v1beta1
-kind: ClusterQueue
-metadata:
-  name: "cluster-queue"
-spec:
-  preemption:
-      reclaimWithinCohort: Never # Don't preempt other queues in the cohort.
-      withinClusterQueue: LowerPriority
-  namespaceSelector: {{}} # match all.
-  resourceGroups:
-  - coveredResources: ["{resource_type}"]
-    flavors:
-    - name: {cluster_hardware_name}
-      resources:
-      - name: "{resource_type}"
-        nominalQuota: {total_chips}  # Number of slices * number of chips in each slice
----
-apiVersion: kueue.x-k8s.io/v1beta1
-kind: LocalQueue
-metadata:
-  namespace: default
-  name: multislice-queue
-spec:
-  clusterQueue: cluster-queue
----
-apiVersion: scheduling.k8s.io/v1
-kind: PriorityClass
-metadata:
-  name: very-low
-value: 100
-globalDefault: false
-description: "Very Low"
----
-apiVersion: scheduling.k8s.io/v1
-kind: PriorityClass
-metadata:
-  name: low
-value: 250
-globalDefault: false
-description: "Low"
----
-apiVersion: scheduling.k8s.io/v1
-kind: PriorityClass
-metadata:
-  name: medium
-value: 500
-globalDefault: false
-description: "Medium"
----
-apiVersion: scheduling.k8s.io/v1
-kind: PriorityClass
-metadata:
-  name: high
-value: 750
-globalDefault: false
-description: "High"
----
-apiVersion: scheduling.k8s.io/v1
-kind: PriorityClass
-metadata:
-  name: very-high
-value: 1000
-globalDefault: false
-description: "Very High"
-"""
-
+# Pulls the images of `cluster cacheimage` with init containers that exit at
+# once, through a static busybox binary copied from the first init container
+# so that the images need no shell. A small pause container then keeps the
+# pod, and with it the images, on the node.
 cluster_preheat_yml = """
 apiVersion: apps/v1
 kind: DaemonSet
@@ -215,12 +249,18 @@ metadata:
   name: {cachekey}
   labels:
     k8s-app: {cachekey}
+    xpk.google.com/cache-key: {cachekey}
+  annotations:
+    xpk.google.com/cached-at: "{cached_at}"
 spec:
   selector:
     matchLabels:
       k8s-app: {cachekey}
   updateStrategy:
     type: RollingUpdate
+    rollingUpdate:
+      maxUnavailable: {max_unavailable}
+      maxSurge: {max_surge}
   template:
     metadata:
       labels:
@@ -236,10 +276,197 @@ spec:
                 operator: Exists
       tolerations:
       - operator: "Exists"
+      initContainers:
+      - image: {busybox_image}
+        name: install-busybox
+        command: [ "cp", "/bin/busybox", "/xpk-cache/busybox" ]
+        resources:
+          requests: {{ cpu: 1m, memory: 16Mi }}
+        volumeMounts:
+        - name: xpk-cache
+          mountPath: /xpk-cache
+{cache_containers}
       containers:
-      - image: {image_name}
-        name: {cachekey}
+      - image: {busybox_image}
+        name: pause
+        command: [ "sleep", "inf" ]
+        resources:
+          requests: {{ cpu: 1m, memory: 16Mi }}
+      volumes:
+      - name: xpk-cache
+        emptyDir: {{}}
+"""
+
+cluster_preheat_cache_container_yml = """      - image: {image_name}
+        name: cache-{index}
+        {image_pull_policy}
+        command: [ "/xpk-cache/busybox", "true" ]
+        resources:
+          requests: {{ cpu: 1m, memory: 16Mi }}
+        volumeMounts:
+        - name: xpk-cache
+          mountPath: /xpk-cache"""
+
+# In-cluster pull-through cache of `{upstream}`. The token of the node service
+# account expires after an hour, so the registry restarts with a fresh one
+# every 45 minutes; nodes pull from the upstream registry in the meantime.
+registry_mirror_yaml = """apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: xpk-registry-mirror
+  namespace: kube-system
+  labels:
+    k8s-app: xpk-registry-mirror
+spec:
+  replicas: {replicas}
+  selector:
+    matchLabels:
+      k8s-app: xpk-registry-mirror
+  template:
+    metadata:
+      labels:
+        k8s-app: xpk-registry-mirror
+    spec:
+      affinity:
+        nodeAffinity:
+          requiredDuringSchedulingIgnoredDuringExecution:
+            nodeSelectorTerms:
+            - matchExpressions:
+              - key: cloud.google.com/gke-tpu-accelerator
+                operator: DoesNotExist
+              - key: cloud.google.com/gke-accelerator
+                operator: DoesNotExist
+        podAntiAffinity:
+          preferredDuringSchedulingIgnoredDuringExecution:
+          - weight: 100
+            podAffinityTerm:
+              topologyKey: kubernetes.io/hostname
+              labelSelector:
+                matchLabels:
+                  k8s-app: xpk-registry-mirror
+      containers:
+      - name: registry
+        image: {registry_image}
+        env:
+        - name: REGISTRY_PROXY_REMOTEURL
+          value: https://{upstream}
+        - name: REGISTRY_PROXY_USERNAME
+          value: oauth2accesstoken
+        command: [/bin/sh, -c]
+        args:
+        - |
+          while true; do
+            export REGISTRY_PROXY_PASSWORD=$(wget -q -O - --header 'Metadata-Flavor: Google' http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token | sed 's/.*"access_token" *: *"\\([^"]*\\)".*/\\1/')
+            registry serve /etc/docker/registry/config.yml &
+            sleep 2700
+            kill $!
+            wait $!
+          done
+        ports:
+        - containerPort: 5000
+        readinessProbe:
+          httpGet:
+            path: /v2/
+            port: 5000
+        volumeMounts:
+        - name: cache
+          mountPath: /var/lib/registry
+      volumes:
+      - name: cache
+        emptyDir:
+          sizeLimit: {cache_size}
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: xpk-registry-mirror
+  namespace: kube-system
+spec:
+  selector:
+    k8s-app: xpk-registry-mirror
+  ports:
+  - port: 5000
+    targetPort: 5000
+"""
+
+# Points containerd of every node at the registry mirror for `{upstream}`,
+# falling back to the registry itself when the mirror fails. With a hosts
+# directory (`config_path`) containerd picks up the mirror on the next pull,
+# otherwise a mirror is added to its config file and containerd restarts.
+registry_mirror_config_yaml = """apiVersion: apps/v1
+kind: DaemonSet
+metadata:
+  name: xpk-registry-mirror-config
+  namespace: kube-system
+  labels:
+    k8s-app: xpk-registry-mirror-config
+spec:
+  selector:
+    matchLabels:
+      k8s-app: xpk-registry-mirror-config
+  updateStrategy:
+    type: RollingUpdate
+    rollingUpdate:
+      maxUnavailable: 100%
+  template:
+    metadata:
+      labels:
+        k8s-app: xpk-registry-mirror-config
+    spec:
+      hostPID: true
+      priorityClassName: system-node-critical
+      tolerations:
+      - operator: "Exists"
+      initContainers:
+      - name: configure-containerd
+        image: {busybox_image}
+        securityContext:
+          privileged: true
+        command: [/bin/sh, -c]
+        args:
+        - |
+          set -e
+          config=/host/etc/containerd/config.toml
+          hosts_dir=$(sed -n 's/^ *config_path *= *"\\(.*\\)"/\\1/p' $config | head -n 1)
+          if [ -n "$hosts_dir" ]; then
+            mkdir -p /host$hosts_dir/{upstream}
+            cat > /host$hosts_dir/{upstream}/hosts.toml <<EOF
+          server = "https://{upstream}"
+
+          [host."http://{mirror_address}:5000"]
+            capabilities = ["pull", "resolve"]
+          EOF
+            exit 0
+          fi
+          sed '/^# xpk-registry-mirror begin/,/^# xpk-registry-mirror end/d' $config > $config.xpk
+          if grep -qF 'registry.mirrors."{upstream}"]' $config.xpk; then
+            echo 'containerd already has a mirror for {upstream}, keeping it.'
+            rm $config.xpk
+            exit 0
+          fi
+          cat >> $config.xpk <<EOF
+          # xpk-registry-mirror begin
+          [plugins."io.containerd.grpc.v1.cri".registry.mirrors."{upstream}"]
+            endpoint = ["http://{mirror_address}:5000", "https://{upstream}"]
+          # xpk-registry-mirror end
+          EOF
+          if cmp -s $config.xpk $config; then
+            rm $config.xpk
+            exit 0
+          fi
+          mv $config.xpk $config
+          nsenter -t 1 -m -u -i -n -p -- systemctl restart containerd
+        volumeMounts:
+        - name: host
+          mountPath: /host
+      containers:
+      - name: pause
+        image: {busybox_image}
         command: [ "sleep", "inf" ]
+      volumes:
+      - name: host
+        hostPath:
+          path: /
 """
 
 cluster_configmap_yaml = """kind: ConfigMap
@@ -697,119 +924,867 @@ UserFacingNameToSystemCharacteristics = {
 Map in MaxText/accelerator_to_spec_map.py """
 # ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 
-def chunks(lst, n):
-  """Return a list of n-sized chunks from lst.
+def is_log_dir_in_use(run_dir) -> bool:
+  """Returns whether the xpk run that owns a log directory is still running.
+
+  Args:
+    run_dir: log directory named `<timestamp>-<pid>` by `get_run_log_dir`.
+
+  Returns:
+    True if the process of the run still exists.
+  """
+  pid = os.path.basename(run_dir).rpartition('-')[2]
+  if not pid.isdigit():
+    return False
+  try:
+    os.kill(int(pid), 0)
+  except ProcessLookupError:
+    return False
+  except OSError:
+    # The process exists but belongs to another user.
+    return True
+  return True
+
+
+def prune_log_dirs(log_root, keep_runs, max_age_days):
+  """Deletes old per-run log directories.
+
+  Directories modified in the last `log_retention_grace_seconds` and those of
+  runs that are still going are kept, so that concurrent runs never delete
+  each other's logs and manifests.
 
   Args:
-    lst: input list to get chunks from.
-    n: size of each chunk.
+    log_root: directory holding one directory per xpk run.
+    keep_runs: number of most recent run directories to keep.
+    max_age_days: run directories older than this are deleted.
+  """
+  try:
+    names = os.listdir(log_root)
+  except OSError:
+    return
+  run_dirs = []
+  for name in names:
+    run_dir = os.path.join(log_root, name)
+    try:
+      if os.path.isdir(run_dir):
+        run_dirs.append((os.path.getmtime(run_dir), run_dir))
+    except OSError:
+      # Deleted by a concurrent run.
+      continue
+  run_dirs.sort(reverse=True)
+  now = time.time()
+  oldest_allowed = now - max_age_days * 24 * 60 * 60
+  for i, (mtime, run_dir) in enumerate(run_dirs):
+    if i < keep_runs and mtime >= oldest_allowed:
+      continue
+    if mtime > now - log_retention_grace_seconds or is_log_dir_in_use(run_dir):
+      continue
+    try:
+      shutil.rmtree(run_dir)
+    except OSError:
+      continue
+
+
+def get_run_log_dir() -> str:
+  """Returns the log directory of this xpk run, creating it on first use.
+
+  Creating it also applies the retention policy to the logs of older runs.
 
   Returns:
-    List of n-sized chunks for lst.
+    Path of the log directory.
   """
-  return [lst[i:i+n] for i in range(0, len(lst), n)]
+  global _run_log_dir
+  if _run_log_dir is None:
+    prune_log_dirs(xpk_log_root, log_retention_runs - 1, log_retention_days)
+    run_name = (
+        f'{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+    )
+    _run_log_dir = os.path.join(xpk_log_root, run_name)
+    os.makedirs(_run_log_dir, exist_ok=True)
+  return _run_log_dir
 
 
-def make_tmp_files(per_command_name):
-  """Make temporary files for each command.
+class CommandLog:
+  """Output of one batched command.
+
+  The output of each attempt is appended to a file, capped at `max_bytes` per
+  attempt, and the last `tail_lines` lines of the current attempt are kept in
+  memory so that failures can be shown and classified without reading the file
+  back. The file is only opened once the command starts, so queued commands do
+  not hold file descriptors.
+  """
+
+  def __init__(self, path, max_bytes, tail_lines):
+    self.name = path
+    self.file = None
+    self.max_bytes = max_bytes
+    self.bytes_written = 0
+    self.truncated = False
+    self.tail = collections.deque(maxlen=tail_lines)
+    self.partial_line = b''
+
+  def start_attempt(self):
+    """Opens the log and resets the tail and the cap before each attempt."""
+    if self.file is None:
+      # Kept open while the command runs, closed by `close`.
+      self.file = open(self.name, 'ab')  # pylint: disable=consider-using-with
+    self.tail.clear()
+    self.partial_line = b''
+    self.bytes_written = 0
+    self.truncated = False
+
+  def write(self, data):
+    """Appends a chunk of output to the tail and, within the cap, the file.
+
+    Args:
+      data: bytes read from the command.
+    """
+    lines = (self.partial_line + data).split(b'\n')
+    self.partial_line = lines.pop()
+    self.tail.extend(line.decode('utf-8', errors='replace') for line in lines)
+    if self.truncated:
+      return
+    room = self.max_bytes - self.bytes_written
+    if len(data) > room:
+      self.file.write(data[:room])
+      self.file.write(
+          f'\n[xpk: log truncated at {self.max_bytes} bytes]\n'.encode()
+      )
+      self.truncated = True
+    else:
+      self.file.write(data)
+    self.bytes_written += min(len(data), room)
+
+  def tail_text(self) -> str:
+    """Returns the last lines of output of the current attempt."""
+    lines = list(self.tail)
+    if self.partial_line:
+      lines.append(self.partial_line.decode('utf-8', errors='replace'))
+    return '\n'.join(lines)
+
+  def close(self, compress=True):
+    """Closes the log file, gzip compressing it if asked.
+
+    Args:
+      compress: replaces the log with a `.gz` file if True.
+    """
+    if self.file is None or self.file.closed:
+      return
+    self.file.close()
+    if not compress:
+      return
+    with open(self.name, 'rb') as f_in, gzip.open(
+        self.name + '.gz', 'wb'
+    ) as f_out:
+      shutil.copyfileobj(f_in, f_out)
+    os.remove(self.name)
+    self.name += '.gz'
+
+
+def make_command_logs(per_command_name) -> list[CommandLog]:
+  """Make a log in the run log directory for each command.
 
   Args:
     per_command_name: list of command names.
 
   Returns:
-    A list of temporary files for each command.
+    A list of CommandLog, one per command.
   """
+  log_dir = get_run_log_dir()
   return [
-      tempfile.NamedTemporaryFile(delete=False, prefix=command + '-')
-      for command in per_command_name
+      CommandLog(
+          os.path.join(log_dir, f'{name}-{i}.log'),
+          max_command_log_bytes,
+          command_log_tail_lines,
+      )
+      for i, name in enumerate(per_command_name)
   ]
 
 
-def run_commands(commands, jobname, per_command_name, batch=10, dry_run=False):
-  """Run commands in groups of `batch`.
+def print_log_tail(log):
+  """Prints the last lines of a command log.
+
+  Args:
+    log: CommandLog of the command.
+  """
+  xpk_print(f'Last {len(log.tail)} lines of output:')
+  for line in log.tail_text().splitlines():
+    xpk_print(f'  {line}')
+
+
+class TraceRecorder:
+  """Spans of one xpk run, saved in Chrome trace-event format.
+
+  The file can be opened in Perfetto (https://ui.perfetto.dev) or
+  chrome://tracing. The whole subcommand is the root span, and overlapping
+  spans of the same category are laid out on separate tracks.
+  """
+
+  def __init__(self, path, name):
+    self.path = path
+    self.name = name
+    self.start = time.perf_counter()
+    self.spans = []
+    self.lock = threading.Lock()
+    self.saved = False
+
+  def add_span(self, name, category, start, end, **span_args):
+    """Records a span.
+
+    Args:
+      name: name of the span, e.g. the task of a command.
+      category: kind of span, each category gets its own tracks.
+      start: time.perf_counter() at the start of the span.
+      end: time.perf_counter() at the end of the span.
+      **span_args: details shown with the span, such as the exit code.
+    """
+    with self.lock:
+      self.spans.append((name, category, start, end, span_args))
+
+  def to_trace_events(self) -> list[dict]:
+    """Returns the spans as a list of Chrome trace events."""
+    pid = os.getpid()
+    events = [{
+        'name': 'process_name',
+        'ph': 'M',
+        'pid': pid,
+        'args': {'name': f'xpk {self.name}'},
+    }]
+    # Track end times per category, the index of a track is its position.
+    track_ends = {}
+    track_ids = {}
+    with self.lock:
+      spans = sorted(self.spans, key=lambda span: (span[2], -span[3]))
+    for name, category, start, end, span_args in spans:
+      ends = track_ends.setdefault(category, [])
+      track = next(
+          (t for t, track_end in enumerate(ends) if track_end <= start),
+          len(ends),
+      )
+      if track == len(ends):
+        ends.append(end)
+        track_ids[(category, track)] = len(track_ids) + 1
+        events.append({
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': pid,
+            'tid': track_ids[(category, track)],
+            'args': {'name': f'{category} {track}'},
+        })
+      ends[track] = end
+      events.append({
+          'name': name,
+          'cat': category,
+          'ph': 'X',
+          'ts': round((start - self.start) * 1e6),
+          'dur': round((end - start) * 1e6),
+          'pid': pid,
+          'tid': track_ids[(category, track)],
+          'args': span_args,
+      })
+    return events
+
+  def save(self, return_code=None):
+    """Closes the root span and writes the trace file, only once.
+
+    Args:
+      return_code: exit code of xpk, if known.
+    """
+    if self.saved:
+      return
+    self.saved = True
+    self.add_span(
+        self.name,
+        'subcommand',
+        self.start,
+        time.perf_counter(),
+        exit_code=return_code,
+    )
+    with open(self.path, 'w', encoding='utf-8') as f:
+      json.dump(
+          {'traceEvents': self.to_trace_events(), 'displayTimeUnit': 'ms'}, f
+      )
+    xpk_print(f'Wrote trace of {len(self.spans)} spans to {self.path}')
+
+
+def start_tracing(path, name):
+  """Records spans of this run and saves them to `path` when xpk exits.
+
+  Args:
+    path: trace file to write.
+    name: name of the subcommand, used for the root span.
+  """
+  global _tracer
+  _tracer = TraceRecorder(path, name)
+  atexit.register(_tracer.save)
+
+
+class RunProfiler:
+  """Wall-time profile of one xpk run, printed as a table at exit.
+
+  Time is aggregated per step, per task of single commands and per batch of
+  commands. Spans of the same row that overlap are summed, so rows of
+  concurrent work can add up to more than the wall time.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.start = time.perf_counter()
+    self.lock = threading.Lock()
+    # (name, kind) -> [count, seconds]
+    self.rows = {}
+    self.spawns = 0
+    self.pipe_bytes = 0
+    self.poll_sleep_seconds = 0.0
+    self.printed = False
+
+  def add_span(self, name, category, start, end, **span_args):
+    """Adds a span recorded by `trace_span` to its row.
+
+    Args:
+      name: name of the span.
+      category: kind of span.
+      start: time.perf_counter() at the start of the span.
+      end: time.perf_counter() at the end of the span.
+      **span_args: details of the span. Batched commands carry their `task`.
+    """
+    if category == 'command' and 'task' in span_args:
+      key = (span_args['task'], 'batch')
+    else:
+      key = (name, category)
+    with self.lock:
+      row = self.rows.setdefault(key, [0, 0.0])
+      row[0] += 1
+      row[1] += end - start
+
+  def count(self, spawns=0, pipe_bytes=0, poll_sleep_seconds=0.0):
+    """Adds to the process, pipe and polling counters."""
+    with self.lock:
+      self.spawns += spawns
+      self.pipe_bytes += pipe_bytes
+      self.poll_sleep_seconds += poll_sleep_seconds
+
+  def print_summary(self, return_code=None):
+    """Prints the profile table, only once.
+
+    Args:
+      return_code: exit code of xpk, unused but accepted like
+        `TraceRecorder.save` so both can be registered with atexit.
+    """
+    del return_code
+    if self.printed:
+      return
+    self.printed = True
+    wall = max(time.perf_counter() - self.start, 1e-9)
+    with self.lock:
+      rows = sorted(self.rows.items(), key=lambda row: -row[1][1])
+    name_width = max([len('Step / task')] + [len(name) for name, _ in self.rows])
+    xpk_print(f'Profile of {self.name} (wall time {wall:.2f}s):')
+    xpk_print(
+        f'  {"Step / task":<{name_width}}  {"Kind":<7}  {"Count":>5}'
+        f'  {"Time (s)":>9}  {"% wall":>7}'
+    )
+    for (name, kind), (count, seconds) in rows:
+      xpk_print(
+          f'  {name:<{name_width}}  {kind:<7}  {count:>5}  {seconds:>9.2f}'
+          f'  {100 * seconds / wall:>6.1f}%'
+      )
+    xpk_print(f'  Processes spawned: {self.spawns}')
+    xpk_print(f'  Bytes read from subprocess pipes: {self.pipe_bytes:,}')
+    xpk_print(
+        '  Time sleeping in poll loops:'
+        f' {self.poll_sleep_seconds:.2f}s'
+        f' ({100 * self.poll_sleep_seconds / wall:.1f}% of wall time)'
+    )
+
+
+def start_profiling(name):
+  """Profiles this run and prints the table when xpk exits.
+
+  Args:
+    name: name of the subcommand.
+  """
+  global _profiler
+  _profiler = RunProfiler(name)
+  atexit.register(_profiler.print_summary)
+
+
+def profile_count(spawns=0, pipe_bytes=0, poll_sleep_seconds=0.0):
+  """Adds to the counters of the profile if profiling is enabled.
+
+  Args:
+    spawns: number of processes started.
+    pipe_bytes: number of bytes read from subprocess pipes.
+    poll_sleep_seconds: time spent in a poll loop without any progress.
+  """
+  if _profiler is not None:
+    _profiler.count(spawns, pipe_bytes, poll_sleep_seconds)
+
+
+def trace_span(name, category, start, end=None, **span_args):
+  """Records a span if tracing or profiling is enabled.
+
+  Args:
+    name: name of the span.
+    category: kind of span, e.g. `command` or `step`.
+    start: time.perf_counter() at the start of the span.
+    end: time.perf_counter() at the end of the span. Defaults to now.
+    **span_args: details shown with the span, such as the exit code.
+  """
+  if end is None:
+    end = time.perf_counter()
+  if _tracer is not None:
+    _tracer.add_span(name, category, start, end, **span_args)
+  if _profiler is not None:
+    _profiler.add_span(name, category, start, end, **span_args)
+
+
+@dataclass
+class CommandTiming:
+  """Start and end of one command run by `run_command_batch`.
+
+  Times are seconds relative to the start of the batch. `end` and
+  `return_code` stay None for commands that never finished. `attempts` counts
+  retries as well as the first run.
+  """
+  name: str
+  start: float | None = None
+  end: float | None = None
+  return_code: int | None = None
+  attempts: int = 0
+
+
+@dataclass
+class CommandResult:
+  """Structured outcome of one external command."""
+  task: str
+  command: str
+  return_code: int
+  stdout: str = ''
+  stderr: str = ''
+  duration: float = 0.0
+
+
+@dataclass
+class RetryPolicy:
+  """Decides which failed commands of a batch are retried, and when.
+
+  A failed command is retried when its output matches one of
+  `retryable_patterns` and it has been attempted fewer than `max_attempts`
+  times. Retries wait for an exponential backoff with full jitter.
+  """
+  max_attempts: int = 1
+  initial_backoff_seconds: float = 10
+  max_backoff_seconds: float = 300
+  retryable_patterns: tuple[str, ...] = ()
+
+  def is_retryable(self, output) -> bool:
+    """Returns True if `output` of a failed command shows a transient error.
+
+    Args:
+      output: output of the failed attempt.
+
+    Returns:
+      True if the failure should be retried.
+    """
+    return any(
+        re.search(pattern, output, re.IGNORECASE)
+        for pattern in self.retryable_patterns
+    )
+
+  def backoff_seconds(self, attempt) -> float:
+    """Returns how long to wait before running attempt `attempt + 1`.
+
+    Args:
+      attempt: number of attempts made so far, starting at 1.
+
+    Returns:
+      Number of seconds to wait.
+    """
+    ceiling = min(
+        self.max_backoff_seconds,
+        self.initial_backoff_seconds * 2 ** (attempt - 1),
+    )
+    return random.uniform(0, ceiling)
+
+
+class AdaptiveConcurrencyLimit:
+  """Additive-increase / multiplicative-decrease limit on parallel commands.
+
+  Every successful command raises the limit by one, up to `maximum`. A failure
+  whose output matches `congestion_patterns` multiplies it by
+  `decrease_factor`, down to `minimum`. Only commands dispatched after the last
+  decrease can trigger the next one, so a burst of failures caused by the same
+  overloaded window backs off once.
+  """
+
+  def __init__(
+      self,
+      initial,
+      minimum=1,
+      maximum=None,
+      congestion_patterns=(),
+      decrease_factor=0.5,
+  ):
+    self.minimum = max(1, minimum)
+    self.maximum = max(self.minimum, maximum or initial)
+    self.limit = min(max(initial, self.minimum), self.maximum)
+    self.initial = self.limit
+    self.peak = self.limit
+    self.decreases = 0
+    self.epoch = 0
+    self.congestion_patterns = congestion_patterns
+    self.decrease_factor = decrease_factor
+
+  def is_congestion(self, output) -> bool:
+    """Returns True if `output` of a failed command signals overload.
+
+    Args:
+      output: output of the failed attempt.
+
+    Returns:
+      True if the failure should lower the limit.
+    """
+    return any(
+        re.search(pattern, output, re.IGNORECASE)
+        for pattern in self.congestion_patterns
+    )
+
+  def on_success(self):
+    """Raises the limit after a successful command."""
+    self.limit = min(self.maximum, self.limit + 1)
+    self.peak = max(self.peak, self.limit)
+
+  def on_congestion(self, epoch) -> bool:
+    """Lowers the limit after a command failed because of overload.
+
+    Args:
+      epoch: value of `self.epoch` when the failed command was dispatched.
+
+    Returns:
+      True if the limit was lowered.
+    """
+    if epoch != self.epoch:
+      return False
+    self.limit = max(self.minimum, int(self.limit * self.decrease_factor))
+    self.epoch += 1
+    self.decreases += 1
+    return True
+
+  def summary(self) -> str:
+    """Returns a one line description of how the limit evolved."""
+    return (
+        f'concurrency started at {self.initial} (bounds {self.minimum}-'
+        f'{self.maximum}), peaked at {self.peak}, ended at {self.limit} after'
+        f' {self.decreases} back-offs'
+    )
+
+
+def print_command_timings(jobname, timings):
+  """Prints the per-command start and end times of a batch.
+
+  Args:
+    jobname: the name of the job.
+    timings: list of CommandTiming.
+  """
+  xpk_print(f'Per-command timings for {jobname}:')
+  for timing in timings:
+    attempts_str = (
+        f', {timing.attempts} attempts' if timing.attempts > 1 else ''
+    )
+    if timing.start is None:
+      xpk_print(f'  {timing.name}: not started')
+    elif timing.end is None:
+      xpk_print(
+          f'  {timing.name}: started t={timing.start:.2f}, did not'
+          f' finish{attempts_str}'
+      )
+    else:
+      xpk_print(
+          f'  {timing.name}: started t={timing.start:.2f}, ended'
+          f' t={timing.end:.2f}, took {timing.end - timing.start:.2f}s,'
+          f' code {timing.return_code}{attempts_str}'
+      )
+
+
+async def pump_command_output_async(child, log) -> int:
+  """Streams the output of a child into its log and waits for it to exit.
+
+  Args:
+    child: asyncio subprocess with stdout piped.
+    log: CommandLog to write to.
+
+  Returns:
+    The return code of the child.
+  """
+  while True:
+    chunk = await child.stdout.read(64 * 1024)
+    if not chunk:
+      break
+    profile_count(pipe_bytes=len(chunk))
+    log.write(chunk)
+  return await child.wait()
+
+
+def run_commands(
+    commands,
+    jobname,
+    per_command_name,
+    batch=10,
+    dry_run=False,
+    *,
+    retry_policy=None,
+    concurrency_limit=None,
+):
+  """Run commands keeping at most `batch` of them in flight.
 
   Args:
     commands: list of command.
     jobname: the name of the job.
     per_command_name: list of command names.
-    batch: number of commands to run in parallel.
+    batch: maximum number of commands to run in parallel.
     dry_run: enables dry_run if set to true.
+    retry_policy: RetryPolicy for failed commands. No retries if None.
+    concurrency_limit: AdaptiveConcurrencyLimit used instead of `batch`.
 
   Returns:
     0 if successful and 1 otherwise.
   """
-  temporary_files_batches = chunks(make_tmp_files(per_command_name), batch)
-  commands_batched = chunks(commands, batch)
-  per_command_name_batches = chunks(per_command_name, batch)
+  command_logs = make_command_logs(per_command_name)
 
-  xpk_print(
-      f'Breaking up a total of {len(commands)} commands into'
-      f' {len(commands_batched)} batches'
-  )
+  if concurrency_limit is not None:
+    xpk_print(
+        f'Dispatching a total of {len(commands)} commands with an adaptive'
+        f' parallelism of {concurrency_limit.limit} (between'
+        f' {concurrency_limit.minimum} and {concurrency_limit.maximum})'
+    )
+  else:
+    xpk_print(
+        f'Dispatching a total of {len(commands)} commands with up to'
+        f' {batch} running in parallel'
+    )
   if dry_run:
     xpk_print('Pretending all the jobs succeeded')
+    now = time.perf_counter()
+    for command, name in zip(commands, per_command_name):
+      trace_span(
+          name, 'command', now, now, task=jobname, command=command, dry_run=True
+      )
     return 0
 
-  max_return_code = 0
-  for i, _ in enumerate(commands_batched):
-    xpk_print(f'Dispatching batch {i}/{len(commands_batched)}')
-    batch_max_return_code, _ = run_command_batch(
-        commands_batched[i],
-        jobname,
-        per_command_name_batches[i],
-        temporary_files_batches[i],
-    )
-    max_return_code = max(max_return_code, batch_max_return_code)
-    if max_return_code > 0:
-      return max_return_code
-  return max_return_code
-
+  return_code, _ = run_command_batch(
+      commands,
+      jobname,
+      per_command_name,
+      command_logs,
+      max_parallel=batch,
+      retry_policy=retry_policy,
+      concurrency_limit=concurrency_limit,
+  )
+  return return_code
+
+
+def run_command_batch(
+    commands,
+    jobname,
+    per_command_name,
+    output_logs,
+    *,
+    max_parallel=None,
+    retry_policy=None,
+    concurrency_limit=None,
+):
+  """Runs commands in parallel with a sliding window of `max_parallel`.
 
-def run_command_batch(commands, jobname, per_command_name, output_logs):
-  """Runs commands in parallel.
+  A new command is started as soon as a running one exits, so a single slow
+  command never holds back the rest of the queue.
 
   Args:
     commands: list of n commands, each command is a a list of strings
     jobname: Useful debugging name for the group of commands
     per_command_name: specific name per task
-    output_logs: list of n log paths, each command will output to each log.
+    output_logs: list of n CommandLog, each command will output to each log.
+    max_parallel: maximum number of commands in flight. Defaults to all.
+    retry_policy: RetryPolicy for failed commands. No retries if None.
+    concurrency_limit: AdaptiveConcurrencyLimit that replaces `max_parallel`.
 
   Returns:
-    The max return code and a list of all the return codes.
+    The return code of the first failed command (0 if all succeeded) and a
+    list of all the return codes.
   """
+  return asyncio.run(
+      run_command_batch_async(
+          commands,
+          jobname,
+          per_command_name,
+          output_logs,
+          max_parallel=max_parallel,
+          retry_policy=retry_policy,
+          concurrency_limit=concurrency_limit,
+      )
+  )
+
+
+async def run_command_batch_async(
+    commands,
+    jobname,
+    per_command_name,
+    output_logs,
+    *,
+    max_parallel=None,
+    retry_policy=None,
+    concurrency_limit=None,
+):
+  """Coroutine behind `run_command_batch`.
+
+  Completion of every child is awaited directly, so the next command is
+  dispatched and a failure is acted upon the moment a child exits. Progress is
+  still printed every `progress_interval_seconds` while nothing finishes.
+
+  A failure that `retry_policy` deems transient only re-queues that command
+  after a backoff; the commands already in flight keep running. Any other
+  failure terminates all running commands.
+
+  With a `concurrency_limit`, the window follows that limit as it grows on
+  successes and shrinks on failures that signal overload.
+
+  Args:
+    commands: list of n commands, each command is a a list of strings
+    jobname: Useful debugging name for the group of commands
+    per_command_name: specific name per task
+    output_logs: list of n CommandLog, each command will output to each log.
+    max_parallel: maximum number of commands in flight. Defaults to all.
+    retry_policy: RetryPolicy for failed commands. No retries if None.
+    concurrency_limit: AdaptiveConcurrencyLimit that replaces `max_parallel`.
 
-  children = []
+  Returns:
+    The return code of the first failed command (0 if all succeeded) and a
+    list of all the return codes.
+  """
+  total = len(commands)
+  if not max_parallel or max_parallel < 1:
+    max_parallel = max(total, 1)
+  if retry_policy is None:
+    retry_policy = RetryPolicy()
+
+  pending = collections.deque(range(total))
+  # Heap of (monotonic time the retry is due, command index).
+  retries = []
+  running = {}
+  dispatch_epochs = [0] * total
+  attempt_starts = [0.0] * total
+  returncodes = [None] * total
+  timings = [CommandTiming(name) for name in per_command_name]
+  failed_returncode = 0
   start_time = datetime.datetime.now()
-  for i, command in enumerate(commands):
-    children.append(
-        # subprocess managed by list pylint: disable=consider-using-with
-        subprocess.Popen(
-            command, stdout=output_logs[i], stderr=output_logs[i], shell=True
-        )
-    )
 
   while True:
-    returncodes = [child.poll() for child in children]
-    max_returncode = max([0] + [r for r in returncodes if r is not None])
-    completed = len([r for r in returncodes if r is not None])
-    total = len(returncodes)
+    while len(running) < (
+        concurrency_limit.limit if concurrency_limit else max_parallel
+    ):
+      if retries and retries[0][0] <= time.monotonic():
+        i = heapq.heappop(retries)[1]
+      elif pending:
+        i = pending.popleft()
+      else:
+        break
+      if timings[i].start is None:
+        timings[i].start = (
+            datetime.datetime.now() - start_time
+        ).total_seconds()
+      timings[i].attempts += 1
+      output_logs[i].start_attempt()
+      if concurrency_limit:
+        dispatch_epochs[i] = concurrency_limit.epoch
+      attempt_starts[i] = time.perf_counter()
+      child = await start_command_async(
+          commands[i], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+      )
+      waiter = asyncio.ensure_future(
+          pump_command_output_async(child, output_logs[i])
+      )
+      running[waiter] = (i, child)
+
+    timeout = progress_interval_seconds
+    if retries:
+      timeout = max(0, min(timeout, retries[0][0] - time.monotonic()))
+    wait_start = time.perf_counter()
+    if running:
+      done, _ = await asyncio.wait(
+          running.keys(),
+          timeout=timeout,
+          return_when=asyncio.FIRST_COMPLETED,
+      )
+    else:
+      await asyncio.sleep(timeout)
+      done = set()
+    if not done:
+      profile_count(poll_sleep_seconds=time.perf_counter() - wait_start)
+
+    for waiter in done:
+      i, _ = running.pop(waiter)
+      return_code = waiter.result()
+      trace_span(
+          per_command_name[i],
+          'command',
+          attempt_starts[i],
+          task=jobname,
+          command=commands[i],
+          attempt=timings[i].attempts,
+          exit_code=return_code,
+      )
+      output = output_logs[i].tail_text() if return_code != 0 else ''
+      if concurrency_limit and return_code == 0:
+        concurrency_limit.on_success()
+      elif (
+          concurrency_limit
+          and concurrency_limit.is_congestion(output)
+          and concurrency_limit.on_congestion(dispatch_epochs[i])
+      ):
+        xpk_print(
+            f'{jobname} is being throttled, lowering parallelism to'
+            f' {concurrency_limit.limit}'
+        )
+      if return_code != 0 and timings[i].attempts < retry_policy.max_attempts:
+        if retry_policy.is_retryable(output):
+          backoff = retry_policy.backoff_seconds(timings[i].attempts)
+          xpk_print(
+              f'Task {per_command_name[i]} failed with a transient error on'
+              f' attempt {timings[i].attempts}/{retry_policy.max_attempts},'
+              f' retrying in {backoff:.1f}s. Logfile {output_logs[i].name}'
+          )
+          heapq.heappush(retries, (time.monotonic() + backoff, i))
+          continue
+      output_logs[i].close()
+      returncodes[i] = return_code
+      timings[i].end = (datetime.datetime.now() - start_time).total_seconds()
+      timings[i].return_code = return_code
+      if failed_returncode == 0:
+        # Not max(): children killed by a signal exit with a negative code.
+        failed_returncode = return_code
+
+    completed = total - len(running) - len(pending) - len(retries)
     seconds_elapsed = (datetime.datetime.now() - start_time).total_seconds()
-    if completed < total:
-      slow_worker_index = returncodes.index(None)
-      slow_worker_text = per_command_name[slow_worker_index]
+    if running:
+      slow_worker_index = min(i for i, _ in running.values())
       slow_str = (
-          f', task {slow_worker_text} still working, logfile'
-          f' {output_logs[slow_worker_index].name}'
+          f', task {per_command_name[slow_worker_index]} still working,'
+          f' logfile {output_logs[slow_worker_index].name}'
       )
     else:
       slow_str = ''
+    retry_str = f', waiting to retry {len(retries)}' if retries else ''
+    limit_str = (
+        f' (limit {concurrency_limit.limit})' if concurrency_limit else ''
+    )
     xpk_print(
         f'[t={seconds_elapsed:.2f}, {jobname}] Completed'
-        f' {completed}/{total}{slow_str}'
+        f' {completed}/{total}, running'
+        f' {len(running)}{limit_str}{retry_str}{slow_str}'
     )
-    if max_returncode > 0:
+    if failed_returncode != 0:
       failing_index = [
-          i for i, x in enumerate(returncodes) if x is not None and x > 0
+          i for i, x in enumerate(returncodes) if x is not None and x != 0
       ][0]
       xpk_print(
           f'Terminating all {jobname} processes since at least one failed.'
@@ -818,38 +1793,592 @@ def run_command_batch(commands, jobname, per_command_name, output_logs):
           f'Failure is {per_command_name[failing_index]}'
           f' and logfile {output_logs[failing_index].name}'
       )
-      for child in children:
-        child.terminate()
+      print_log_tail(output_logs[failing_index])
+      for _, child in running.values():
+        if child.returncode is None:
+          child.terminate()
+      await asyncio.gather(*running.keys())
+      for waiter, (i, _) in running.items():
+        trace_span(
+            per_command_name[i],
+            'command',
+            attempt_starts[i],
+            task=jobname,
+            command=commands[i],
+            attempt=timings[i].attempts,
+            exit_code=waiter.result(),
+            terminated=True,
+        )
+      for log in output_logs:
+        log.close()
       break
 
-    if completed == total:
+    if not running and not pending and not retries:
       break
 
-    time.sleep(1)
-  return max_returncode, returncodes
+  print_command_timings(jobname, timings)
+  if concurrency_limit:
+    xpk_print(f'{jobname} {concurrency_limit.summary()}')
+  return failed_returncode, returncodes
 
 
-def add_zone_and_project(args):
-  """Obtains the zone and project names from gcloud configs if not defined.
+@dataclass
+class Step:
+  """A unit of work of a step graph.
 
-  Args:
-    args: user provided arguments for running the command.
+  `run` is called once every step named in `dependencies` succeeded and
+  returns 0 if successful. Times are seconds relative to the start of the
+  graph and stay None for steps that did not start or finish.
   """
-  if not args.project:
-    args.project = get_project()
-  if not args.zone:
-    args.zone = get_zone()
-  xpk_print(f'Working on {args.project=} and {args.zone}')
+  name: str
+  run: Callable[[], int]
+  dependencies: tuple[str, ...] = ()
+  # Resumable steps are idempotent and skipped when a StepJournal shows they
+  # already succeeded with the same `inputs`.
+  resumable: bool = False
+  inputs: dict | None = None
+  # Set for steps that only prepare local state for their dependents, such as
+  # kubectl credentials: they rerun whenever one of their dependents runs.
+  rerun_with_dependents: bool = False
+  # Set for steps that may prompt the user: they run one at a time on the
+  # main thread, while the other steps keep running on worker threads.
+  interactive: bool = False
+  start: float | None = None
+  end: float | None = None
+  return_code: int | None = None
+  resumed: bool = False
+  # Set for steps stopped because another step failed, see `fail_fast`.
+  cancelled: bool = False
+
+
+class StepJournal:
+  """Record of the steps of a command that completed, stored as JSON.
+
+  Each entry keeps a fingerprint of the step inputs, so a completed step is
+  only considered done again if it would run with the same inputs. Notes keep
+  facts about what the steps created, such as the create time of a cluster.
+  """
+
+  def __init__(self, path, read_only=False):
+    self.path = path
+    self.read_only = read_only
+    self.entries = {}
+    self.notes = {}
+    if os.path.exists(path):
+      try:
+        with open(path, 'r', encoding='utf-8') as f:
+          self.entries = json.load(f)
+      except (OSError, ValueError) as e:
+        xpk_print(f'Ignoring unreadable step journal {path}: {e}')
+      self.notes = self.entries.pop('_notes', {})
+
+  @staticmethod
+  def fingerprint(inputs) -> str:
+    """Returns a stable hash of the inputs of a step."""
+    payload = json.dumps(inputs or {}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+  def is_complete(self, name, inputs) -> bool:
+    """Returns True if step `name` already succeeded with `inputs`."""
+    entry = self.entries.get(name)
+    return entry is not None and entry['inputs'] == self.fingerprint(inputs)
+
+  def record(self, name, inputs):
+    """Marks step `name` as completed with `inputs`."""
+    self.entries[name] = {
+        'inputs': self.fingerprint(inputs),
+        'completed_at': datetime.datetime.now().isoformat(),
+    }
+    self.save()
+
+  def forget(self, name):
+    """Marks step `name` as not completed."""
+    if self.entries.pop(name, None) is not None:
+      self.save()
+
+  def set_note(self, name, value):
+    """Keeps `value` as note `name`, until the journal is cleared."""
+    self.notes[name] = value
+    self.save()
+
+  def clear(self):
+    """Forgets all steps and notes."""
+    self.entries = {}
+    self.notes = {}
+    self.save()
+
+  def save(self):
+    """Writes the journal to disk, atomically replacing the previous one."""
+    if self.read_only:
+      return
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        'w',
+        dir=os.path.dirname(self.path),
+        delete=False,
+        encoding='utf-8',
+    ) as tmp:
+      json.dump(
+          self.entries | ({'_notes': self.notes} if self.notes else {}),
+          tmp,
+          indent=2,
+          sort_keys=True,
+      )
+    os.replace(tmp.name, self.path)
 
 
-def add_env_config(args):
-  """Adds environment configurations to the jobset config.
+def get_dependent_step_names(steps, name) -> set[str]:
+  """Returns `name` and the names of all steps that depend on it.
 
   Args:
-    args: user provided arguments for running the command.
+    steps: list of Step.
+    name: name of the step.
+
+  Returns:
+    Set of step names.
   """
-  env = {'JOBSET_NAME': args.workload}
-  if args.env_file:
+  names = {name}
+  changed = True
+  while changed:
+    changed = False
+    for step in steps:
+      if step.name not in names and names.intersection(step.dependencies):
+        names.add(step.name)
+        changed = True
+  return names
+
+
+def get_resumed_step_names(steps, journal) -> set[str]:
+  """Returns the names of the steps the journal shows as already done.
+
+  Args:
+    steps: list of Step.
+    journal: StepJournal of previous runs.
+
+  Returns:
+    Set of names of steps that do not need to run again.
+  """
+  steps_by_name = {step.name: step for step in steps}
+  resumed = {
+      step.name
+      for step in steps
+      if step.resumable and journal.is_complete(step.name, step.inputs)
+  }
+  changed = True
+  while changed:
+    changed = False
+    for step in steps:
+      if step.name in resumed:
+        continue
+      for dependency in step.dependencies:
+        if (
+            dependency in resumed
+            and steps_by_name[dependency].rerun_with_dependents
+        ):
+          resumed.remove(dependency)
+          changed = True
+  return resumed
+
+
+def validate_step_graph(steps):
+  """Checks that step names are unique and dependencies form a DAG.
+
+  Args:
+    steps: list of Step.
+
+  Raises:
+    ValueError: if the steps do not form a valid graph.
+  """
+  steps_by_name = {step.name: step for step in steps}
+  if len(steps_by_name) != len(steps):
+    raise ValueError('Step names must be unique.')
+  for step in steps:
+    for dependency in step.dependencies:
+      if dependency not in steps_by_name:
+        raise ValueError(
+            f'Step `{step.name}` depends on unknown step `{dependency}`.'
+        )
+  visiting, visited = set(), set()
+
+  def visit(name):
+    if name in visited:
+      return
+    if name in visiting:
+      raise ValueError(f'Step `{name}` is part of a dependency cycle.')
+    visiting.add(name)
+    for dependency in steps_by_name[name].dependencies:
+      visit(dependency)
+    visiting.remove(name)
+    visited.add(name)
+
+  for step in steps:
+    visit(step.name)
+
+
+def get_critical_path(steps) -> list[Step]:
+  """Returns the chain of steps that determined the end of the graph.
+
+  Starting from the step that finished last, repeatedly follows the
+  dependency that finished last, i.e. the one the step was waiting on.
+
+  Args:
+    steps: list of Step after the graph ran.
+
+  Returns:
+    Steps of the critical path, in execution order.
+  """
+  steps_by_name = {step.name: step for step in steps}
+  finished = [step for step in steps if step.end is not None]
+  if not finished:
+    return []
+  step = max(finished, key=lambda s: s.end)
+  path = [step]
+  while step.dependencies:
+    step = max(
+        (steps_by_name[name] for name in step.dependencies),
+        key=lambda s: s.end,
+    )
+    path.append(step)
+  return path[::-1]
+
+
+def print_step_graph_summary(jobname, steps):
+  """Prints the timing of each step and the critical path of the graph.
+
+  Args:
+    jobname: the name of the graph.
+    steps: list of Step after the graph ran.
+  """
+  xpk_print(f'Step timings for {jobname}:')
+  for step in steps:
+    if step.resumed:
+      xpk_print(f'  {step.name}: already completed by a previous run')
+    elif step.start is None:
+      xpk_print(f'  {step.name}: skipped')
+    elif step.end is None:
+      xpk_print(f'  {step.name}: started t={step.start:.2f}, did not finish')
+    elif step.cancelled:
+      xpk_print(
+          f'  {step.name}: started t={step.start:.2f}, stopped'
+          f' t={step.end:.2f} after another step failed'
+      )
+    else:
+      xpk_print(
+          f'  {step.name}: started t={step.start:.2f}, ended'
+          f' t={step.end:.2f}, took {step.end - step.start:.2f}s, code'
+          f' {step.return_code}'
+      )
+  critical_path = get_critical_path(steps)
+  if critical_path:
+    path_str = ' -> '.join(
+        f'{step.name} (resumed)'
+        if step.resumed
+        else f'{step.name} ({step.end - step.start:.2f}s)'
+        for step in critical_path
+    )
+    xpk_print(
+        f'Critical path of {jobname} ({critical_path[-1].end:.2f}s):'
+        f' {path_str}'
+    )
+
+
+def run_step_graph(steps, jobname, journal=None, fail_fast=False) -> int:
+  """Runs steps in parallel as soon as their dependencies succeed.
+
+  Steps run on worker threads, and interactive steps one at a time on the
+  main thread. A step that raises, including through `xpk_exit`, fails with
+  code 1 or the code it exits with. Once a step fails no new step is started,
+  the steps already running are waited for, or with `fail_fast` stopped by
+  terminating their commands.
+
+  Args:
+    steps: list of Step.
+    jobname: user-facing name of the graph.
+    journal: StepJournal used to skip resumable steps that already completed
+      and to record the ones that complete now.
+    fail_fast: terminates the commands of the running steps once a step
+      fails. Only for steps that are safe to interrupt, such as checks.
+
+  Returns:
+    0 if all steps succeeded, otherwise the return code of the first failure.
+  """
+  validate_step_graph(steps)
+  steps_by_name = {step.name: step for step in steps}
+  first_failure = None
+  start_time = time.perf_counter()
+
+  if journal is not None:
+    resumed_step_names = get_resumed_step_names(steps, journal)
+    for step in steps:
+      if step.name in resumed_step_names:
+        step.resumed = True
+        xpk_print(
+            f'[{jobname}] Skipping step `{step.name}`, it already completed'
+            ' with the same inputs. Use `--restart` or `--from-step` to run it'
+            ' again.'
+        )
+
+  def finish_step(step, get_return_code, running):
+    nonlocal first_failure
+    try:
+      step.return_code = get_return_code()
+    except SystemExit as e:
+      step.return_code = e.code if isinstance(e.code, int) and e.code else 1
+      xpk_print(f'[{jobname}] Step `{step.name}` exited')
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      step.return_code = 1
+      xpk_print(f'[{jobname}] Step `{step.name}` raised {e!r}')
+    step.cancelled = fail_fast and first_failure is not None
+    step.end = time.perf_counter() - start_time
+    trace_span(
+        step.name,
+        'step',
+        start_time + step.start,
+        start_time + step.end,
+        graph=jobname,
+        exit_code=step.return_code,
+    )
+    xpk_print(
+        f'[{jobname}] Step `{step.name}` finished with code'
+        f' {step.return_code} after {step.end - step.start:.2f}s'
+    )
+    if journal is not None and step.resumable:
+      if step.return_code == 0:
+        journal.record(step.name, step.inputs)
+      else:
+        journal.forget(step.name)
+    if step.return_code != 0 and first_failure is None:
+      first_failure = step
+      if running and fail_fast:
+        xpk_print(
+            f'[{jobname}] Not starting new steps since `{step.name}`'
+            ' failed, stopping the running steps.'
+        )
+      elif running:
+        xpk_print(
+            f'[{jobname}] Not starting new steps since `{step.name}`'
+            ' failed, waiting for the running steps to finish.'
+        )
+
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=max(len(steps), 1)
+  ) as executor:
+    running = {}
+    interactive = []
+    while True:
+      # Resumed steps complete as soon as their dependencies do, so that
+      # their dependents still wait for steps that rerun, like credentials.
+      scheduled = first_failure is None
+      while scheduled:
+        scheduled = False
+        for step in steps:
+          if (
+              step.start is not None
+              or step in interactive
+              or not all(
+                  steps_by_name[name].return_code == 0
+                  for name in step.dependencies
+              )
+          ):
+            continue
+          if step.resumed:
+            step.start = time.perf_counter() - start_time
+            step.end = step.start
+            step.return_code = 0
+            scheduled = True
+            trace_span(
+                step.name,
+                'step',
+                start_time + step.start,
+                start_time + step.end,
+                graph=jobname,
+                resumed=True,
+            )
+          elif step.interactive:
+            interactive.append(step)
+          else:
+            step.start = time.perf_counter() - start_time
+            xpk_print(f'[{jobname}] Starting step `{step.name}`')
+            running[executor.submit(step.run)] = step
+      if interactive and first_failure is None:
+        step = interactive.pop(0)
+        step.start = time.perf_counter() - start_time
+        xpk_print(f'[{jobname}] Starting step `{step.name}`')
+        finish_step(step, step.run, running)
+        continue
+      if not running:
+        break
+      if fail_fast and first_failure is not None:
+        # Also catches the commands that steps start after the first failure.
+        terminate_running_commands()
+        done, _ = concurrent.futures.wait(
+            running,
+            timeout=progress_interval_seconds,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+      else:
+        done, _ = concurrent.futures.wait(
+            running, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+      for future in done:
+        step = running.pop(future)
+        finish_step(step, future.result, running)
+
+  print_step_graph_summary(jobname, steps)
+  if first_failure is not None:
+    return first_failure.return_code
+  return 0
+
+
+class ClusterContextCache:
+  """Setup of cluster commands reused across xpk runs, stored as JSON.
+
+  Each cluster, keyed by project, region and name, has an entry recording
+  that its private kubeconfig is up to date, with the IDs of its monitoring
+  dashboards. The gcloud default project and zone are kept in a
+  `gcloud-defaults` entry. Entries older than `ttl_seconds` are ignored.
+  """
+
+  def __init__(self, directory, ttl_seconds):
+    self.directory = directory
+    self.ttl_seconds = ttl_seconds
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def cluster_key(args) -> str:
+    """Returns the name of the entry of the cluster of `args`."""
+    return f'{args.project}_{zone_to_region(args.zone)}_{args.cluster}'
+
+  def path(self, name) -> str:
+    return os.path.join(self.directory, f'{name}.json')
+
+  def load(self, name) -> dict | None:
+    """Returns entry `name`, or None if it is missing or expired."""
+    try:
+      with open(self.path(name), 'r', encoding='utf-8') as f:
+        entry = json.load(f)
+    except FileNotFoundError:
+      return None
+    except (OSError, ValueError) as e:
+      xpk_print(f'Ignoring unreadable cluster context {self.path(name)}: {e}')
+      return None
+    if time.time() - entry.get('saved_at', 0) > self.ttl_seconds:
+      return None
+    return entry
+
+  def save(self, name, entry):
+    """Writes entry `name`, atomically replacing the previous one."""
+    entry.setdefault('saved_at', time.time())
+    os.makedirs(self.directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        'w', dir=self.directory, delete=False, encoding='utf-8'
+    ) as tmp:
+      json.dump(entry, tmp, indent=2, sort_keys=True)
+    os.replace(tmp.name, self.path(name))
+
+  def add_dashboard(self, name, dashboard_filter, dashboard_id):
+    """Records a dashboard ID in an unexpired entry, keeping its age."""
+    with self.lock:
+      entry = self.load(name)
+      if entry is not None:
+        entry.setdefault('dashboards', {})[dashboard_filter] = dashboard_id
+        self.save(name, entry)
+
+  def forget(self, name):
+    """Removes entry `name`."""
+    if os.path.exists(self.path(name)):
+      os.remove(self.path(name))
+
+
+def get_context_cache(args) -> ClusterContextCache | None:
+  """Returns the cluster context cache, or None if it is disabled.
+
+  Dry runs do not use the cache, so they print every setup command.
+
+  Args:
+    args: user provided arguments for running the command.
+
+  Returns:
+    ClusterContextCache or None.
+  """
+  global _context_cache
+  ttl_seconds = getattr(
+      args, 'context_cache_ttl', default_context_cache_ttl_seconds
+  )
+  if ttl_seconds <= 0 or getattr(args, 'dry_run', False):
+    return None
+  with _context_cache_lock:
+    if _context_cache is None:
+      _context_cache = ClusterContextCache(cluster_context_dir, ttl_seconds)
+  return _context_cache
+
+
+def get_gcloud_config_fingerprint() -> str:
+  """Returns a string that changes whenever the gcloud defaults may change.
+
+  It combines the active gcloud configuration, the modification time of its
+  file and the environment variables that override it.
+  """
+  config_dir = os.environ.get('CLOUDSDK_CONFIG') or os.path.join(
+      os.path.expanduser('~'), '.config', 'gcloud'
+  )
+  name = os.environ.get('CLOUDSDK_ACTIVE_CONFIG_NAME')
+  if not name:
+    try:
+      with open(
+          os.path.join(config_dir, 'active_config'), 'r', encoding='utf-8'
+      ) as f:
+        name = f.read().strip()
+    except OSError:
+      name = 'default'
+  try:
+    mtime = os.stat(
+        os.path.join(config_dir, 'configurations', f'config_{name}')
+    ).st_mtime_ns
+  except OSError:
+    mtime = 0
+  return ':'.join([
+      name,
+      str(mtime),
+      os.environ.get('CLOUDSDK_CORE_PROJECT', ''),
+      os.environ.get('CLOUDSDK_COMPUTE_ZONE', ''),
+  ])
+
+
+def add_zone_and_project(args):
+  """Obtains the zone and project names from gcloud configs if not defined.
+
+  The gcloud defaults are cached until the gcloud configuration changes.
+
+  Args:
+    args: user provided arguments for running the command.
+  """
+  if not args.project or not args.zone:
+    cache = get_context_cache(args)
+    fingerprint = get_gcloud_config_fingerprint()
+    defaults = cache.load('gcloud-defaults') if cache else None
+    if defaults is None or defaults.get('fingerprint') != fingerprint:
+      defaults = {'fingerprint': fingerprint}
+    resolved = dict(defaults)
+    if not args.project:
+      args.project = resolved['project'] = (
+          defaults.get('project') or get_project()
+      )
+    if not args.zone:
+      args.zone = resolved['zone'] = defaults.get('zone') or get_zone()
+    if cache is not None and resolved != defaults:
+      cache.save('gcloud-defaults', resolved)
+  xpk_print(f'Working on {args.project=} and {args.zone}')
+
+
+def add_env_config(args):
+  """Adds environment configurations to the jobset config.
+
+  Args:
+    args: user provided arguments for running the command.
+  """
+  env = {}
+  if args.env_file:
     print('Setting container environment from', args.env_file)
     pat = re.compile(r'(^[a-zA-Z_][a-zA-Z0-9_]*?)(?:=(.*))$', re.M)
     with open(file=args.env_file, mode='r', encoding='utf-8') as f:
@@ -864,137 +2393,2039 @@ def add_env_config(args):
           )
           env[variable] = os.environ[variable]
 
-  if args.debug_dump_gcs:
-    if 'XLA_FLAGS' in env:
-      raise ValueError('Conflict: XLA_FLAGS defined in both --debug_dump_gcs '
-                       'and environment file. Please choose one way to define '
-                       'XLA_FLAGS.')
-    env['XLA_FLAGS'] = '--xla_dump_to=/tmp/xla_dump/'
+  if args.debug_dump_gcs:
+    if 'XLA_FLAGS' in env:
+      raise ValueError('Conflict: XLA_FLAGS defined in both --debug_dump_gcs '
+                       'and environment file. Please choose one way to define '
+                       'XLA_FLAGS.')
+    env['XLA_FLAGS'] = '--xla_dump_to=/tmp/xla_dump/'
+
+  args.env = [{'name': key, 'value': value} for key, value in env.items()]
+
+
+def write_temporary_file(payload):
+  """Writes `payload` to a temporary file in the run log directory.
+
+  Args:
+    payload: The string to be written to the file.
+
+  Returns:
+    A file object that was written to.
+  """
+  with tempfile.NamedTemporaryFile(delete=False, dir=get_run_log_dir()) as tmp:
+    with open(file=tmp.name, mode='w', encoding='utf=8') as f:
+      f.write(payload)
+      f.flush()
+    return tmp
+
+
+def get_command_env(global_args) -> dict[str, str] | None:
+  """Returns the environment of the commands run for `global_args`.
+
+  Commands inherit the environment of xpk, with KUBECONFIG pointing at the
+  private kubeconfig of the cluster once `set_cluster_command` fetched it.
+  The environment is built for each command instead of changing the one of
+  xpk, which steps on other threads may be reading to start their commands.
+
+  Args:
+    global_args: user provided arguments for running the command.
+
+  Returns:
+    The environment, or None to inherit the one of xpk unchanged.
+  """
+  kubeconfig = getattr(global_args, 'kubeconfig', None)
+  if kubeconfig is None:
+    return None
+  return os.environ | {'KUBECONFIG': kubeconfig}
+
+
+class ToolSemaphore:
+  """Semaphore shared by the event loops of all the threads of xpk.
+
+  asyncio semaphores belong to one event loop, while steps of a step graph
+  each run their own. Waiters are queued in order and woken through their own
+  loop, so waiting never blocks a thread.
+  """
+
+  def __init__(self, value):
+    self.value = value
+    self.lock = threading.Lock()
+    self.waiters = collections.deque()
+
+  async def __aenter__(self):
+    with self.lock:
+      if self.value > 0 and not self.waiters:
+        self.value -= 1
+        return self
+      loop = asyncio.get_running_loop()
+      waiter = loop.create_future()
+      self.waiters.append((loop, waiter))
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      with self.lock:
+        if (loop, waiter) in self.waiters:
+          self.waiters.remove((loop, waiter))
+        else:
+          # The permit was already handed over, pass it on.
+          self.release_locked()
+      raise
+    return self
+
+  async def __aexit__(self, *exc_info):
+    with self.lock:
+      self.release_locked()
+
+  def release_locked(self):
+    """Hands a permit to the next waiter or returns it, holding the lock."""
+    while self.waiters:
+      loop, waiter = self.waiters.popleft()
+      try:
+        loop.call_soon_threadsafe(
+            lambda w: w.done() or w.set_result(None), waiter
+        )
+      except RuntimeError:
+        # Its loop is closed.
+        continue
+      return
+    self.value += 1
+
+
+def get_command_tool(command) -> str:
+  """Returns the name of the tool that a command line runs.
+
+  Variable assignments and words like `cd` or `env` that only prepare the
+  command are skipped, as are commands chained before the tool with `&&`,
+  `||` or `;`, e.g. `cd dir && docker build .` runs `docker`.
+
+  Args:
+    command: command line to execute.
+
+  Returns:
+    The base name of the tool, or '' if there is none.
+  """
+  lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+  lexer.whitespace_split = True
+  try:
+    words = list(lexer)
+  except ValueError:
+    words = command.split()
+  skip_segment = False
+  for word in words:
+    if word in ('&&', '||', ';', '&', '|'):
+      skip_segment = False
+    elif skip_segment or re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*=.*', word):
+      continue
+    elif word in command_prefix_words:
+      # `cd` and `export` take the rest of their segment, `env` and `exec`
+      # are followed by the tool.
+      skip_segment = word not in ('command', 'env', 'exec')
+    elif not word.startswith('-'):
+      return os.path.basename(word)
+  return ''
+
+
+def get_tool_semaphore(command) -> ToolSemaphore:
+  """Returns the semaphore limiting concurrent commands of the same tool.
+
+  Args:
+    command: command that is about to be executed.
+
+  Returns:
+    The semaphore shared by all commands running the same tool, from any
+    thread.
+  """
+  tool = get_command_tool(command)
+  with _tool_semaphores_lock:
+    if tool not in _tool_semaphores:
+      _tool_semaphores[tool] = ToolSemaphore(
+          max_concurrent_commands_per_tool.get(
+              tool, default_max_concurrent_commands_per_tool
+          )
+      )
+    return _tool_semaphores[tool]
+
+
+def get_command_argv(command) -> list[str] | None:
+  """Returns the argv of `command` if it can run without a shell.
+
+  Args:
+    command: command line to execute.
+
+  Returns:
+    The arguments of the command, or None if it uses pipes, redirections,
+    variables, globs or any other shell syntax outside of quotes.
+  """
+  quote = None
+  for char in command:
+    if quote == "'":
+      if char == "'":
+        quote = None
+    elif quote == '"':
+      if char in '$`\\':
+        return None
+      if char == '"':
+        quote = None
+    elif char in '\'"':
+      quote = char
+    elif char in shell_special_chars:
+      return None
+  try:
+    argv = shlex.split(command)
+  except ValueError:
+    return None
+  # Leading variable assignments are shell syntax too.
+  if not argv or '=' in argv[0]:
+    return None
+  return argv
+
+
+async def start_command_async(command, **kwargs):
+  """Starts `command`, without a shell unless it needs one.
+
+  Executing the argv directly saves a `/bin/sh` process per command.
+
+  Args:
+    command: command line to execute.
+    **kwargs: passed on to asyncio's subprocess functions, e.g. `stdout`.
+
+  Returns:
+    The asyncio subprocess.
+  """
+  profile_count(spawns=1)
+  argv = get_command_argv(command)
+  child = None
+  if argv is not None:
+    try:
+      child = await asyncio.create_subprocess_exec(*argv, **kwargs)
+    except OSError:
+      # Let the shell report missing or non executable tools as usual.
+      pass
+  if child is None:
+    child = await asyncio.create_subprocess_shell(command, **kwargs)
+  with _running_commands_lock:
+    _running_commands.difference_update(
+        [c for c in _running_commands if c.returncode is not None]
+    )
+    _running_commands.add(child)
+  return child
+
+
+def terminate_running_commands() -> int:
+  """Sends SIGTERM to the commands started by xpk that are still running.
+
+  Processes are signalled by pid, which is safe from any thread whatever event
+  loop started them. Shells are terminated but not the commands they started.
+
+  Returns:
+    The number of commands terminated.
+  """
+  with _running_commands_lock:
+    children = [c for c in _running_commands if c.returncode is None]
+    _running_commands.clear()
+  for child in children:
+    try:
+      os.kill(child.pid, signal.SIGTERM)
+    except ProcessLookupError:
+      pass
+  return len(children)
+
+
+def run_concurrently(*coroutines) -> list:
+  """Runs coroutines concurrently from synchronous code.
+
+  Args:
+    *coroutines: coroutines to run. None entries are skipped and yield None,
+      which keeps conditional lookups easy to express.
+
+  Returns:
+    The results of the coroutines, in the order they were given.
+  """
+
+  async def none():
+    return None
+
+  async def gather():
+    return await asyncio.gather(
+        *[none() if c is None else c for c in coroutines]
+    )
+
+  return asyncio.run(gather())
+
+
+async def run_command_async(
+    command, task, global_args, dry_run_return_val='0', stream_output=False
+) -> CommandResult:
+  """Runs the command and returns its structured result.
+
+  This is the core used by all the `run_command_*` helpers. Commands are
+  throttled per tool (see `max_concurrent_commands_per_tool`), so independent
+  lookups can be overlapped with `asyncio.gather` or `run_concurrently`.
+
+  Args:
+    command: command to execute.
+    task: user-facing name of the task.
+    global_args: user provided arguments for running the command.
+    dry_run_return_val: stdout of this command for dry run.
+    stream_output: forwards the output to the terminal instead of capturing it.
+
+  Returns:
+    CommandResult with the exit code, output and duration of the command.
+  """
+  if global_args.dry_run:
+    xpk_print(
+        f'Task: `{task}` is implemented by the following command'
+        ' not running since it is a dry run.'
+        f' \n{command}'
+    )
+    now = time.perf_counter()
+    trace_span(task, 'command', now, now, command=command, dry_run=True)
+    return CommandResult(task, command, 0, stdout=dry_run_return_val)
+
+  queued_time = time.perf_counter()
+  async with get_tool_semaphore(command):
+    start_time = time.perf_counter()
+    env = get_command_env(global_args)
+    if stream_output:
+      return_code = await stream_command_with_updates_async(
+          command, task, env=env
+      )
+      stdout, stderr = '', ''
+    else:
+      child = await start_command_async(
+          command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env
+      )
+      stdout_bytes, stderr_bytes = await child.communicate()
+      profile_count(pipe_bytes=len(stdout_bytes) + len(stderr_bytes))
+      return_code = child.returncode
+      stdout = stdout_bytes.decode('utf-8', errors='replace')
+      stderr = stderr_bytes.decode('utf-8', errors='replace')
+    trace_span(
+        task,
+        'command',
+        start_time,
+        command=command,
+        exit_code=return_code,
+        queued_seconds=round(start_time - queued_time, 6),
+    )
+    return CommandResult(
+        task,
+        command,
+        return_code,
+        stdout,
+        stderr,
+        time.perf_counter() - start_time,
+    )
+
+
+async def run_command_for_value_async(
+    command, task, global_args, dry_run_return_val='0'
+) -> tuple[int, str]:
+  """Runs the command and returns the error code and stdout.
+
+  Prints errors and associated user-facing information
+
+  Args:
+    command: user provided command to run.
+    task: user provided task name for running the command.
+    global_args: user provided arguments for running the command.
+    dry_run_return_val: return value of this command for dry run.
+
+  Returns:
+    tuple[int, str]
+    int: return_code, default is 0
+    str: return_val, default is '0'. On failure this also holds stderr.
+  """
+  if not global_args.dry_run:
+    xpk_print(
+        f'Task: `{task}` is implemented by `{command}`, hiding output unless'
+        ' there is an error.'
+    )
+  result = await run_command_async(
+      command, task, global_args, dry_run_return_val
+  )
+  if result.return_code != 0:
+    xpk_print(f'Task {task} failed with {result.return_code}')
+    xpk_print('*' * 80)
+    xpk_print(result.stdout + result.stderr)
+    xpk_print('*' * 80)
+    return result.return_code, result.stdout + result.stderr
+  return 0, result.stdout
+
+
+def run_command_for_value(
+    command, task, global_args, dry_run_return_val='0'
+) -> tuple[int, str]:
+  """Synchronous wrapper around `run_command_for_value_async`.
+
+  Args:
+    command: user provided command to run.
+    task: user provided task name for running the command.
+    global_args: user provided arguments for running the command.
+    dry_run_return_val: return value of this command for dry run.
+
+  Returns:
+    tuple[int, str]
+    int: return_code, default is 0
+    str: return_val, default is '0'
+  """
+  return asyncio.run(
+      run_command_for_value_async(
+          command, task, global_args, dry_run_return_val
+      )
+  )
+
+
+async def stream_command_with_updates_async(command, task, env=None) -> int:
+  """Runs `command` with live output, printing a heartbeat while it runs.
+
+  The child's exit is awaited directly rather than polled, so the return
+  happens as soon as the process terminates.
+
+  Args:
+    command: command to execute
+    task: user-facing name of the task
+    env: environment of the command, inherited from xpk if None.
+
+  Returns:
+    The return code of the command.
+  """
+  child = await start_command_async(
+      command, stdout=sys.stdout, stderr=sys.stderr, env=env
+  )
+  waiter = asyncio.ensure_future(child.wait())
+  i = 0
+  while True:
+    wait_start = time.perf_counter()
+    done, _ = await asyncio.wait({waiter}, timeout=progress_interval_seconds)
+    if done:
+      return waiter.result()
+    profile_count(poll_sleep_seconds=time.perf_counter() - wait_start)
+    i += progress_interval_seconds
+    xpk_print(f'Waiting for `{task}`, for {i} seconds')
+
+
+async def run_command_with_updates_async(
+    command, task, global_args, verbose=True
+) -> int:
+  """Generic run commands function with updates.
+
+  Args:
+    command: command to execute
+    task: user-facing name of the task
+    global_args: user provided arguments for running the command.
+    verbose: shows stdout and stderr if set to true. Set to True by default.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  if global_args.dry_run:
+    result = await run_command_async(command, task, global_args)
+    return result.return_code
+  if verbose:
+    xpk_print(
+        f'Task: `{task}` is implemented by `{command}`, streaming output live.'
+    )
+    result = await run_command_async(
+        command, task, global_args, stream_output=True
+    )
+    xpk_print(f'Task: `{task}` terminated with code `{result.return_code}`')
+    return result.return_code
+
+  xpk_print(
+      f'Task: `{task}` is implemented by `{command}`, hiding output unless'
+      ' there is an error.'
+  )
+  result = await run_command_async(command, task, global_args)
+  if result.return_code != 0:
+    xpk_print(
+        f'Task: `{task}` terminated with ERROR `{result.return_code}`,'
+        ' printing logs'
+    )
+    xpk_print('*' * 80)
+    xpk_print(result.stdout + result.stderr)
+    xpk_print('*' * 80)
+    return result.return_code
+  xpk_print(f'Task: `{task}` succeeded.')
+  return 0
+
+
+def run_command_with_updates(command, task, global_args, verbose=True) -> int:
+  """Synchronous wrapper around `run_command_with_updates_async`.
+
+  Args:
+    command: command to execute
+    task: user-facing name of the task
+    global_args: user provided arguments for running the command.
+    verbose: shows stdout and stderr if set to true. Set to True by default.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  return asyncio.run(
+      run_command_with_updates_async(command, task, global_args, verbose)
+  )
+
+
+@dataclass
+class KubernetesResource:
+  """Location of a kind of object in the Kubernetes API."""
+  group: str
+  version: str
+  plural: str
+  namespaced: bool = True
+
+  def path(self, namespace=None, name=None) -> str:
+    """Returns the API path of a collection, or of one object if `name`."""
+    if self.group:
+      path = f'/apis/{self.group}/{self.version}'
+    else:
+      path = f'/api/{self.version}'
+    if self.namespaced:
+      path += f'/namespaces/{urllib.parse.quote(namespace or "default")}'
+    path += f'/{self.plural}'
+    if name:
+      path += f'/{urllib.parse.quote(name)}'
+    return path
+
+
+# Kinds of objects the native Kubernetes client works with.
+kubernetes_resources = {
+    'JobSet': KubernetesResource('jobset.x-k8s.io', 'v1alpha2', 'jobsets'),
+    'Workload': KubernetesResource('kueue.x-k8s.io', 'v1beta1', 'workloads'),
+    'ConfigMap': KubernetesResource('', 'v1', 'configmaps'),
+    'DaemonSet': KubernetesResource('apps', 'v1', 'daemonsets'),
+    'Deployment': KubernetesResource('apps', 'v1', 'deployments'),
+    'Service': KubernetesResource('', 'v1', 'services'),
+    'Node': KubernetesResource('', 'v1', 'nodes', namespaced=False),
+    'Pod': KubernetesResource('', 'v1', 'pods'),
+}
+
+
+class KubernetesApiError(Exception):
+  """Error returned by the Kubernetes API, or failure to reach it."""
+
+  def __init__(self, status, reason, message):
+    super().__init__(f'{status} {reason}: {message}')
+    self.status = status
+    self.reason = reason
+    self.message = message
+
+
+def serialize_manifests(manifests) -> str:
+  """Serializes manifests built as Python objects into one YAML stream.
+
+  Every document is written as JSON, which is also YAML, so that strings are
+  always escaped, whatever they contain.
+
+  Args:
+    manifests: dict of one object, or list of dicts.
+
+  Returns:
+    The documents separated by `---`.
+  """
+  if isinstance(manifests, dict):
+    manifests = [manifests]
+  return '---\n'.join(
+      json.dumps(manifest, indent=2) + '\n' for manifest in manifests
+  )
+
+
+class ManifestTemplate:
+  """A manifest serialized once, whose string fields are filled in per render.
+
+  Fields are marked in the manifest with `ManifestTemplate.field(name)` as
+  whole string values. Rendering only joins the serialized parts with the
+  JSON encoded values, so thousands of variants of a manifest cost little
+  more than their size.
+  """
+
+  def __init__(self, manifests):
+    self.parts = re.split(
+        r'"\\u0000(\w+)\\u0000"', serialize_manifests(manifests)
+    )
+
+  @staticmethod
+  def field(name) -> str:
+    """Returns the placeholder of the field `name`."""
+    return f'\0{name}\0'
+
+  def render(self, **values) -> str:
+    """Returns the serialized manifests with the fields set to `values`."""
+    parts = self.parts.copy()
+    parts[1::2] = [json.dumps(values[name]) for name in self.parts[1::2]]
+    return ''.join(parts)
+
+
+def get_manifest_errors(manifest, path='') -> list[str]:
+  """Validates a manifest built as Python objects before it is submitted.
+
+  Checks the fields that the API server would otherwise reject one at a
+  time: the identity and labels of the object, the type of its integer
+  fields, and the names, images, environment variables, ports and volume
+  mounts of every pod template.
+
+  Args:
+    manifest: dict of one object.
+    path: path of the object in error messages, its kind by default.
+
+  Returns:
+    List of errors, empty if the manifest is valid.
+  """
+  errors = []
+  path = path or str(manifest.get('kind', ''))
+
+  def check_name(value, where, pattern, max_length):
+    if not isinstance(value, str) or not value:
+      errors.append(f'{where}: required string is missing.')
+    elif len(value) > max_length or not re.fullmatch(pattern, value):
+      errors.append(
+          f'{where}: `{value}` must be at most {max_length} characters and'
+          f' match `{pattern}`.'
+      )
+
+  def check_values(value, where):
+    if isinstance(value, dict):
+      for key, item in value.items():
+        if not isinstance(key, str):
+          errors.append(f'{where}: key {key!r} is not a string.')
+        elif key in kubernetes_integer_fields and (
+            not isinstance(item, int) or isinstance(item, bool)
+        ):
+          errors.append(f'{where}.{key}: {item!r} is not an integer.')
+        check_values(item, f'{where}.{key}')
+    elif isinstance(value, list):
+      for i, item in enumerate(value):
+        check_values(item, f'{where}[{i}]')
+    elif isinstance(value, str):
+      if '\0' in value:
+        errors.append(f'{where}: string contains a NUL character.')
+    elif value is not None and not isinstance(value, (bool, int, float)):
+      errors.append(f'{where}: {type(value).__name__} is not a JSON value.')
+
+  def check_pod_spec(spec, where):
+    volumes = {volume.get('name') for volume in spec.get('volumes') or []}
+    container_names = set()
+    for kind in ('initContainers', 'containers'):
+      for i, container in enumerate(spec.get(kind) or []):
+        container_path = f'{where}.{kind}[{i}]'
+        check_name(
+            container.get('name'),
+            f'{container_path}.name',
+            kubernetes_container_name_pattern,
+            63,
+        )
+        if container.get('name') in container_names:
+          errors.append(
+              f'{container_path}.name: `{container.get("name")}` is used by'
+              ' another container.'
+          )
+        container_names.add(container.get('name'))
+        if not isinstance(container.get('image'), str) or not container.get(
+            'image'
+        ):
+          errors.append(f'{container_path}.image: required string is missing.')
+        for j, env in enumerate(container.get('env') or []):
+          env_path = f'{container_path}.env[{j}]'
+          check_name(env.get('name'), f'{env_path}.name', env_var_pattern, 4096)
+          if ('value' in env) == ('valueFrom' in env):
+            errors.append(f'{env_path}: exactly one of value and valueFrom.')
+          elif 'value' in env and not isinstance(env['value'], str):
+            errors.append(f'{env_path}.value: {env["value"]!r} is not a string.')
+        for j, port in enumerate(container.get('ports') or []):
+          container_port = port.get('containerPort')
+          if not isinstance(container_port, int) or not (
+              0 < container_port < 65536
+          ):
+            errors.append(
+                f'{container_path}.ports[{j}].containerPort:'
+                f' {container_port!r} is not a port number.'
+            )
+        for j, mount in enumerate(container.get('volumeMounts') or []):
+          if mount.get('name') not in volumes:
+            errors.append(
+                f'{container_path}.volumeMounts[{j}].name:'
+                f' `{mount.get("name")}` is not a volume of the pod.'
+            )
+
+  def check_object(value, where):
+    if isinstance(value, dict):
+      if isinstance(value.get('containers'), list):
+        check_pod_spec(value, where)
+      for key, item in value.items():
+        check_object(item, f'{where}.{key}')
+    elif isinstance(value, list):
+      for i, item in enumerate(value):
+        check_object(item, f'{where}[{i}]')
+
+  check_values(manifest, path)
+  for field in ('apiVersion', 'kind'):
+    if not isinstance(manifest.get(field), str) or not manifest.get(field):
+      errors.append(f'{path}.{field}: required string is missing.')
+  metadata = manifest.get('metadata') or {}
+  check_name(
+      metadata.get('name'),
+      f'{path}.metadata.name',
+      kubernetes_name_pattern,
+      253,
+  )
+  for key, value in (metadata.get('labels') or {}).items():
+    if not isinstance(value, str) or len(value) > 63 or not re.fullmatch(
+        kubernetes_label_value_pattern, value
+    ):
+      errors.append(
+          f'{path}.metadata.labels.{key}: `{value}` is not a label value.'
+      )
+  check_object(manifest.get('spec'), f'{path}.spec')
+  return errors
+
+
+def split_manifests(manifests) -> list:
+  """Splits a multi-document YAML string into its non-empty documents.
+
+  Args:
+    manifests: YAML string, or a dict for a single object.
+
+  Returns:
+    List of YAML strings or dicts.
+  """
+  if isinstance(manifests, dict):
+    return [manifests]
+  return [
+      doc
+      for doc in re.split(r'^---[ \t]*$', manifests, flags=re.MULTILINE)
+      if re.search(r'^[^\s#]', doc, flags=re.MULTILINE)
+  ]
+
+
+def get_manifest_identity(manifest) -> tuple[str, str, str, str | None]:
+  """Returns the apiVersion, kind, name and namespace of a manifest.
+
+  YAML manifests are only scanned for these fields, the API server parses
+  the full document.
+
+  Args:
+    manifest: single YAML document or dict.
+
+  Returns:
+    Tuple of apiVersion, kind, name and namespace (None if not set).
+
+  Raises:
+    ValueError: if a field other than the namespace is missing.
+  """
+  if isinstance(manifest, str) and manifest.lstrip().startswith('{'):
+    # Documents written by `serialize_manifests`.
+    manifest = json.loads(manifest)
+  if isinstance(manifest, dict):
+    metadata = manifest.get('metadata', {})
+    fields = {
+        'apiVersion': manifest.get('apiVersion'),
+        'kind': manifest.get('kind'),
+        'name': metadata.get('name'),
+        'namespace': metadata.get('namespace'),
+    }
+  else:
+    fields = {}
+    metadata_indent = None
+    in_metadata = False
+    for line in manifest.splitlines():
+      match = re.match(r'^(\s*)([A-Za-z]+):\s*(.*?)\s*(#.*)?$', line)
+      if not match:
+        continue
+      indent, key, value = len(match.group(1)), match.group(2), match.group(3)
+      value = value.strip('"\'')
+      if indent == 0:
+        in_metadata = key == 'metadata'
+        metadata_indent = None
+        if key in ('apiVersion', 'kind'):
+          fields[key] = value
+      elif in_metadata:
+        if metadata_indent is None:
+          metadata_indent = indent
+        if indent == metadata_indent and key in ('name', 'namespace'):
+          fields[key] = value
+  for field_name in ('apiVersion', 'kind', 'name'):
+    if not fields.get(field_name):
+      raise ValueError(f'Manifest has no {field_name}.')
+  return (
+      fields['apiVersion'],
+      fields['kind'],
+      fields['name'],
+      fields.get('namespace') or None,
+  )
+
+
+def get_json_path(obj, path):
+  """Returns the value at a kubectl custom-columns path like `.a.b[0].c`.
+
+  Args:
+    obj: Kubernetes object as a dict.
+    path: path of the value, supporting keys and (negative) list indices.
+
+  Returns:
+    The value, or `<none>` if it is missing, like kubectl.
+  """
+  value = obj
+  for key, index in re.findall(r'\.([^.\[]+)|\[(-?\d+)\]', path):
+    try:
+      value = value[key] if key else value[int(index)]
+    except (KeyError, IndexError, TypeError):
+      return '<none>'
+  return '<none>' if value is None else value
+
+
+def format_custom_columns(columns, objects) -> str:
+  """Formats objects like `kubectl get -o=custom-columns=...`.
+
+  Args:
+    columns: dict of column header to get_json_path path.
+    objects: list of Kubernetes objects.
+
+  Returns:
+    The table, with a header line.
+  """
+  rows = [list(columns)] + [
+      [str(get_json_path(obj, path)) for path in columns.values()]
+      for obj in objects
+  ]
+  widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+  return '\n'.join(
+      '   '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+      for row in rows
+  )
+
+
+class KubernetesClient:
+  """Minimal Kubernetes API client over one keep-alive HTTP(S) connection.
+
+  Requests of all threads share the connection, one at a time, so a whole
+  xpk run authenticates and opens a TLS session only once. Watches use a
+  connection of their own since they keep it busy.
+  """
+
+  def __init__(
+      self,
+      server,
+      ssl_context=None,
+      token_provider=None,
+      namespace='default',
+      timeout=kubernetes_api_timeout_seconds,
+  ):
+    url = urllib.parse.urlsplit(server)
+    self.server = server
+    self.scheme = url.scheme
+    self.host = url.hostname
+    self.port = url.port
+    self.base_path = url.path.rstrip('/')
+    self.ssl_context = ssl_context
+    self.token_provider = token_provider
+    self.namespace = namespace
+    self.timeout = timeout
+    self.connection = None
+    self.lock = threading.Lock()
+
+  @classmethod
+  def from_kubeconfig(cls, kubeconfig) -> 'KubernetesClient':
+    """Creates a client for the current context of a flattened kubeconfig.
+
+    Supports bearer tokens, client certificates, exec credential plugins such
+    as gke-gcloud-auth-plugin, and access tokens of the legacy gcp
+    auth-provider.
+
+    Args:
+      kubeconfig: output of `kubectl config view --minify --flatten -o json`.
+
+    Returns:
+      KubernetesClient.
+    """
+
+    def named(section, name):
+      for entry in kubeconfig.get(section) or []:
+        if entry.get('name') == name:
+          return entry
+      return {}
+
+    context_name = kubeconfig.get('current-context')
+    context = named('contexts', context_name).get('context', {})
+    cluster = named('clusters', context.get('cluster')).get('cluster', {})
+    user = named('users', context.get('user')).get('user', {})
+    if not cluster.get('server'):
+      raise KubernetesApiError(
+          0, 'InvalidKubeconfig', f'No server for context {context_name}.'
+      )
+
+    ssl_context = None
+    if cluster['server'].startswith('https'):
+      ssl_context = ssl.create_default_context()
+      if cluster.get('insecure-skip-tls-verify'):
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+      elif cluster.get('certificate-authority-data'):
+        ssl_context.load_verify_locations(
+            cadata=base64.b64decode(
+                cluster['certificate-authority-data']
+            ).decode()
+        )
+      elif cluster.get('certificate-authority'):
+        ssl_context.load_verify_locations(cafile=cluster['certificate-authority'])
+
+    def static_token(token):
+      return lambda refresh=False: token
+
+    token_provider = None
+    client_certificate = (
+        user.get('client-certificate-data'),
+        user.get('client-key-data'),
+    )
+    if user.get('token'):
+      token_provider = static_token(user['token'])
+    elif user.get('exec'):
+      token_provider = ExecCredentialProvider(user['exec'])
+    elif user.get('auth-provider', {}).get('config', {}).get('access-token'):
+      token_provider = static_token(
+          user['auth-provider']['config']['access-token']
+      )
+    if ssl_context is not None and all(client_certificate):
+      cert_file = write_temporary_file(
+          base64.b64decode(client_certificate[0]).decode()
+      )
+      try:
+        key_file = write_temporary_file(
+            base64.b64decode(client_certificate[1]).decode()
+        )
+        try:
+          ssl_context.load_cert_chain(cert_file.name, key_file.name)
+        finally:
+          # Never leave the private key on disk, even if it does not load.
+          os.remove(key_file.name)
+      finally:
+        os.remove(cert_file.name)
+    return cls(
+        cluster['server'],
+        ssl_context=ssl_context,
+        token_provider=token_provider,
+        namespace=context.get('namespace') or 'default',
+    )
+
+  def new_connection(self, timeout=None) -> http.client.HTTPConnection:
+    """Opens a new connection to the API server."""
+    if self.scheme == 'https':
+      return http.client.HTTPSConnection(
+          self.host,
+          self.port,
+          timeout=timeout or self.timeout,
+          context=self.ssl_context,
+      )
+    return http.client.HTTPConnection(
+        self.host, self.port, timeout=timeout or self.timeout
+    )
+
+  def headers(self, refresh_token=False) -> dict[str, str]:
+    """Returns the headers sent with every request."""
+    headers = {'Accept': 'application/json', 'User-Agent': 'xpk'}
+    if self.token_provider is not None:
+      headers['Authorization'] = (
+          f'Bearer {self.token_provider(refresh=refresh_token)}'
+      )
+    return headers
+
+  def request(
+      self,
+      method,
+      path,
+      params=None,
+      body=None,
+      content_type='application/json',
+  ) -> dict:
+    """Sends a request on the shared connection and returns the JSON reply.
+
+    A connection closed by the server is reopened once, and an expired token
+    is refreshed once.
+
+    Args:
+      method: HTTP method.
+      path: API path, e.g. `/api/v1/namespaces/default/pods`.
+      params: query parameters.
+      body: dict sent as JSON, or string sent as is.
+      content_type: content type of `body`.
+
+    Returns:
+      The decoded JSON reply.
+
+    Raises:
+      KubernetesApiError: if the request failed.
+    """
+    url = self.base_path + path
+    if params:
+      url += '?' + urllib.parse.urlencode(params)
+    payload = None
+    if body is not None:
+      payload = (json.dumps(body) if isinstance(body, dict) else body).encode()
+    start_time = time.perf_counter()
+    refresh_token = False
+    with self.lock:
+      for attempt in range(3):
+        headers = self.headers(refresh_token)
+        if payload is not None:
+          headers['Content-Type'] = content_type
+        if self.connection is None:
+          self.connection = self.new_connection()
+        try:
+          self.connection.request(method, url, body=payload, headers=headers)
+          response = self.connection.getresponse()
+          data = response.read()
+        except (http.client.HTTPException, OSError) as e:
+          self.connection.close()
+          self.connection = None
+          if attempt > 0:
+            raise KubernetesApiError(0, 'ConnectionError', str(e)) from e
+          continue
+        if (
+            response.status == 401
+            and not refresh_token
+            and isinstance(self.token_provider, ExecCredentialProvider)
+        ):
+          refresh_token = True
+          continue
+        break
+    trace_span(
+        f'{method} {path}',
+        'api',
+        start_time,
+        status=response.status,
+        server=self.server,
+    )
+    if response.status >= 400:
+      try:
+        status = json.loads(data)
+        reason, message = status.get('reason', ''), status.get('message', '')
+      except ValueError:
+        reason, message = response.reason, data.decode(errors='replace')
+      raise KubernetesApiError(response.status, reason, message)
+    return json.loads(data) if data else {}
+
+  def resource(self, kind) -> KubernetesResource:
+    """Returns the KubernetesResource of `kind`."""
+    if kind not in kubernetes_resources:
+      raise KubernetesApiError(
+          0, 'UnsupportedKind', f'{kind} is not supported by the xpk client.'
+      )
+    return kubernetes_resources[kind]
+
+  def get(
+      self, kind, name, namespace=None, ignore_not_found=False
+  ) -> dict | None:
+    """Returns one object, or None if it is missing and `ignore_not_found`."""
+    try:
+      return self.request(
+          'GET', self.resource(kind).path(namespace or self.namespace, name)
+      )
+    except KubernetesApiError as e:
+      if not (ignore_not_found and e.status == 404):
+        raise
+      return None
+
+  def list(
+      self,
+      kind,
+      namespace=None,
+      label_selector=None,
+      field_selector=None,
+      limit=kubernetes_list_page_size,
+  ) -> list[dict]:
+    """Returns all the objects of a kind, fetching them page by page."""
+    params = {'limit': limit}
+    if label_selector:
+      params['labelSelector'] = label_selector
+    if field_selector:
+      params['fieldSelector'] = field_selector
+    path = self.resource(kind).path(namespace or self.namespace)
+    items = []
+    while True:
+      reply = self.request('GET', path, params)
+      items.extend(reply.get('items') or [])
+      params['continue'] = reply.get('metadata', {}).get('continue')
+      if not params['continue']:
+        return items
+
+  def apply(self, manifest, force=True) -> dict:
+    """Server-side applies one object, taking ownership of its fields.
+
+    Args:
+      manifest: YAML document or dict of the object.
+      force: takes over the fields last set by other field managers, as
+        `kubectl apply` overwrites them. Otherwise such conflicts fail with
+        a 409 Conflict error.
+
+    Returns:
+      The object as stored by the API server.
+    """
+    api_version, kind, name, namespace = get_manifest_identity(manifest)
+    group, _, version = api_version.rpartition('/')
+    resource = self.resource(kind)
+    # The version of the manifest wins over the one xpk reads with.
+    resource = KubernetesResource(
+        group, version, resource.plural, resource.namespaced
+    )
+    return self.request(
+        'PATCH',
+        resource.path(namespace or self.namespace, name),
+        params={
+            'fieldManager': kubernetes_field_manager,
+            'force': 'true' if force else 'false',
+        },
+        body=manifest,
+        content_type='application/apply-patch+yaml',
+    )
+
+  def delete(self, kind, name, namespace=None, ignore_not_found=False):
+    """Deletes one object and, in the background, the objects it owns."""
+    try:
+      self.request(
+          'DELETE',
+          self.resource(kind).path(namespace or self.namespace, name),
+          params={'propagationPolicy': 'Background'},
+      )
+    except KubernetesApiError as e:
+      if not (ignore_not_found and e.status == 404):
+        raise
+
+  def watch(
+      self,
+      kind,
+      namespace=None,
+      label_selector=None,
+      resource_version=None,
+      timeout_seconds=300,
+  ):
+    """Yields (event type, object) for changes of the objects of a kind.
+
+    The watch runs on a connection of its own and ends after
+    `timeout_seconds`, or when the server closes it.
+    """
+    params = {'watch': 'true', 'timeoutSeconds': timeout_seconds}
+    if label_selector:
+      params['labelSelector'] = label_selector
+    if resource_version:
+      params['resourceVersion'] = resource_version
+    url = (
+        self.base_path
+        + self.resource(kind).path(namespace or self.namespace)
+        + '?'
+        + urllib.parse.urlencode(params)
+    )
+    connection = self.new_connection(timeout=timeout_seconds + 30)
+    try:
+      connection.request('GET', url, headers=self.headers())
+      response = connection.getresponse()
+      if response.status >= 400:
+        raise KubernetesApiError(
+            response.status,
+            response.reason,
+            response.read().decode(errors='replace'),
+        )
+      while True:
+        line = response.readline()
+        if not line:
+          return
+        if line.strip():
+          event = json.loads(line)
+          yield event.get('type'), event.get('object', {})
+    finally:
+      connection.close()
 
-  env_format = '''
-                - name: {key}
-                  value: "{value}"'''
-  args.env = ''.join(env_format.format(key=k, value=v) for k, v in env.items())
 
+class ExecCredentialProvider:
+  """Bearer tokens of a kubeconfig exec plugin, like gke-gcloud-auth-plugin.
 
-def write_temporary_file(payload):
-  """Writes `payload` to a temporary file.
+  The plugin runs once and its token is reused until shortly before it
+  expires.
+  """
+
+  def __init__(self, exec_config):
+    self.exec_config = exec_config
+    self.token = None
+    self.expires_at = None
+    self.lock = threading.Lock()
+
+  def __call__(self, refresh=False) -> str:
+    with self.lock:
+      if (
+          refresh
+          or self.token is None
+          or (self.expires_at is not None and time.time() > self.expires_at)
+      ):
+        self.run_plugin()
+      return self.token
+
+  def run_plugin(self):
+    """Runs the plugin and stores the token it returns."""
+    env = dict(os.environ)
+    for entry in self.exec_config.get('env') or []:
+      env[entry['name']] = entry['value']
+    env['KUBERNETES_EXEC_INFO'] = json.dumps({
+        'apiVersion': self.exec_config.get(
+            'apiVersion', 'client.authentication.k8s.io/v1beta1'
+        ),
+        'kind': 'ExecCredential',
+        'spec': {'interactive': False},
+    })
+    argv = [self.exec_config['command'], *(self.exec_config.get('args') or [])]
+    start_time = time.perf_counter()
+    completed_command = subprocess.run(
+        argv, env=env, capture_output=True, check=False
+    )
+    profile_count(spawns=1, pipe_bytes=len(completed_command.stdout))
+    trace_span(
+        'Get Kubernetes Credentials',
+        'command',
+        start_time,
+        command=shlex.join(argv),
+        exit_code=completed_command.returncode,
+    )
+    if completed_command.returncode != 0:
+      raise KubernetesApiError(
+          0,
+          'CredentialPluginFailed',
+          completed_command.stderr.decode(errors='replace'),
+      )
+    status = json.loads(completed_command.stdout).get('status', {})
+    self.token = status.get('token')
+    self.expires_at = None
+    if status.get('expirationTimestamp'):
+      expiry = datetime.datetime.fromisoformat(
+          status['expirationTimestamp'].replace('Z', '+00:00')
+      )
+      # Refresh a minute early so that requests never race the expiry.
+      self.expires_at = expiry.timestamp() - 60
+
+
+def use_native_kubernetes_client(args) -> bool:
+  """Returns True if Kubernetes calls go through KubernetesClient.
+
+  Dry runs always print the equivalent kubectl commands.
+  """
+  return getattr(args, 'kube_client', 'kubectl') == 'native' and not getattr(
+      args, 'dry_run', False
+  )
+
+
+def get_kubernetes_client(args) -> KubernetesClient:
+  """Returns the client of this xpk run, created on first use.
+
+  The client is built from the current kubectl context, so it must be
+  created after `set_cluster_command`.
 
   Args:
-    payload: The string to be written to the file.
+    args: user provided arguments for running the command.
 
   Returns:
-    A file object that was written to.
+    KubernetesClient.
   """
-  with tempfile.NamedTemporaryFile(delete=False) as tmp:
-    with open(file=tmp.name, mode='w', encoding='utf=8') as f:
-      f.write(payload)
-      f.flush()
-    return tmp
-
+  global _kubernetes_client
+  with _kubernetes_client_lock:
+    if _kubernetes_client is None:
+      start_time = time.perf_counter()
+      command = ['kubectl', 'config', 'view', '--minify', '--flatten', '-o', 'json']
+      completed_command = subprocess.run(
+          command, env=get_command_env(args), capture_output=True, check=False
+      )
+      profile_count(spawns=1, pipe_bytes=len(completed_command.stdout))
+      trace_span(
+          'Read Kubeconfig',
+          'command',
+          start_time,
+          command=shlex.join(command),
+          exit_code=completed_command.returncode,
+      )
+      if completed_command.returncode != 0:
+        raise KubernetesApiError(
+            0,
+            'InvalidKubeconfig',
+            completed_command.stderr.decode(errors='replace'),
+        )
+      _kubernetes_client = KubernetesClient.from_kubeconfig(
+          json.loads(completed_command.stdout)
+      )
+      xpk_print(
+          'Using the native Kubernetes client with API server'
+          f' {_kubernetes_client.server}'
+      )
+  return _kubernetes_client
 
-def run_command_for_value(
-    command, task, global_args, dry_run_return_val='0'
-) -> tuple[int, str]:
-  """Runs the command and returns the error code and stdout.
 
-  Prints errors and associated user-facing information
+async def kubernetes_call_async(task, args, method, *method_args, **kwargs):
+  """Calls a KubernetesClient method on a worker thread.
 
   Args:
-    command: user provided command to run.
-    task: user provided task name for running the command.
-    global_args: user provided arguments for running the command.
-    dry_run_return_val: return value of this command for dry run.
+    task: user-facing name of the task.
+    args: user provided arguments for running the command.
+    method: name of the KubernetesClient method, e.g. `list`.
+    *method_args: positional arguments of the method.
+    **kwargs: keyword arguments of the method.
 
   Returns:
-    tuple[int, str]
-    int: return_code, default is 0
-    str: return_val, default is '0'
+    A tuple of 0 and the result of the method if successful, or the error
+    code and None otherwise.
   """
-  if global_args.dry_run:
+  try:
+    if method == 'apply':
+      _, kind, name, _ = get_manifest_identity(method_args[0])
+      target = f'{kind} {name}'
+    else:
+      target = ' '.join(str(arg) for arg in method_args if arg)
     xpk_print(
-        f'Task: `{task}` is implemented by the following command'
-        ' not running since it is a dry run.'
-        f' \n{command}'
+        f'Task: `{task}` is implemented by the Kubernetes API ({method}'
+        f' {target}).'
     )
-    return 0, dry_run_return_val
-  else:
+    client = await asyncio.to_thread(get_kubernetes_client, args)
+    result = await asyncio.to_thread(
+        getattr(client, method), *method_args, **kwargs
+    )
+  except (KubernetesApiError, ValueError) as e:
+    xpk_print(f'Task {task} failed: {e}')
+    return 1, None
+  except (OSError, http.client.HTTPException) as e:
+    # Also a missing kubectl (FileNotFoundError) and TLS failures
+    # (ssl.SSLError) while reading the kubeconfig or calling the API server.
     xpk_print(
-        f'Task: `{task}` is implemented by `{command}`, hiding output unless'
-        ' there is an error.'
+        f'Task {task} failed, the native Kubernetes client could not read'
+        f' the kubeconfig or reach the API server: {e!r}. Rerun with'
+        ' `--kube-client=kubectl` to go through kubectl instead.'
     )
-    try:
-      output = subprocess.check_output(
-          command,
-          shell=True,
-          stderr=subprocess.STDOUT,
-      )
-    except subprocess.CalledProcessError as e:
-      xpk_print(f'Task {task} failed with {e.returncode}')
-      xpk_print('*' * 80)
-      xpk_print(e.output)
-      xpk_print('*' * 80)
-      return e.returncode, str(e.output, 'UTF-8')
-    return 0, str(output, 'UTF-8')
+    return 1, None
+  return 0, result
 
 
-def run_command_with_updates(command, task, global_args, verbose=True) -> int:
-  """Generic run commands function with updates.
+async def apply_manifests_async(manifests, task, args) -> int:
+  """Applies YAML manifests, with kubectl or the native client.
 
   Args:
-    command: command to execute
-    task: user-facing name of the task
-    global_args: user provided arguments for running the command.
-    verbose: shows stdout and stderr if set to true. Set to True by default.
+    manifests: YAML string, possibly with several documents.
+    task: user-facing name of the task.
+    args: user provided arguments for running the command.
 
   Returns:
     0 if successful and 1 otherwise.
   """
-  if global_args.dry_run:
-    xpk_print(
-        f'Task: `{task}` is implemented by the following command'
-        ' not running since it is a dry run.'
-        f' \n{command}'
+  if not use_native_kubernetes_client(args):
+    tmp = write_temporary_file(manifests)
+    command = f'kubectl apply -f {str(tmp.file.name)}'
+    return await run_command_with_updates_async(command, task, args)
+  for manifest in split_manifests(manifests):
+    return_code, _ = await kubernetes_call_async(task, args, 'apply', manifest)
+    if return_code != 0:
+      return return_code
+  xpk_print(f'Task: `{task}` succeeded.')
+  return 0
+
+
+def apply_manifests(manifests, task, args) -> int:
+  """Synchronous wrapper around `apply_manifests_async`."""
+  return asyncio.run(apply_manifests_async(manifests, task, args))
+
+
+async def delete_manifests_async(
+    manifests, task, args, ignore_not_found=False
+) -> int:
+  """Deletes the objects of YAML manifests, with kubectl or the native client.
+
+  Args:
+    manifests: YAML string, possibly with several documents.
+    task: user-facing name of the task.
+    args: user provided arguments for running the command.
+    ignore_not_found: treats objects that do not exist as deleted.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  if not use_native_kubernetes_client(args):
+    tmp = write_temporary_file(manifests)
+    command = f'kubectl delete -f {str(tmp.file.name)}'
+    if ignore_not_found:
+      command += ' --ignore-not-found=true'
+    return await run_command_with_updates_async(command, task, args)
+  for manifest in split_manifests(manifests):
+    try:
+      _, kind, name, namespace = get_manifest_identity(manifest)
+    except ValueError as e:
+      xpk_print(f'Task {task} failed: {e}')
+      return 1
+    return_code, _ = await kubernetes_call_async(
+        task,
+        args,
+        'delete',
+        kind,
+        name,
+        namespace,
+        ignore_not_found=ignore_not_found,
     )
-    return 0
-  if verbose:
-    xpk_print(
-        f'Task: `{task}` is implemented by `{command}`, streaming output live.'
+    if return_code != 0:
+      return return_code
+  xpk_print(f'Task: `{task}` succeeded.')
+  return 0
+
+
+def delete_manifests(manifests, task, args, ignore_not_found=False) -> int:
+  """Synchronous wrapper around `delete_manifests_async`."""
+  return asyncio.run(
+      delete_manifests_async(manifests, task, args, ignore_not_found)
+  )
+
+
+class GcpApiError(Exception):
+  """Error returned by a Google Cloud API, or failure to reach it."""
+
+  def __init__(self, status, reason, message):
+    super().__init__(f'{status} {reason}: {message}')
+    self.status = status
+    self.reason = reason
+    self.message = message
+
+
+# Failures of GcpRestClient calls besides GcpApiError: a missing gcloud for
+# the access token (FileNotFoundError), connection and TLS errors of the pooled
+# connections, and replies that are not the JSON expected.
+gcp_client_errors = (OSError, http.client.HTTPException, ValueError, KeyError)
+
+
+class GcloudAccessTokenProvider:
+  """Access tokens of the active gcloud account.
+
+  `gcloud auth print-access-token` runs once and its token is reused until an
+  API rejects it.
+  """
+
+  def __init__(self):
+    self.token = None
+    self.lock = threading.Lock()
+
+  def __call__(self, refresh=False) -> str:
+    with self.lock:
+      if refresh or self.token is None:
+        self.print_access_token()
+      return self.token
+
+  def print_access_token(self):
+    """Runs gcloud and stores the token it prints."""
+    argv = ['gcloud', 'auth', 'print-access-token']
+    start_time = time.perf_counter()
+    completed_command = subprocess.run(argv, capture_output=True, check=False)
+    profile_count(spawns=1, pipe_bytes=len(completed_command.stdout))
+    trace_span(
+        'Get Access Token',
+        'command',
+        start_time,
+        command=shlex.join(argv),
+        exit_code=completed_command.returncode,
     )
-    with subprocess.Popen(
-        command,
-        stdout=sys.stdout,
-        stderr=sys.stderr,
-        shell=True,
-    ) as child:
-      i = 0
-      while True:
-        return_code = child.poll()
-        if return_code is None:
-          xpk_print(f'Waiting for `{task}`, for {i} seconds')
-          time.sleep(1)
-          i += 1
-        else:
-          xpk_print(f'Task: `{task}` terminated with code `{return_code}`')
-          return return_code
-  else:
+    if completed_command.returncode != 0:
+      raise GcpApiError(
+          0,
+          'AccessTokenFailed',
+          completed_command.stderr.decode(errors='replace'),
+      )
+    self.token = completed_command.stdout.decode().strip()
+
+
+class GcpRestClient:
+  """Client of the GKE, Compute Engine and Cloud Monitoring REST APIs.
+
+  Idle keep-alive connections are pooled per API host and shared by all
+  threads, so concurrent requests only open a TLS session when every pooled
+  connection is busy. `endpoint` replaces the host of all the APIs, e.g. with
+  a local stand-in server.
+  """
+
+  def __init__(
+      self,
+      token_provider=None,
+      endpoint=None,
+      timeout=gcp_api_timeout_seconds,
+  ):
+    self.endpoints = {
+        service: (endpoint or url).rstrip('/')
+        for service, url in gcp_api_endpoints.items()
+    }
+    self.token_provider = token_provider
+    self.timeout = timeout
+    self.ssl_context = ssl.create_default_context()
+    self.idle_connections = collections.defaultdict(list)
+    self.lock = threading.Lock()
+
+  def new_connection(self, endpoint) -> http.client.HTTPConnection:
+    """Opens a new connection to an API host."""
+    url = urllib.parse.urlsplit(endpoint)
+    if url.scheme == 'https':
+      return http.client.HTTPSConnection(
+          url.hostname, url.port, timeout=self.timeout, context=self.ssl_context
+      )
+    return http.client.HTTPConnection(
+        url.hostname, url.port, timeout=self.timeout
+    )
+
+  def request(self, service, method, path, params=None, body=None) -> dict:
+    """Sends a request on a pooled connection and returns the JSON reply.
+
+    A pooled connection closed by the server is replaced once, and an expired
+    token is refreshed once.
+
+    Args:
+      service: `container`, `compute` or `monitoring`.
+      method: HTTP method.
+      path: API path, e.g. `/v1/projects/p/locations/l/clusters`.
+      params: query parameters.
+      body: dict sent as JSON.
+
+    Returns:
+      The decoded JSON reply.
+
+    Raises:
+      GcpApiError: if the request failed.
+    """
+    endpoint = self.endpoints[service]
+    url = urllib.parse.urlsplit(endpoint).path + path
+    if params:
+      url += '?' + urllib.parse.urlencode(params)
+    payload = None if body is None else json.dumps(body).encode()
+    start_time = time.perf_counter()
+    refresh_token = False
+    for attempt in range(3):
+      headers = {'Accept': 'application/json', 'User-Agent': 'xpk'}
+      if payload is not None:
+        headers['Content-Type'] = 'application/json'
+      if self.token_provider is not None:
+        headers['Authorization'] = (
+            f'Bearer {self.token_provider(refresh=refresh_token)}'
+        )
+      with self.lock:
+        idle = self.idle_connections[endpoint]
+        connection = idle.pop() if idle else None
+      pooled = connection is not None
+      if connection is None:
+        connection = self.new_connection(endpoint)
+      try:
+        connection.request(method, url, body=payload, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+      except (http.client.HTTPException, OSError) as e:
+        connection.close()
+        if not pooled or attempt > 0:
+          raise GcpApiError(0, 'ConnectionError', str(e)) from e
+        continue
+      with self.lock:
+        self.idle_connections[endpoint].append(connection)
+      if (
+          response.status == 401
+          and not refresh_token
+          and self.token_provider is not None
+      ):
+        refresh_token = True
+        continue
+      break
+    trace_span(
+        f'{method} {path}',
+        'api',
+        start_time,
+        status=response.status,
+        service=service,
+    )
+    if response.status >= 400:
+      try:
+        error = json.loads(data)['error']
+        reason, message = error.get('status', ''), error.get('message', '')
+      except (ValueError, KeyError, TypeError):
+        reason, message = response.reason, data.decode(errors='replace')
+      raise GcpApiError(response.status, reason, message)
+    return json.loads(data) if data else {}
+
+  def list_pages(self, service, path, items_key) -> list:
+    """Returns the items of a paginated list."""
+    params = {}
+    items = []
+    while True:
+      reply = self.request(service, 'GET', path, params)
+      items.extend(reply.get(items_key) or [])
+      params['pageToken'] = reply.get('nextPageToken')
+      if not params['pageToken']:
+        return items
+
+  def list_clusters(self, project, location) -> list[dict]:
+    """Returns the GKE clusters of a location."""
+    return self.request(
+        'container',
+        'GET',
+        f'/v1/projects/{project}/locations/{location}/clusters',
+    ).get('clusters') or []
+
+  def list_node_pools(self, project, location, cluster) -> list[dict]:
+    """Returns the node pools of a GKE cluster."""
+    return self.request(
+        'container',
+        'GET',
+        f'/v1/projects/{project}/locations/{location}/clusters/{cluster}'
+        '/nodePools',
+    ).get('nodePools') or []
+
+  def create_node_pool(self, project, location, cluster, node_pool) -> dict:
+    """Starts creating a node pool and returns the GKE operation."""
+    return self.request(
+        'container',
+        'POST',
+        f'/v1/projects/{project}/locations/{location}/clusters/{cluster}'
+        '/nodePools',
+        body={'nodePool': node_pool},
+    )
+
+  def delete_node_pool(self, project, location, cluster, node_pool) -> dict:
+    """Starts deleting a node pool and returns the GKE operation."""
+    return self.request(
+        'container',
+        'DELETE',
+        f'/v1/projects/{project}/locations/{location}/clusters/{cluster}'
+        f'/nodePools/{node_pool}',
+    )
+
+  def list_operations(self, project, location) -> list[dict]:
+    """Returns all the GKE operations of a location."""
+    return self.request(
+        'container',
+        'GET',
+        f'/v1/projects/{project}/locations/{location}/operations',
+    ).get('operations') or []
+
+  def get_reservation(self, project, zone, reservation) -> dict:
+    """Returns a Compute Engine reservation."""
+    return self.request(
+        'compute',
+        'GET',
+        f'/compute/v1/projects/{project}/zones/{zone}/reservations/'
+        f'{reservation}',
+    )
+
+  def list_reservations(self, project) -> list[dict]:
+    """Returns the Compute Engine reservations of all the zones."""
+    scopes = self.list_pages(
+        'compute',
+        f'/compute/v1/projects/{project}/aggregated/reservations',
+        'items',
+    )
+    return [
+        reservation
+        for scope in scopes
+        for reservation in scope.get('reservations') or []
+    ]
+
+  def list_dashboards(self, project) -> list[dict]:
+    """Returns the Cloud Monitoring dashboards of a project."""
+    return self.list_pages(
+        'monitoring', f'/v1/projects/{project}/dashboards', 'dashboards'
+    )
+
+
+def use_gcp_rest_client(args) -> bool:
+  """Returns True if Google Cloud calls go through GcpRestClient.
+
+  Dry runs always print the equivalent gcloud commands.
+  """
+  return getattr(args, 'gcp_client', 'gcloud') == 'rest' and not getattr(
+      args, 'dry_run', False
+  )
+
+
+def get_gcp_client(args) -> GcpRestClient:
+  """Returns the REST client of this xpk run, created on first use.
+
+  Args:
+    args: user provided arguments for running the command.
+
+  Returns:
+    GcpRestClient.
+  """
+  global _gcp_client
+  with _gcp_client_lock:
+    if _gcp_client is None:
+      endpoint = getattr(args, 'gcp_api_endpoint', None)
+      _gcp_client = GcpRestClient(
+          token_provider=GcloudAccessTokenProvider(), endpoint=endpoint
+      )
+      xpk_print(
+          'Using the Google Cloud REST APIs'
+          + (f' at {endpoint}' if endpoint else '')
+      )
+  return _gcp_client
+
+
+async def gcp_call_async(task, args, method, *method_args):
+  """Calls a GcpRestClient method on a worker thread.
+
+  Args:
+    task: user-facing name of the task.
+    args: user provided arguments for running the command.
+    method: name of the GcpRestClient method, e.g. `list_clusters`.
+    *method_args: positional arguments of the method.
+
+  Returns:
+    A tuple of 0 and the result of the method if successful, or the error
+    code and None otherwise.
+  """
+  target = ' '.join(str(arg) for arg in method_args if isinstance(arg, str))
+  xpk_print(
+      f'Task: `{task}` is implemented by the Google Cloud REST API ({method}'
+      f' {target}).'
+  )
+  try:
+    client = get_gcp_client(args)
+    result = await asyncio.to_thread(getattr(client, method), *method_args)
+  except GcpApiError as e:
+    xpk_print(f'Task {task} failed: {e}')
+    return 1, None
+  except gcp_client_errors as e:
     xpk_print(
-        f'Task: `{task}` is implemented by `{command}`, hiding output unless'
-        ' there is an error.'
+        f'Task {task} failed, the Google Cloud REST API could not be called:'
+        f' {e!r}. Rerun with `--gcp-client=gcloud` to go through gcloud'
+        ' instead.'
     )
+    return 1, None
+  return 0, result
+
+
+@dataclass
+class NodePoolOperation:
+  """A node pool create or delete tracked by its GKE operation.
+
+  `command` submits it with gcloud and `body` is the NodePool of a create
+  through the GKE API. `operation` is the ID of the GKE operation of the
+  current attempt once submitted.
+  """
+  task: str
+  node_pool: str
+  method: str
+  command: str = ''
+  body: dict | None = None
+  operation: str | None = None
+
+
+def get_operation_error(operation) -> str | None:
+  """Returns the error of a finished GKE operation, or None if it succeeded."""
+  error = operation.get('error')
+  if not error:
+    return None
+  return f'{error.get("code", "")} {error.get("message", "")}'.strip()
+
+
+def run_node_pool_operations(
+    args,
+    operations,
+    jobname,
+    *,
+    use_rest=False,
+    retry_policy=None,
+    concurrency_limit=None,
+) -> int:
+  """Runs node pool operations, tracking them by their GKE operation ID.
+
+  Args:
+    args: user provided arguments for running the command.
+    operations: list of NodePoolOperation.
+    jobname: the name of the job.
+    use_rest: submits and lists the operations through GcpRestClient instead
+      of gcloud.
+    retry_policy: RetryPolicy for failed operations. No retries if None.
+    concurrency_limit: AdaptiveConcurrencyLimit of the operations in flight.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  return asyncio.run(
+      run_node_pool_operations_async(
+          args,
+          operations,
+          jobname,
+          use_rest=use_rest,
+          retry_policy=retry_policy,
+          concurrency_limit=concurrency_limit,
+      )
+  )
+
+
+async def run_node_pool_operations_async(
+    args,
+    operations,
+    jobname,
+    *,
+    use_rest=False,
+    retry_policy=None,
+    concurrency_limit=None,
+) -> int:
+  """Coroutine behind `run_node_pool_operations`.
+
+  Operations are submitted without waiting for them, through the GKE API or
+  with `gcloud --async`. Every
+  `args.node_pool_poll_interval` seconds, one list of the operations of the
+  cluster location updates all of them, whatever their number. gcloud only
+  lists the operations in flight, the GKE API has no filter so the client
+  lists all the operations of the location. The run fails once
+  `args.node_pool_timeout` seconds passed, or when an operation is missing
+  from `max_missing_operation_polls` lists in a row. At most
+  `concurrency_limit.limit` operations are in flight, and the retries,
+  backoffs and limit follow the rules of `run_command_batch_async`. GKE
+  operations cannot be cancelled, so after a permanent failure the operations
+  in flight are left to finish and no new ones are submitted.
+
+  Args:
+    args: user provided arguments for running the command.
+    operations: list of NodePoolOperation.
+    jobname: the name of the job.
+    use_rest: submits and lists the operations through GcpRestClient instead
+      of gcloud.
+    retry_policy: RetryPolicy for failed operations. No retries if None.
+    concurrency_limit: AdaptiveConcurrencyLimit of the operations in flight.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  client = get_gcp_client(args) if use_rest else None
+  project, location = args.project, zone_to_region(args.zone)
+  total = len(operations)
+  if retry_policy is None:
+    retry_policy = RetryPolicy()
+  if concurrency_limit is None:
+    concurrency_limit = AdaptiveConcurrencyLimit(max(total, 1))
+  xpk_print(
+      f'Submitting a total of {total} node pool operations with an adaptive'
+      f' parallelism of {concurrency_limit.limit} (between'
+      f' {concurrency_limit.minimum} and {concurrency_limit.maximum})'
+  )
+
+  pending = collections.deque(range(total))
+  # Heap of (monotonic time the retry is due, operation index).
+  retries = []
+  running = set()
+  dispatch_epochs = [0] * total
+  attempt_starts = [0.0] * total
+  timings = [CommandTiming(operation.task) for operation in operations]
+  # Consecutive lists that did not show the current attempt of an operation.
+  missing_polls = [0] * total
+  failure = None
+  start_time = datetime.datetime.now()
+  deadline = time.monotonic() + args.node_pool_timeout
+
+  async def submit(operation) -> tuple[str | None, str | None]:
+    """Submits an operation, returning its GKE operation ID or the error."""
+    if not use_rest:
+      result = await run_command_async(operation.command, operation.task, args)
+      operation_id = result.stdout.strip()
+      if result.return_code != 0 or not operation_id:
+        return None, result.stdout + result.stderr
+      return operation_id.splitlines()[-1], None
     try:
-      subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
+      if operation.method == 'create':
+        reply = await asyncio.to_thread(
+            client.create_node_pool,
+            project,
+            location,
+            args.cluster,
+            operation.body,
+        )
+      else:
+        reply = await asyncio.to_thread(
+            client.delete_node_pool,
+            project,
+            location,
+            args.cluster,
+            operation.node_pool,
+        )
+      operation_id = reply['name']
+    except GcpApiError as e:
+      return None, str(e)
+    except gcp_client_errors as e:
+      return None, repr(e)
+    return operation_id, None
+
+  async def list_operations(ids) -> tuple[dict | None, str | None]:
+    """Returns GKE operations by ID, at least those of `ids`, or the error."""
+    if use_rest:
+      try:
+        listed = await asyncio.to_thread(
+            client.list_operations, project, location
+        )
+      except GcpApiError as e:
+        return None, str(e)
+      except gcp_client_errors as e:
+        return None, repr(e)
+    else:
+      names = ' '.join(ids)
+      result = await run_command_async(
+          f'gcloud container operations list --project={project}'
+          f' --region={location} --filter="name=({names})" --format=json',
+          'List Node Pool Operations',
+          args,
+      )
+      if result.return_code != 0:
+        return None, result.stdout + result.stderr
+      try:
+        listed = json.loads(result.stdout or '[]')
+      except ValueError as e:
+        return None, f'Cannot parse the operations: {e}'
+    return {
+        operation['name'].split('/')[-1]: operation
+        for operation in listed
+        if isinstance(operation, dict) and operation.get('name')
+    }, None
+
+  def finish_attempt(i, error):
+    """Records the end of an attempt, re-queueing it if it is retried."""
+    nonlocal failure
+    trace_span(
+        operations[i].task,
+        'operation',
+        attempt_starts[i],
+        task=jobname,
+        operation=operations[i].operation or '',
+        attempt=timings[i].attempts,
+        error=error or '',
+    )
+    if error is None:
+      concurrency_limit.on_success()
+    elif concurrency_limit.is_congestion(error) and (
+        concurrency_limit.on_congestion(dispatch_epochs[i])
+    ):
       xpk_print(
-          f'Task: `{task}` terminated with ERROR `{e.returncode}`, printing'
-          ' logs'
+          f'{jobname} is being throttled, lowering parallelism to'
+          f' {concurrency_limit.limit}'
+      )
+    if (
+        error is not None
+        and timings[i].attempts < retry_policy.max_attempts
+        and retry_policy.is_retryable(error)
+    ):
+      backoff = retry_policy.backoff_seconds(timings[i].attempts)
+      xpk_print(
+          f'Task {operations[i].task} failed with a transient error on'
+          f' attempt {timings[i].attempts}/{retry_policy.max_attempts},'
+          f' retrying in {backoff:.1f}s: {error.strip()}'
+      )
+      heapq.heappush(retries, (time.monotonic() + backoff, i))
+      return
+    timings[i].end = (datetime.datetime.now() - start_time).total_seconds()
+    timings[i].return_code = 0 if error is None else 1
+    if error is not None and failure is None:
+      failure = (operations[i].task, error)
+
+  def count_finished(method) -> tuple[int, int]:
+    """Returns how many operations of `method` succeeded, and their total."""
+    indexes = [i for i, op in enumerate(operations) if op.method == method]
+    return (
+        sum(1 for i in indexes if timings[i].return_code == 0),
+        len(indexes),
+    )
+
+  while True:
+    submitted = []
+    while failure is None and len(running) + len(submitted) < (
+        concurrency_limit.limit
+    ):
+      if retries and retries[0][0] <= time.monotonic():
+        i = heapq.heappop(retries)[1]
+      elif pending:
+        i = pending.popleft()
+      else:
+        break
+      if timings[i].start is None:
+        timings[i].start = (
+            datetime.datetime.now() - start_time
+        ).total_seconds()
+      timings[i].attempts += 1
+      dispatch_epochs[i] = concurrency_limit.epoch
+      attempt_starts[i] = time.perf_counter()
+      operations[i].operation = None
+      missing_polls[i] = 0
+      submitted.append(i)
+    replies = await asyncio.gather(
+        *(submit(operations[i]) for i in submitted)
+    )
+    for i, (operation_id, error) in zip(submitted, replies):
+      if error is not None:
+        finish_attempt(i, error)
+      else:
+        operations[i].operation = operation_id
+        running.add(i)
+
+    if failure is None and (running or retries):
+      timeout = (
+          args.node_pool_poll_interval if running else progress_interval_seconds
+      )
+      if retries:
+        timeout = max(0, min(timeout, retries[0][0] - time.monotonic()))
+      sleep_start = time.perf_counter()
+      await asyncio.sleep(timeout)
+      profile_count(poll_sleep_seconds=time.perf_counter() - sleep_start)
+    if failure is None and running:
+      listed, error = await list_operations(
+          sorted(operations[i].operation for i in running)
+      )
+      if error is not None and not retry_policy.is_retryable(error):
+        failure = ('List Node Pool Operations', error)
+      for i in sorted(running) if listed is not None else []:
+        operation = listed.get(operations[i].operation)
+        if operation is None:
+          # Operations may take a few lists to show up in them.
+          missing_polls[i] += 1
+          if missing_polls[i] >= max_missing_operation_polls:
+            running.discard(i)
+            finish_attempt(
+                i,
+                f'Operation {operations[i].operation} was not listed by GKE'
+                f' in {missing_polls[i]} polls.',
+            )
+          continue
+        missing_polls[i] = 0
+        if operation.get('status') == 'DONE':
+          running.discard(i)
+          finish_attempt(i, get_operation_error(operation))
+    if (
+        failure is None
+        and (running or pending or retries)
+        and time.monotonic() > deadline
+    ):
+      failure = (
+          jobname,
+          f'Timed out after {args.node_pool_timeout:g}s with'
+          f' {len(running) + len(pending) + len(retries)} operations not'
+          ' done.',
       )
-      xpk_print('*' * 80)
-      xpk_print(e.output)
-      xpk_print('*' * 80)
-      return e.returncode
-    xpk_print(f'Task: `{task}` succeeded.')
-    return 0
+
+    seconds_elapsed = (datetime.datetime.now() - start_time).total_seconds()
+    ready, creates = count_finished('create')
+    deleted, deletes = count_finished('delete')
+    progress = []
+    if creates:
+      progress.append(f'{ready} of {creates} pools ready')
+    if deletes:
+      progress.append(f'{deleted} of {deletes} pools deleted')
+    retry_str = f', waiting to retry {len(retries)}' if retries else ''
+    xpk_print(
+        f'[t={seconds_elapsed:.2f}, {jobname}] {", ".join(progress)},'
+        f' {len(running)} operations running (limit'
+        f' {concurrency_limit.limit}){retry_str}'
+    )
+    if failure is not None:
+      task, error = failure
+      xpk_print(f'Stopping {jobname} since at least one operation failed.')
+      xpk_print(f'Failure is {task}: {error.strip()}')
+      if running:
+        xpk_print(
+            f'{len(running)} operations already submitted to GKE keep running:'
+            f' {", ".join(operations[j].operation for j in sorted(running))}'
+        )
+      break
+    if not running and not pending and not retries:
+      break
+
+  print_command_timings(jobname, timings)
+  xpk_print(f'{jobname} {concurrency_limit.summary()}')
+  return 0 if failure is None else 1
 
 
 def xpk_print(*args, **kwargs):
@@ -1004,9 +4435,11 @@ def xpk_print(*args, **kwargs):
     *args: user provided print args.
     **kwargs: user provided print args.
   """
-  sys.stdout.write('[XPK] ')
-  print(*args, **kwargs)
-  sys.stdout.flush()
+  # Steps may run on several threads, keep each message on its own line.
+  with _print_lock:
+    sys.stdout.write('[XPK] ')
+    print(*args, **kwargs)
+    sys.stdout.flush()
 
 
 def xpk_exit(error_code):
@@ -1015,6 +4448,10 @@ def xpk_exit(error_code):
   Args:
     error_code: If the code provided is zero, then no issues occurred.
   """
+  if _tracer is not None:
+    _tracer.save(error_code)
+  if _profiler is not None:
+    _profiler.print_summary(error_code)
   if error_code == 0:
     xpk_print('Exiting XPK cleanly')
     sys.exit(0)
@@ -1029,9 +4466,18 @@ def get_project():
   Returns:
      The project name.
   """
+  start_time = time.perf_counter()
   completed_command = subprocess.run(
       ['gcloud', 'config', 'get', 'project'], check=True, capture_output=True
   )
+  profile_count(spawns=1, pipe_bytes=len(completed_command.stdout))
+  trace_span(
+      'Get Project',
+      'command',
+      start_time,
+      command='gcloud config get project',
+      exit_code=completed_command.returncode,
+  )
   project_outputs = completed_command.stdout.decode().strip().split('\n')
   if len(project_outputs) < 1 or project_outputs[-1] == '':
     sys.exit(
@@ -1049,11 +4495,20 @@ def get_zone():
   Returns:
      The zone name.
   """
+  start_time = time.perf_counter()
   completed_command = subprocess.run(
       ['gcloud', 'config', 'get', 'compute/zone'],
       check=True,
       capture_output=True,
   )
+  profile_count(spawns=1, pipe_bytes=len(completed_command.stdout))
+  trace_span(
+      'Get Zone',
+      'command',
+      start_time,
+      command='gcloud config get compute/zone',
+      exit_code=completed_command.returncode,
+  )
   zone_outputs = completed_command.stdout.decode().strip().split('\n')
   if len(zone_outputs) < 1 or zone_outputs[-1] == '':
     sys.exit(
@@ -1131,10 +4586,7 @@ def create_cluster_configmap(args, system):
   data = f'{device_type}: "{int(args.num_slices) * system.vms_per_slice}"'
   yml_string = cluster_configmap_yaml.format(args=args,
                                            data=data)
-  tmp = write_temporary_file(yml_string)
-  command = f'kubectl apply -f {str(tmp.file.name)}'
-
-  return_code = run_command_with_updates(command, 'GKE Cluster Create ConfigMap', args)
+  return_code = apply_manifests(yml_string, 'GKE Cluster Create ConfigMap', args)
   if return_code != 0:
     xpk_print(f'GKE Cluster Create ConfigMap request returned ERROR {return_code}')
     return 1
@@ -1142,7 +4594,7 @@ def create_cluster_configmap(args, system):
   return 0
 
 
-def get_cluster_configmap(args):
+async def get_cluster_configmap_async(args):
   """Run the Get GKE Cluster ConfigMap request.
 
   Args:
@@ -1151,20 +4603,41 @@ def get_cluster_configmap(args):
   Returns:
     key:value pairs stored in cluster ConfigMap.
   """
+  if use_native_kubernetes_client(args):
+    return_code, config_map = await kubernetes_call_async(
+        'GKE Cluster Get ConfigMap',
+        args,
+        'get',
+        'ConfigMap',
+        f'{args.cluster}-resources-configmap',
+    )
+    if return_code != 0:
+      xpk_print(f'GKE Cluster Get ConfigMap request returned ERROR {return_code}')
+      return None
+    return {
+        key: int(value)
+        for key, value in (config_map.get('data') or {}).items()
+    }
+
   command = (
     f'kubectl get configmap {args.cluster}-resources-configmap -o=custom-columns="ConfigData:data" --no-headers=true'
   )
 
-  return_code, return_value = run_command_for_value(command, 'GKE Cluster Get ConfigMap', args)
+  return_code, return_value = await run_command_for_value_async(
+      command, 'GKE Cluster Get ConfigMap', args
+  )
   if return_code != 0:
     xpk_print(f'GKE Cluster Get ConfigMap request returned ERROR {return_code}')
     return None
+  if args.dry_run:
+    # There is no ConfigMap to parse, handle it like a cluster without one.
+    return None
 
   config_map = {}
   return_value = return_value.strip()
   if return_value:
     # Format of ConfigMap: map[key1:value1 key2:value2]
-    configs = return_value[4:-1].split(" ")
+    configs = return_value[4:-1].split()
     for config in configs:
       key, value = config.strip().split(":")
       config_map[key] = int(value)
@@ -1180,6 +4653,21 @@ def get_all_clusters_programmatic(args) -> tuple[list[str], int]:
   Returns:
     List of cluster names and 0 if successful and 1 otherwise.
   """
+  if use_gcp_rest_client(args):
+    return_code, clusters = asyncio.run(
+        gcp_call_async(
+            'Find if Cluster Exists',
+            args,
+            'list_clusters',
+            args.project,
+            zone_to_region(args.zone),
+        )
+    )
+    if return_code != 0:
+      xpk_print(f'Find if Cluster Exists returned ERROR {return_code}')
+      return [], return_code
+    return [cluster['name'] for cluster in clusters], 0
+
   command = (
       'gcloud container clusters list'
       f' --project={args.project} --region={zone_to_region(args.zone)}'
@@ -1206,7 +4694,9 @@ def create_cluster_if_necessary(args) -> int:
     return run_gke_cluster_create_command(args)
 
 
-def get_all_nodepools_programmatic(args) -> tuple[list[str], int]:
+async def get_all_nodepools_programmatic_async(
+    args,
+) -> tuple[list[str], int]:
   """Gets all the nodepools associated with the cluster / project / region.
 
   Args:
@@ -1215,13 +4705,27 @@ def get_all_nodepools_programmatic(args) -> tuple[list[str], int]:
   Returns:
     List of nodepools and 0 if successful and 1 otherwise.
   """
+  if use_gcp_rest_client(args):
+    return_code, node_pools = await gcp_call_async(
+        'Get All Node Pools',
+        args,
+        'list_node_pools',
+        args.project,
+        zone_to_region(args.zone),
+        args.cluster,
+    )
+    if return_code != 0:
+      xpk_print(f'Get All Node Pools returned ERROR {return_code}')
+      return [], 1
+    return [node_pool['name'] for node_pool in node_pools], 0
+
   command = (
       'gcloud beta container node-pools list'
       ' --cluster'
       f' {args.cluster} --project={args.project} --region={zone_to_region(args.zone)}'
   )
-  return_code, raw_nodepool_output = (
-      run_command_for_value(command, 'Get All Node Pools', args)
+  return_code, raw_nodepool_output = await run_command_for_value_async(
+      command, 'Get All Node Pools', args
   )
   if return_code != 0:
     xpk_print(f'Get All Node Pools returned ERROR {return_code}')
@@ -1231,7 +4735,7 @@ def get_all_nodepools_programmatic(args) -> tuple[list[str], int]:
   return all_nodepools, 0
 
 
-def print_reservations(args) -> int:
+async def print_reservations_async(args) -> int:
   """Print the reservations in the project.
 
   Args:
@@ -1240,20 +4744,39 @@ def print_reservations(args) -> int:
   Returns:
     0 if successful and 1 otherwise.
   """
-  command = (
-        f'gcloud beta compute reservations list --project={args.project}'
+  if use_gcp_rest_client(args):
+    return_code, reservations = await gcp_call_async(
+        'Get all reservations in the project',
+        args,
+        'list_reservations',
+        args.project,
+    )
+    if return_code == 0:
+      rows = [('NAME', 'IN_USE_COUNT', 'COUNT', 'ZONE')] + [
+          (
+              reservation['name'],
+              reservation.get('specificReservation', {}).get('inUseCount', '0'),
+              reservation.get('specificReservation', {}).get('count', '0'),
+              reservation.get('zone', '').split('/')[-1],
+          )
+          for reservation in reservations
+      ]
+      for row in rows:
+        xpk_print(f'{row[0]:<40} {row[1]:>12} {row[2]:>8}  {row[3]}')
+  else:
+    command = (
+          f'gcloud beta compute reservations list --project={args.project}'
+      )
+    return_code = await run_command_with_updates_async(
+        command, 'Get all reservations in the project', args
     )
-  return_code = (
-      run_command_with_updates(
-          command, 'Get all reservations in the project', args)
-  )
   if return_code != 0:
     xpk_print(f'Get all reservations returned ERROR {return_code}')
     return 1
   return 0
 
 
-def verify_reservation_exists(args) -> int:
+async def verify_reservation_exists_async(args) -> int:
   """Verify the reservation exists.
 
   Args:
@@ -1262,14 +4785,23 @@ def verify_reservation_exists(args) -> int:
   Returns:
     0 if successful and 1 otherwise.
   """
-  command = (
-        f'gcloud beta compute reservations describe {args.reservation}'
-        f' --project={args.project} --zone={args.zone}'
+  if use_gcp_rest_client(args):
+    return_code, _ = await gcp_call_async(
+        'Describe reservation',
+        args,
+        'get_reservation',
+        args.project,
+        args.zone,
+        args.reservation,
+    )
+  else:
+    command = (
+          f'gcloud beta compute reservations describe {args.reservation}'
+          f' --project={args.project} --zone={args.zone}'
+      )
+    return_code = await run_command_with_updates_async(
+        command, 'Describe reservation', args
     )
-  return_code = (
-      run_command_with_updates(
-          command, 'Describe reservation', args)
-  )
   if return_code != 0:
     xpk_print(f'Describe reservation returned ERROR {return_code}')
     xpk_print('Please confirm that your reservation name is correct.')
@@ -1277,7 +4809,7 @@ def verify_reservation_exists(args) -> int:
   return 0
 
 
-def get_capacity_arguments(args) -> tuple[str, int]:
+async def get_capacity_arguments_async(args) -> tuple[str, int]:
   """Determine the TPU Nodepool creation capacity arguments needed.
 
   Args:
@@ -1296,7 +4828,7 @@ def get_capacity_arguments(args) -> tuple[str, int]:
     capacity_args = ""
     num_types+=1
   if args.reservation:
-    return_code = verify_reservation_exists(args)
+    return_code = await verify_reservation_exists_async(args)
     if return_code > 0:
       return capacity_args, return_code
     capacity_args = (
@@ -1309,7 +4841,7 @@ def get_capacity_arguments(args) -> tuple[str, int]:
 
   # Check that the number of arguments provided is valid.
   if num_types == 0:
-    return_code = print_reservations(args)
+    return_code = await print_reservations_async(args)
     xpk_print(
       'ERROR: User needs to provide the capacity type. Please specify one of'
       ' the following `--reservation=$RESERVATION_NAME`, `--on-demand`'
@@ -1341,36 +4873,110 @@ def get_user_input(input_msg):
   return user_input in ('y', 'yes')
 
 
-def run_gke_node_pool_create_command(args, system) -> int:
-  """Run the Create GKE Node Pool request.
+def get_node_pool_body(args, system, node_pool_name) -> dict:
+  """Returns the GKE API NodePool of a `node-pools create` command.
 
   Args:
     args: user provided arguments for running the command.
     system: System characteristics based on TPU type/topology.
+    node_pool_name: name of the node pool.
 
   Returns:
-    0 if successful and 1 otherwise.
+    NodePool resource, see
+    https://cloud.google.com/kubernetes-engine/docs/reference/rest/v1/projects.locations.clusters.nodePools
+  """
+  config = {
+      'machineType': system.gce_machine_type,
+      'oauthScopes': list(node_pool_oauth_scopes),
+      'gvnic': {'enabled': True},
+      'hostMaintenancePolicy': {
+          'maintenanceInterval': args.host_maintenance_interval
+      },
+  }
+  if args.reservation:
+    config['reservationAffinity'] = {
+        'consumeReservationType': 'SPECIFIC_RESERVATION',
+        'key': 'compute.googleapis.com/reservation-name',
+        'values': [args.reservation],
+    }
+  elif args.spot:
+    config['spot'] = True
+  node_pool = {
+      'name': node_pool_name,
+      'version': args.gke_version,
+      'initialNodeCount': system.vms_per_slice,
+      'locations': [args.zone],
+      'config': config,
+      'maxPodsConstraint': {'maxPodsPerNode': '15'},
+  }
+  if system.accelerator_type == AcceleratorType['TPU']:
+    node_pool['placementPolicy'] = {
+        'type': 'COMPACT',
+        'tpuTopology': system.topology,
+    }
+  elif system.accelerator_type == AcceleratorType['GPU']:
+    node_pool['placementPolicy'] = {'type': 'COMPACT'}
+    config['accelerators'] = [{
+        'acceleratorType': system.gke_accelerator,
+        'acceleratorCount': str(system.chips_per_vm),
+    }]
+  return node_pool
+
+
+def plan_gke_node_pool_operations(
+    args, system
+) -> tuple[int, list[NodePoolOperation], bool]:
+  """Returns the node pool creates and deletes needed for `--num-slices`.
+
+  Asks for confirmation before deleting node pools, unless `--force` is set.
+
+  Args:
+    args: user provided arguments for running the command.
+    system: System characteristics based on TPU type/topology.
+
+  Returns:
+    Tuple of:
+      0 if successful and 1 otherwise.
+      List of NodePoolOperation.
+      True if the operations go through the GKE API instead of gcloud.
   """
   device_type = args.tpu_type if args.tpu_type else args.device_type
   xpk_print(
       f'Creating {args.num_slices} node pool or pools of {device_type}\n'
       f'Underlyingly, we assume that means: {system}'
   )
-  existing_node_pool_names, return_code = get_all_nodepools_programmatic(args)
+  # Listing node pools and checking the capacity are independent lookups.
+  (existing_node_pool_names, return_code), (
+      capacity_args,
+      capacity_return_code,
+  ) = run_concurrently(
+      get_all_nodepools_programmatic_async(args),
+      get_capacity_arguments_async(args),
+  )
   if return_code > 0:
     xpk_print('Listing all node pools failed!')
-    return return_code
+    return return_code, [], False
+  if capacity_return_code > 0:
+    xpk_print('Parsing capacity arguments failed!')
+    return capacity_return_code, [], False
   desired_node_pool_names = [
       f'{args.cluster}-np-{slice_num}' for slice_num in range(args.num_slices)
   ]
 
-  capacity_args, return_code = get_capacity_arguments(args)
-  if return_code > 0:
-    xpk_print('Parsing capacity arguments failed!')
-    return return_code
-
+  use_rest = use_gcp_rest_client(args)
+  if (
+      use_rest
+      and system.accelerator_type == AcceleratorType['TPU']
+      and args.custom_tpu_nodepool_arguments
+  ):
+    xpk_print(
+        'Creating node pools with gcloud since --custom-tpu-nodepool-arguments'
+        ' are gcloud flags.'
+    )
+    use_rest = False
   commands = []
   task_names = []
+  operations = []
   for node_pool_name in desired_node_pool_names:
     if node_pool_name in existing_node_pool_names:
       continue
@@ -1397,6 +5003,14 @@ def run_gke_node_pool_create_command(args, system) -> int:
     task = f'NodepoolCreate-{node_pool_name}'
     commands.append(command)
     task_names.append(task)
+    operations.append(
+        NodePoolOperation(
+            task,
+            node_pool_name,
+            'create',
+            body=get_node_pool_body(args, system, node_pool_name),
+        )
+    )
 
   node_pools_to_delete = []
   for existing_node_pool_name in existing_node_pool_names:
@@ -1429,12 +5043,69 @@ def run_gke_node_pool_create_command(args, system) -> int:
         task = f'Nodepool-Delete-{existing_node_pool_name}'
         commands.append(command)
         task_names.append(task)
+        operations.append(
+            NodePoolOperation(task, existing_node_pool_name, 'delete')
+        )
+
+  if args.node_pool_async and not use_rest:
+    # gcloud only submits the operation and prints its ID.
+    commands = [
+        f'{command} --async --format="value(name)"' for command in commands
+    ]
+  for operation, command in zip(operations, commands):
+    operation.command = command
 
   for i, command in enumerate(commands):
-    xpk_print(f'To complete {task_names[i]} we are executing {command}')
-  max_return_code = run_commands(
-      commands, 'Create and Delete Nodepools', task_names, dry_run=args.dry_run
+    if use_rest:
+      xpk_print(
+          f'To complete {task_names[i]} we are calling the GKE API to'
+          f' {operations[i].method} node pool {operations[i].node_pool}'
+      )
+    else:
+      xpk_print(f'To complete {task_names[i]} we are executing {command}')
+  return 0, operations, use_rest
+
+
+def run_gke_node_pool_create_command(args, operations, use_rest) -> int:
+  """Run the Create GKE Node Pool request.
+
+  Args:
+    args: user provided arguments for running the command.
+    operations: list of NodePoolOperation from
+      `plan_gke_node_pool_operations`.
+    use_rest: True to go through the GKE API instead of gcloud.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  retry_policy = RetryPolicy(
+      max_attempts=args.node_pool_retries + 1,
+      retryable_patterns=node_pool_retryable_errors,
   )
+  concurrency_limit = AdaptiveConcurrencyLimit(
+      args.node_pool_concurrency,
+      minimum=args.min_node_pool_concurrency,
+      maximum=args.max_node_pool_concurrency,
+      congestion_patterns=node_pool_congestion_errors,
+  )
+  if use_rest or (args.node_pool_async and not args.dry_run):
+    max_return_code = run_node_pool_operations(
+        args,
+        operations,
+        'Create and Delete Nodepools',
+        use_rest=use_rest,
+        retry_policy=retry_policy,
+        concurrency_limit=concurrency_limit,
+    )
+  else:
+    max_return_code = run_commands(
+        [operation.command for operation in operations],
+        'Create and Delete Nodepools',
+        [operation.task for operation in operations],
+        dry_run=args.dry_run,
+        retry_policy=retry_policy,
+        concurrency_limit=concurrency_limit,
+    )
   if max_return_code != 0:
     xpk_print(f'Create and Delete Nodepools returned ERROR {max_return_code}')
     return 1
@@ -1487,19 +5158,54 @@ def run_gke_clusters_list_command(args) -> int:
   return 0
 
 
-def set_cluster_command(args) -> int:
+def get_cluster_kubeconfig(args) -> str:
+  """Returns the path of the private kubeconfig of the cluster of `args`."""
+  return os.path.join(
+      cluster_context_dir, f'{ClusterContextCache.cluster_key(args)}.kubeconfig'
+  )
+
+
+def set_cluster_command(args, refresh=False) -> int:
   """Run cluster configuration command to set the kubectl config.
 
+  The credentials go to a private kubeconfig of the cluster instead of the
+  shared one. Its path is kept in `args.kubeconfig`, and every kubectl command
+  and the native client of this run get it through the KUBECONFIG variable of
+  their own environment, see `get_command_env`. xpk runs on different
+  clusters therefore never
+  change each other's current context. Runs on the same cluster fetch into
+  their own temporary file and atomically replace the kubeconfig. With the
+  cluster context cache, the credentials are fetched again only once the
+  cached context expires.
+
   Args:
     args: user provided arguments for running the command.
+    refresh: fetches the credentials even if they are cached.
 
   Returns:
     0 if successful and 1 otherwise.
   """
+  kubeconfig = get_cluster_kubeconfig(args)
+  cache = get_context_cache(args)
+  if not args.dry_run:
+    os.makedirs(cluster_context_dir, mode=0o700, exist_ok=True)
+    args.kubeconfig = kubeconfig
+  if (
+      cache is not None
+      and not refresh
+      and os.path.exists(kubeconfig)
+      and cache.load(cache.cluster_key(args)) is not None
+  ):
+    xpk_print(f'Using the cached credentials of cluster {args.cluster}.')
+    return 0
+  fetched_path = f'{kubeconfig}.{os.getpid()}.tmp'
+  fetched_kubeconfig = shlex.quote(fetched_path)
   command = (
-      'gcloud container clusters get-credentials'
-      f' {args.cluster} --region={zone_to_region(args.zone)} --project={args.project} &&'
-      ' kubectl config view && kubectl config set-context --current --namespace=default'
+      f'KUBECONFIG={fetched_kubeconfig} gcloud container clusters'
+      f' get-credentials {args.cluster} --region={zone_to_region(args.zone)}'
+      f' --project={args.project} && KUBECONFIG={fetched_kubeconfig} kubectl'
+      f' config view && KUBECONFIG={fetched_kubeconfig} kubectl config'
+      ' set-context --current --namespace=default'
   )
   return_code = run_command_with_updates(
       command, 'Set Cluster', args, verbose=False
@@ -1507,8 +5213,14 @@ def set_cluster_command(args) -> int:
 
   if return_code != 0:
     xpk_print(f'Set Cluster request returned ERROR {return_code}')
+    if os.path.exists(fetched_path):
+      os.remove(fetched_path)
     return 1
 
+  if not args.dry_run:
+    os.replace(fetched_path, kubeconfig)
+  if cache is not None:
+    cache.save(cache.cluster_key(args), {'kubeconfig': kubeconfig})
   return 0
 
 
@@ -1521,10 +5233,7 @@ def install_kueue_on_cluster(args) -> int:
   Returns:
     0 if successful and 1 otherwise.
   """
-  command = (
-      'kubectl apply -f'
-      ' https://github.com/kubernetes-sigs/kueue/releases/download/v0.4.1/manifests.yaml'
-  )
+  command = f'kubectl apply -f {kueue_manifest_url}'
   return_code = run_command_with_updates(command, 'Set Kueue On Cluster', args)
 
   if return_code != 0:
@@ -1534,29 +5243,171 @@ def install_kueue_on_cluster(args) -> int:
   return 0
 
 
-def enable_kueue_crds(args, system) -> int:
-  """Enable Kueue crds.
+async def get_registry_mirror_address_async(args) -> str | None:
+  """Returns the cluster IP of the registry mirror Service.
+
+  Args:
+    args: user provided arguments for running the command.
+
+  Returns:
+    The IP, or None if the Service could not be read.
+  """
+  task = 'Get Registry Mirror Address'
+  if use_native_kubernetes_client(args):
+    return_code, service = await kubernetes_call_async(
+        task, args, 'get', 'Service', 'xpk-registry-mirror', 'kube-system'
+    )
+    address = '' if service is None else service['spec'].get('clusterIP', '')
+  else:
+    command = (
+        'kubectl get service xpk-registry-mirror --namespace=kube-system'
+        " -o=jsonpath='{.spec.clusterIP}'"
+    )
+    return_code, address = await run_command_for_value_async(
+        command, task, args, dry_run_return_val='MIRROR_CLUSTER_IP'
+    )
+  if return_code != 0 or not address.strip():
+    xpk_print(f'{task} request returned ERROR {return_code}')
+    return None
+  return address.strip()
+
+
+def deploy_registry_mirror(args) -> int:
+  """Deploys the registry mirror and points containerd of all nodes at it.
 
   Args:
     args: user provided arguments for running the command.
-    system: system level arguments.
 
   Returns:
     0 if successful and 1 otherwise.
   """
+  yml_string = registry_mirror_yaml.format(
+      upstream=args.registry_mirror_upstream,
+      replicas=args.registry_mirror_replicas,
+      registry_image=registry_mirror_image,
+      cache_size=args.registry_mirror_cache_size,
+  )
+  return_code = apply_manifests(yml_string, 'Deploy Registry Mirror', args)
+  if return_code != 0:
+    xpk_print(f'Deploy Registry Mirror request returned ERROR {return_code}')
+    return 1
+
+  # Nodes reach the mirror through its cluster IP since containerd does not
+  # use the cluster DNS.
+  mirror_address = run_concurrently(get_registry_mirror_address_async(args))[0]
+  if mirror_address is None:
+    return 1
+  yml_string = registry_mirror_config_yaml.format(
+      upstream=args.registry_mirror_upstream,
+      mirror_address=mirror_address,
+      busybox_image=busybox_image,
+  )
+  return_code = apply_manifests(
+      yml_string, 'Configure Registry Mirror On Nodes', args
+  )
+  if return_code != 0:
+    xpk_print(
+        f'Configure Registry Mirror On Nodes request returned ERROR {return_code}'
+    )
+    return 1
+  xpk_print(
+      f'Nodes pull images of {args.registry_mirror_upstream} through the'
+      f' registry mirror at {mirror_address}:5000.'
+  )
+  return 0
+
+
+def get_cluster_set_crd_manifests(args, system) -> list[dict]:
+  """Generates the Kueue resources and priority classes of a cluster.
 
+  Args:
+    args: user provided arguments for running the command.
+    system: system level arguments.
+
+  Returns:
+    list[dict]: the objects to apply.
+  """
   device_type = args.tpu_type if args.tpu_type else args.device_type
   cluster_hardware_name = f'{args.num_slices}x{device_type}'
   total_chips = args.num_slices * system.vms_per_slice * system.chips_per_vm
-  yml_string = cluster_set_crd_yaml.format(
-      system=system,
-      cluster_hardware_name=cluster_hardware_name,
-      total_chips=total_chips,
-      accelerator_label=create_accelerator_label(system.accelerator_type, system),
-      machine_label=create_machine_label(system.accelerator_type, system),
-      resource_type=AcceleratorTypeToAcceleratorCharacteristics[system.accelerator_type].resource_type
-  )
-  tmp = write_temporary_file(yml_string)
+  resource_type = AcceleratorTypeToAcceleratorCharacteristics[system.accelerator_type].resource_type
+  manifests = [
+      {
+          'apiVersion': 'kueue.x-k8s.io/v1beta1',
+          'kind': 'ResourceFlavor',
+          'metadata': {'name': cluster_hardware_name},
+          'spec': {
+              'nodeLabels': {
+                  **create_accelerator_label(system.accelerator_type, system),
+                  **create_machine_label(system.accelerator_type, system),
+              }
+          },
+      },
+      {
+          'apiVersion': 'kueue.x-k8s.io/v1beta1',
+          'kind': 'ClusterQueue',
+          'metadata': {'name': 'cluster-queue'},
+          'spec': {
+              'preemption': {
+                  # Don't preempt other queues in the cohort.
+                  'reclaimWithinCohort': 'Never',
+                  'withinClusterQueue': 'LowerPriority',
+              },
+              # Match all namespaces.
+              'namespaceSelector': {},
+              'resourceGroups': [{
+                  'coveredResources': [resource_type],
+                  'flavors': [{
+                      'name': cluster_hardware_name,
+                      'resources': [{
+                          'name': resource_type,
+                          # Number of slices * number of chips in each slice.
+                          'nominalQuota': total_chips,
+                      }],
+                  }],
+              }],
+          },
+      },
+      {
+          'apiVersion': 'kueue.x-k8s.io/v1beta1',
+          'kind': 'LocalQueue',
+          'metadata': {'namespace': 'default', 'name': 'multislice-queue'},
+          'spec': {'clusterQueue': 'cluster-queue'},
+      },
+  ]
+  for name, value, description in workload_priority_classes:
+    manifests.append({
+        'apiVersion': 'scheduling.k8s.io/v1',
+        'kind': 'PriorityClass',
+        'metadata': {'name': name},
+        'value': value,
+        'globalDefault': False,
+        'description': description,
+    })
+  return manifests
+
+
+def enable_kueue_crds(args, system) -> int:
+  """Enable Kueue crds.
+
+  Args:
+    args: user provided arguments for running the command.
+    system: system level arguments.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+
+  manifests = get_cluster_set_crd_manifests(args, system)
+  manifest_errors = [
+      error for manifest in manifests for error in get_manifest_errors(manifest)
+  ]
+  if manifest_errors:
+    xpk_print('The Kueue resources are invalid:')
+    for error in manifest_errors:
+      xpk_print(f'  {error}')
+    return 1
+  tmp = write_temporary_file(serialize_manifests(manifests))
   command = f'kubectl apply -f {str(tmp.file.name)}'
   # For kueue setup, we see a timeout error due to the webhook not
   # being ready. Let's retry and wait a few seconds.
@@ -1564,7 +5415,9 @@ def enable_kueue_crds(args, system) -> int:
   i = 0
   return_code = -1
   while (return_code != 0 and i < retry_limit):
+    sleep_start = time.perf_counter()
     time.sleep(5)
+    profile_count(poll_sleep_seconds=time.perf_counter() - sleep_start)
     i += 1
     xpk_print(f'Try {i}: Applying Kueue CRDs')
     return_code = run_command_with_updates(command, 'Applying Kueue CRDs', args)
@@ -1586,10 +5439,7 @@ def set_jobset_on_cluster(args) -> int:
   Returns:
     0 if successful and 1 otherwise.
   """
-  command = (
-      'kubectl apply --server-side -f'
-      ' https://github.com/kubernetes-sigs/jobset/releases/download/v0.3.1/manifests.yaml'
-  )
+  command = f'kubectl apply --server-side -f {jobset_manifest_url}'
   return_code = run_command_with_updates(command, 'Set Jobset On Cluster', args)
 
   if return_code != 0:
@@ -1625,6 +5475,237 @@ def default_subcommand_function(_args) -> int:  # args is unused, so pylint: dis
   return 0
 
 
+def get_cluster_journal_path(args) -> str:
+  """Returns the path of the step journal of a cluster.
+
+  Args:
+    args: user provided arguments for running the command.
+
+  Returns:
+    Path of the journal, keyed by project, zone and cluster.
+  """
+  return os.path.join(
+      xpk_state_dir,
+      'journal',
+      f'{args.project}_{args.zone}_{args.cluster}.json',
+  )
+
+
+def get_cluster_create_time(args) -> tuple[int, str | None]:
+  """Returns when the cluster was created.
+
+  A cluster deleted and created again under the same name has a new create
+  time, which tells the step journal of the old cluster apart.
+
+  Args:
+    args: user provided arguments for running the command.
+
+  Returns:
+    Tuple of:
+      0 if successful and 1 otherwise.
+      The create time of the cluster, or None if it does not exist.
+  """
+  task = 'Get Cluster Create Time'
+  if use_gcp_rest_client(args):
+    return_code, clusters = asyncio.run(
+        gcp_call_async(
+            task,
+            args,
+            'list_clusters',
+            args.project,
+            zone_to_region(args.zone),
+        )
+    )
+    if return_code != 0:
+      return return_code, None
+    for cluster in clusters:
+      if cluster['name'] == args.cluster:
+        return 0, cluster.get('createTime')
+    return 0, None
+
+  command = (
+      'gcloud container clusters list'
+      f' --project={args.project} --region={zone_to_region(args.zone)}'
+      f' --filter=name={args.cluster} --format="value(createTime)"'
+  )
+  return_code, create_time = run_command_for_value(command, task, args)
+  if return_code != 0:
+    xpk_print(f'{task} returned ERROR {return_code}')
+    return return_code, None
+  return 0, create_time.strip() or None
+
+
+def create_cluster_and_note_create_time(args, journal) -> int:
+  """Creates the cluster if necessary and notes its create time.
+
+  Args:
+    args: user provided arguments for running the command.
+    journal: StepJournal of cluster create, or None.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  return_code = create_cluster_if_necessary(args)
+  if return_code != 0 or journal is None:
+    return return_code
+  return_code, create_time = get_cluster_create_time(args)
+  if return_code == 0:
+    journal.set_note('cluster_create_time', create_time)
+  return return_code
+
+
+def check_cluster_journal(args, journal) -> int:
+  """Clears the journal if it was written for another cluster of this name.
+
+  Steps only complete for the cluster that existed when they ran. If it was
+  deleted, or deleted and created again, outside of xpk, every step runs
+  again.
+
+  Args:
+    args: user provided arguments for running the command.
+    journal: StepJournal of cluster create.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  if not journal.entries or args.dry_run:
+    return 0
+  return_code, create_time = get_cluster_create_time(args)
+  if return_code != 0:
+    return return_code
+  if create_time is None or create_time != journal.notes.get(
+      'cluster_create_time'
+  ):
+    xpk_print(
+        f'Cluster {args.cluster} was deleted or created again since the'
+        f' step journal {journal.path} was written, running every step again.'
+    )
+    journal.clear()
+  return 0
+
+
+def get_cluster_create_steps(args, system, journal=None) -> list[Step]:
+  """Returns the steps of cluster create and their dependencies.
+
+  Only the node pools need the long TPU provisioning. Everything installed
+  through kubectl only needs the control plane, so it runs alongside.
+
+  Args:
+    args: user provided arguments for running the command.
+    system: system characteristics.
+    journal: StepJournal in which the create time of the cluster is noted.
+
+  Returns:
+    List of Step.
+  """
+  device_type = args.tpu_type if args.tpu_type else args.device_type
+  slices = {'device_type': device_type, 'num_slices': args.num_slices}
+  node_pool_inputs = slices | {
+      'gke_version': args.gke_version,
+      'host_maintenance_interval': args.host_maintenance_interval,
+      'on_demand': args.on_demand,
+      'reservation': args.reservation,
+      'spot': args.spot,
+      'custom_tpu_nodepool_arguments': args.custom_tpu_nodepool_arguments,
+  }
+  node_pool_plan = {}
+
+  def plan_node_pools() -> int:
+    return_code, node_pool_plan['operations'], node_pool_plan['use_rest'] = (
+        plan_gke_node_pool_operations(args, system)
+    )
+    return return_code
+
+  def create_node_pools() -> int:
+    return run_gke_node_pool_create_command(
+        args, node_pool_plan['operations'], node_pool_plan['use_rest']
+    )
+
+  steps = [
+      Step(
+          'Create Cluster',
+          lambda: create_cluster_and_note_create_time(args, journal),
+          resumable=True,
+          inputs={
+              'gke_version': args.gke_version,
+              'default_pool_cpu_machine_type': (
+                  args.default_pool_cpu_machine_type
+              ),
+              'cluster_cpu_machine_type': args.cluster_cpu_machine_type,
+              'custom_cluster_arguments': args.custom_cluster_arguments,
+          },
+      ),
+      # Lists the node pools and asks before deleting any, so it runs on the
+      # main thread.
+      Step(
+          'Plan Node Pools',
+          plan_node_pools,
+          ('Create Cluster',),
+          resumable=True,
+          inputs=node_pool_inputs,
+          rerun_with_dependents=True,
+          interactive=True,
+      ),
+      Step(
+          'Create Node Pools',
+          create_node_pools,
+          ('Plan Node Pools',),
+          resumable=True,
+          inputs=node_pool_inputs,
+      ),
+      Step(
+          'Set Cluster',
+          lambda: set_cluster_command(args, refresh=True),
+          ('Create Cluster',),
+          resumable=True,
+          rerun_with_dependents=True,
+      ),
+      Step(
+          'Set JobSet On Cluster',
+          lambda: set_jobset_on_cluster(args),
+          ('Set Cluster',),
+          resumable=True,
+          inputs={'manifest': jobset_manifest_url},
+      ),
+      Step(
+          'Set Kueue On Cluster',
+          lambda: install_kueue_on_cluster(args),
+          ('Set Cluster',),
+          resumable=True,
+          inputs={'manifest': kueue_manifest_url},
+      ),
+      Step(
+          'Enable Kueue CRDs',
+          lambda: enable_kueue_crds(args, system),
+          ('Set Kueue On Cluster',),
+          resumable=True,
+          inputs=slices,
+      ),
+      Step(
+          'Create Cluster ConfigMap',
+          lambda: create_cluster_configmap(args, system),
+          ('Set Cluster',),
+          resumable=True,
+          inputs=slices,
+      ),
+  ]
+  if args.registry_mirror:
+    steps.append(
+        Step(
+            'Deploy Registry Mirror',
+            lambda: deploy_registry_mirror(args),
+            ('Set Cluster',),
+            resumable=True,
+            inputs={
+                'upstream': args.registry_mirror_upstream,
+                'replicas': args.registry_mirror_replicas,
+                'cache_size': args.registry_mirror_cache_size,
+            },
+        )
+    )
+  return steps
+
+
 def cluster_create(args) -> int:
   """Function around cluster creation.
 
@@ -1643,67 +5724,268 @@ def cluster_create(args) -> int:
   xpk_print(f'Starting cluster create for cluster {args.cluster}:', flush=True)
   add_zone_and_project(args)
 
-  create_cluster_command_code = create_cluster_if_necessary(args)
-  if create_cluster_command_code != 0:
-    xpk_exit(create_cluster_command_code)
+  journal = StepJournal(get_cluster_journal_path(args), read_only=args.dry_run)
+  steps = get_cluster_create_steps(args, system, journal)
+  if args.restart:
+    journal.clear()
+  else:
+    check_code = check_cluster_journal(args, journal)
+    if check_code != 0:
+      xpk_exit(check_code)
+    if args.from_step:
+      step_names = [step.name for step in steps]
+      if args.from_step not in step_names:
+        xpk_print(
+            f'Unknown step `{args.from_step}` for `--from-step`, choose one of'
+            f' {step_names}.'
+        )
+        xpk_exit(1)
+      for name in get_dependent_step_names(steps, args.from_step):
+        journal.forget(name)
+
+  cluster_create_code = run_step_graph(steps, 'Cluster Create', journal)
+  if cluster_create_code != 0:
+    xpk_exit(cluster_create_code)
+
+  xpk_print('GKE commands done! Resources are created.')
+  xpk_print(
+      'See your GKE Cluster here:'
+      # pylint: disable=line-too-long
+      f' https://console.cloud.google.com/kubernetes/clusters/details/{zone_to_region(args.zone)}/{args.cluster}/details?project={args.project}'
+  )
+  xpk_print(
+      'xpk keeps the credentials of the cluster apart from your kubeconfig,'
+      ' point kubectl at them with:'
+      f' export KUBECONFIG={shlex.quote(get_cluster_kubeconfig(args))}'
+  )
+  xpk_exit(0)
+
+
+def cluster_delete(args) -> int:
+  """Function around cluster delete.
+
+  Args:
+    args: user provided arguments for running the command.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  xpk_print(f'Starting cluster delete for cluster: {args.cluster}', flush=True)
+  add_zone_and_project(args)
+  run_gke_cluster_delete_command_code = run_gke_cluster_delete_command(args)
+  if run_gke_cluster_delete_command_code != 0:
+    xpk_exit(run_gke_cluster_delete_command_code)
+  cache = get_context_cache(args)
+  if cache is not None:
+    cache.forget(cache.cluster_key(args))
+  if not args.dry_run:
+    for path in (get_cluster_kubeconfig(args), get_cluster_journal_path(args)):
+      if os.path.exists(path):
+        os.remove(path)
+  xpk_print(f'GKE commands done! Cluster {args.cluster} deleted.\n')
+  return 0
+
+
+def parse_kubernetes_time(timestamp) -> datetime.datetime | None:
+  """Returns a Kubernetes RFC 3339 timestamp as a datetime, if set."""
+  if not timestamp:
+    return None
+  return datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
 
-  run_gke_node_pool_create_command_code = run_gke_node_pool_create_command(
-      args, system
+def get_daemonset_pod_node(pod) -> str | None:
+  """Returns the node of a DaemonSet pod, even before it is scheduled.
+
+  The DaemonSet controller pins each pod to its node with a node affinity on
+  the node name, and the scheduler only sets `spec.nodeName` once it binds it.
+  """
+  spec = pod.get('spec', {})
+  if spec.get('nodeName'):
+    return spec['nodeName']
+  terms = get_json_path(
+      spec,
+      '.affinity.nodeAffinity.requiredDuringSchedulingIgnoredDuringExecution'
+      '.nodeSelectorTerms',
+  )
+  for term in terms if isinstance(terms, list) else []:
+    for field in term.get('matchFields') or []:
+      if field.get('key') == 'metadata.name' and field.get('values'):
+        return field['values'][0]
+  return None
+
+
+def get_cached_images(pod) -> list[str]:
+  """Returns the images that a pod of `cluster cacheimage` pulls."""
+  return [
+      container.get('image')
+      for container in pod.get('spec', {}).get('initContainers') or []
+      if container.get('name', '').startswith('cache-')
+  ]
+
+
+def get_cached_image_pull_seconds(pod, images) -> float | None:
+  """Returns how long the pod took to pull and start `images` once scheduled.
+
+  Args:
+    pod: DaemonSet pod of `cluster cacheimage`.
+    images: images that the pod has to cache.
+
+  Returns:
+    The seconds from scheduling to the start of the pause container, after
+    the init containers of all the images ran, or None if the pod does not
+    pull `images` or is not ready yet.
+  """
+  if get_cached_images(pod) != images:
+    return None
+  status = pod.get('status', {})
+  conditions = {
+      condition.get('type'): condition
+      for condition in status.get('conditions') or []
+  }
+  if conditions.get('Ready', {}).get('status') != 'True':
+    return None
+  started = None
+  for container_status in status.get('containerStatuses') or []:
+    started = parse_kubernetes_time(
+        container_status.get('state', {}).get('running', {}).get('startedAt')
+    )
+  scheduled = parse_kubernetes_time(
+      conditions.get('PodScheduled', {}).get('lastTransitionTime')
   )
-  if run_gke_node_pool_create_command_code != 0:
-    xpk_exit(run_gke_node_pool_create_command_code)
+  if started is None or scheduled is None:
+    return 0.0
+  return max(0.0, (started - scheduled).total_seconds())
 
-  set_cluster_command_code = set_cluster_command(args)
-  if set_cluster_command_code != 0:
-    xpk_exit(set_cluster_command_code)
 
-  xpk_print(
-      'Enabling the jobset API on our cluster, to be deprecated when Jobset is'
-      ' globally available'
-  )
-  set_jobset_on_cluster_code = set_jobset_on_cluster(args)
-  if set_jobset_on_cluster_code != 0:
-    xpk_exit(set_jobset_on_cluster_code)
+def get_pod_waiting_reason(pod) -> str:
+  """Returns why the containers of a pod are not running, e.g. ErrImagePull."""
+  status = pod.get('status', {})
+  for container_status in (status.get('initContainerStatuses') or []) + (
+      status.get('containerStatuses') or []
+  ):
+    reason = container_status.get('state', {}).get('waiting', {}).get('reason')
+    if reason:
+      return f'{reason} ({container_status.get("image")})'
+  return status.get('phase') or 'Pending'
 
-  xpk_print('Enabling Kueue on the cluster')
-  install_kueue_on_cluster_code = install_kueue_on_cluster(args)
-  if install_kueue_on_cluster_code != 0:
-    xpk_exit(install_kueue_on_cluster_code)
 
-  xpk_print('Enable Kueue CRDs')
-  enable_kueue_creds_code = enable_kueue_crds(args, system)
-  if enable_kueue_creds_code != 0:
-    xpk_exit(enable_kueue_creds_code)
+async def get_cached_image_status_async(args) -> tuple[int, dict, list[dict]]:
+  """Returns the DaemonSet of `cluster cacheimage` and its pods.
 
-  xpk_print('Creating ConfigMap for cluster')
-  create_cluster_configmap_code = create_cluster_configmap(args, system)
-  if create_cluster_configmap_code != 0:
-    xpk_exit(create_cluster_configmap_code)
+  Args:
+    args: user provided arguments for running the command.
 
-  xpk_print('GKE commands done! Resources are created.')
-  xpk_print(
-      'See your GKE Cluster here:'
-      # pylint: disable=line-too-long
-      f' https://console.cloud.google.com/kubernetes/clusters/details/{zone_to_region(args.zone)}/{args.cluster}/details?project={args.project}'
+  Returns:
+    The error code, the DaemonSet and the list of its pods.
+  """
+  if use_native_kubernetes_client(args):
+    (daemonset_code, daemonset), (pods_code, pods) = await asyncio.gather(
+        kubernetes_call_async(
+            'Get Cached Image Status', args, 'get', 'DaemonSet', args.cache_key
+        ),
+        kubernetes_call_async(
+            'List Cached Image Pods',
+            args,
+            'list',
+            'Pod',
+            label_selector=f'k8s-app={args.cache_key}',
+        ),
+    )
+    return daemonset_code or pods_code, daemonset or {}, pods or []
+
+  (daemonset_code, daemonset), (pods_code, pods) = await asyncio.gather(
+      run_command_for_value_async(
+          f'kubectl get daemonset {args.cache_key} -o=json',
+          'Get Cached Image Status',
+          args,
+          dry_run_return_val='{}',
+      ),
+      run_command_for_value_async(
+          f'kubectl get pods -l k8s-app={args.cache_key} -o=json',
+          'List Cached Image Pods',
+          args,
+          dry_run_return_val='{"items": []}',
+      ),
   )
-  xpk_exit(0)
+  if daemonset_code != 0 or pods_code != 0:
+    return daemonset_code or pods_code, {}, []
+  return 0, json.loads(daemonset), json.loads(pods).get('items') or []
 
 
-def cluster_delete(args) -> int:
-  """Function around cluster delete.
+async def wait_for_cached_image_async(args, images) -> int:
+  """Waits until every node targeted by `cluster cacheimage` has `images`.
+
+  Every `cache_image_poll_interval_seconds`, the DaemonSet and its pods are
+  fetched to print how many nodes cached the images and how long the nodes
+  that finished since the last check took to pull them.
 
   Args:
     args: user provided arguments for running the command.
+    images: images that the nodes have to cache.
 
   Returns:
-    0 if successful and 1 otherwise.
+    0 if every node cached the images before `args.wait_timeout` seconds and
+    1 otherwise.
   """
-  xpk_print(f'Starting cluster delete for cluster: {args.cluster}', flush=True)
-  add_zone_and_project(args)
-  run_gke_cluster_delete_command_code = run_gke_cluster_delete_command(args)
-  if run_gke_cluster_delete_command_code != 0:
-    xpk_exit(run_gke_cluster_delete_command_code)
-  xpk_print(f'GKE commands done! Cluster {args.cluster} deleted.\n')
+  start_time = time.monotonic()
+  pull_seconds = {}
+  while True:
+    return_code, daemonset, pods = await get_cached_image_status_async(args)
+    if return_code != 0:
+      xpk_print(f'Checking the cached image returned ERROR {return_code}')
+      return return_code
+    lagging = {}
+    for pod in pods:
+      node = get_daemonset_pod_node(pod)
+      if node is None or node in pull_seconds:
+        continue
+      seconds = get_cached_image_pull_seconds(pod, images)
+      if seconds is not None:
+        pull_seconds[node] = seconds
+        lagging.pop(node, None)
+        xpk_print(f'Node {node} cached the image in {seconds:.1f}s')
+      elif get_cached_images(pod) == images:
+        lagging[node] = get_pod_waiting_reason(pod)
+      else:
+        lagging.setdefault(node, 'previous image')
+
+    status = daemonset.get('status', {})
+    desired = status.get('desiredNumberScheduled', 0)
+    rolled_out = status.get('observedGeneration', 0) >= daemonset.get(
+        'metadata', {}
+    ).get('generation', 0)
+    seconds_elapsed = time.monotonic() - start_time
+    xpk_print(
+        f'[t={seconds_elapsed:.2f}, Cache Image] {len(pull_seconds)}/{desired}'
+        ' nodes cached'
+    )
+    if rolled_out and len(pull_seconds) >= desired:
+      break
+    if seconds_elapsed >= args.wait_timeout:
+      xpk_print(
+          f'Timed out after {args.wait_timeout} seconds with'
+          f' {len(pull_seconds)}/{desired} nodes cached. Nodes still pulling'
+          ' the image:'
+      )
+      for node, reason in sorted(lagging.items()):
+        xpk_print(f'  {node}: {reason}')
+      return 1
+    sleep_start = time.perf_counter()
+    await asyncio.sleep(
+        min(
+            cache_image_poll_interval_seconds,
+            args.wait_timeout - seconds_elapsed,
+        )
+    )
+    profile_count(poll_sleep_seconds=time.perf_counter() - sleep_start)
+
+  if pull_seconds:
+    durations = sorted(pull_seconds.values())
+    xpk_print(
+        f'All {len(durations)} nodes cached the image. Pull time median'
+        f' {durations[len(durations) // 2]:.1f}s, slowest'
+        f' {durations[-1]:.1f}s.'
+    )
   return 0
 
 
@@ -1716,6 +5998,20 @@ def cluster_cacheimage(args) -> int:
   Returns:
     0 if successful and 1 otherwise.
   """
+  # Kubernetes needs exactly one of maxSurge and maxUnavailable to be
+  # non-zero, so the flag that is not given defaults to 0 if the other is.
+  if args.max_unavailable is None:
+    args.max_unavailable = '0'
+  if args.max_surge is None:
+    args.max_surge = '100%' if args.max_unavailable.rstrip('%') == '0' else '0'
+  if (args.max_unavailable.rstrip('%') == '0') == (
+      args.max_surge.rstrip('%') == '0'
+  ):
+    xpk_print(
+        'Exactly one of --max-unavailable and --max-surge must be non-zero.'
+    )
+    xpk_exit(1)
+
   xpk_print(
       f'Starting cluster cacheimage for cluster: {args.cluster}', flush=True
   )
@@ -1730,31 +6026,138 @@ def cluster_cacheimage(args) -> int:
     xpk_print('Fetching system characteristics failed!')
     xpk_exit(return_code)
 
+  # Workloads pin their image to a digest, so cache that same digest.
+  docker_images = list(dict.fromkeys(args.docker_image))
+  pinned_docker_images = run_concurrently(
+      *(get_docker_image_digest_async(image, args) for image in docker_images)
+  )
+  for i, pinned_docker_image in enumerate(pinned_docker_images):
+    if pinned_docker_image is not None:
+      xpk_print(f'Caching {docker_images[i]} as {pinned_docker_image}.')
+      docker_images[i] = pinned_docker_image
+
   node_selector_key = AcceleratorTypeToAcceleratorCharacteristics[system.accelerator_type].accelerator_label
+  cache_containers = '\n'.join(
+      cluster_preheat_cache_container_yml.format(
+          image_name=image,
+          index=i,
+          image_pull_policy=get_image_pull_policy_yaml(args, image),
+      )
+      for i, image in enumerate(docker_images)
+  )
   yml_string = cluster_preheat_yml.format(
       cachekey=args.cache_key,
-      image_name=args.docker_image,
+      cached_at=datetime.datetime.now(datetime.timezone.utc).isoformat(
+          timespec='seconds'
+      ),
+      cache_containers=cache_containers,
+      busybox_image=busybox_image,
+      max_unavailable=args.max_unavailable,
+      max_surge=args.max_surge,
       nodeSelectorKey=node_selector_key
   )
-  tmp = write_temporary_file(yml_string)
-  command_apply = f'kubectl apply -f {str(tmp.file.name)}'
-  command_delete = (
-      f'kubectl delete -f {str(tmp.file.name)} --ignore-not-found=true'
-  )
+  # Updating the DaemonSet in place keeps the pods of the previous image until
+  # the new one runs on their node, rather than recreating all of them.
+  return_code = apply_manifests(yml_string, 'Updating Cached Image', args)
+  if return_code != 0:
+    xpk_print(f'Update Cached Image returned ERROR {return_code}')
+    xpk_exit(return_code)
 
-  return_code = run_command_with_updates(
-      command_delete, 'Deleting Cached Image', args
+  return_code = 0
+  if args.wait:
+    return_code = run_concurrently(
+        wait_for_cached_image_async(args, docker_images)
+    )[0]
+  xpk_exit(return_code)
+
+
+async def get_stale_cache_keys_async(args) -> tuple[int, list[str]]:
+  """Returns the cache keys of `cluster cacheimage` that `args` selects.
+
+  Args:
+    args: user provided arguments for running the command.
+
+  Returns:
+    The error code, and the keys cached more than `args.max_age` seconds ago
+    and not in `args.keep_cache_key`.
+  """
+  if use_native_kubernetes_client(args):
+    return_code, daemonsets = await kubernetes_call_async(
+        'List Cache Keys',
+        args,
+        'list',
+        'DaemonSet',
+        label_selector='xpk.google.com/cache-key',
+    )
+  else:
+    return_code, output = await run_command_for_value_async(
+        'kubectl get daemonsets -l xpk.google.com/cache-key -o=json',
+        'List Cache Keys',
+        args,
+        dry_run_return_val='{"items": []}',
+    )
+    daemonsets = json.loads(output).get('items') if return_code == 0 else None
+  if return_code != 0:
+    return return_code, []
+
+  now = datetime.datetime.now(datetime.timezone.utc)
+  stale_cache_keys = []
+  for daemonset in daemonsets or []:
+    metadata = daemonset.get('metadata', {})
+    cache_key = metadata.get('name')
+    cached_at = parse_kubernetes_time(
+        (metadata.get('annotations') or {}).get('xpk.google.com/cached-at')
+        or metadata.get('creationTimestamp')
+    )
+    age = (now - cached_at).total_seconds() if cached_at else args.max_age
+    if cache_key not in args.keep_cache_key and age >= args.max_age:
+      xpk_print(f'Cache key {cache_key} was last cached {age:.0f}s ago.')
+      stale_cache_keys.append(cache_key)
+  return 0, stale_cache_keys
+
+
+def cluster_cacheimage_gc(args) -> int:
+  """Function around cluster cacheimage-gc.
+
+  Args:
+    args: user provided arguments for running the command.
+
+  Returns:
+    0 if successful and 1 otherwise.
+  """
+  xpk_print(
+      f'Starting cluster cacheimage-gc for cluster: {args.cluster}', flush=True
   )
+  add_zone_and_project(args)
+
+  set_cluster_command_code = set_cluster_command(args)
+  if set_cluster_command_code != 0:
+    xpk_exit(set_cluster_command_code)
+
+  return_code, stale_cache_keys = run_concurrently(
+      get_stale_cache_keys_async(args)
+  )[0]
   if return_code != 0:
-    xpk_print(f'Delete Cached Image returned ERROR {return_code}')
+    xpk_print(f'Listing the cache keys returned ERROR {return_code}')
     xpk_exit(return_code)
-
-  return_code = run_command_with_updates(
-      command_apply, 'Creating Cached Image', args
+  if not stale_cache_keys:
+    xpk_print('There are no stale cache keys.')
+    xpk_exit(0)
+
+  yml_string = serialize_manifests([
+      {'apiVersion': 'apps/v1', 'kind': 'DaemonSet', 'metadata': {'name': key}}
+      for key in stale_cache_keys
+  ])
+  return_code = delete_manifests(
+      yml_string, 'Deleting Stale Cache Keys', args, ignore_not_found=True
   )
   if return_code != 0:
-    xpk_print(f'Create Cached Image returned ERROR {return_code}')
+    xpk_print(f'Delete Stale Cache Keys returned ERROR {return_code}')
     xpk_exit(return_code)
+  xpk_print(
+      f'Deleted {len(stale_cache_keys)} cache keys:'
+      f' {", ".join(stale_cache_keys)}.'
+  )
   xpk_exit(0)
 
 
@@ -1783,24 +6186,51 @@ def cluster_describe(args) -> int:
   if return_code != 0:
     xpk_exit(return_code)
 
-  return_code_node_output, node_output = run_command_for_value(
-      r"kubectl get node --no-headers=true --selector='cloud.google.com/gke-tpu-accelerator' | wc -l",
-      'Count TPU Nodes',
-      args,
-  )
+  if use_native_kubernetes_client(args):
+    (return_code_node_output, nodes), (return_code_pod_output, pods) = (
+        run_concurrently(
+            kubernetes_call_async(
+                'Count TPU Nodes',
+                args,
+                'list',
+                'Node',
+                label_selector='cloud.google.com/gke-tpu-accelerator',
+            ),
+            kubernetes_call_async('Count TPU Pods', args, 'list', 'Pod'),
+        )
+    )
+    node_output = '\n'.join(
+        node['metadata']['name'] for node in nodes or []
+    )
+    pod_output = '\n'.join(
+        pod.get('status', {}).get('phase', '') for pod in pods or []
+    )
+  else:
+    return_code_node_output, node_output = run_command_for_value(
+        'kubectl get node --no-headers=true'
+        ' --selector=cloud.google.com/gke-tpu-accelerator',
+        'Count TPU Nodes',
+        args,
+        dry_run_return_val='',
+    )
+    return_code_pod_output, pod_output = run_command_for_value(
+        'kubectl get pod --no-headers=true'
+        ' -o=custom-columns=Status:.status.phase',
+        'Count TPU Pods',
+        args,
+        dry_run_return_val='',
+    )
   if return_code_node_output != 0:
     xpk_exit(return_code_node_output)
-  number_tpu_vms_in_cluster = int(node_output)
-
-  return_code_pod_output, pod_output = run_command_for_value(
-      "kubectl get pod -o=custom-columns='Status:.status.phase' | grep -i"
-      ' Running | wc -l',
-      'Count TPU Pods',
-      args,
+  number_tpu_vms_in_cluster = sum(
+      1 for line in node_output.splitlines() if line.strip()
   )
+
   if return_code_pod_output != 0:
     xpk_exit(return_code_pod_output)
-  number_tpu_pods_in_cluster = int(pod_output)
+  number_tpu_pods_in_cluster = sum(
+      1 for line in pod_output.splitlines() if 'running' in line.lower()
+  )
 
   xpk_print(
       f'The cluster contains {number_tpu_vms_in_cluster} TPUVMs of which'
@@ -1827,6 +6257,40 @@ def cluster_list(args) -> int:
   return 0
 
 
+def is_google_registry_image(docker_image) -> bool:
+  """Returns whether gcloud can describe `docker_image`."""
+  return 'gcr.io' in docker_image or 'docker.pkg.dev' in docker_image
+
+
+async def get_docker_image_digest_async(docker_image, args) -> str | None:
+  """Returns `docker_image` pinned to the digest that its tag points to.
+
+  Args:
+    docker_image: docker image, e.g. `gcr.io/project/name:tag`.
+    args: user provided arguments for running the command.
+
+  Returns:
+    The image as `name@sha256:...`, or None if it is missing, is not in
+    Container Registry or Artifact Registry, or this is a dry run.
+  """
+  if '@sha256:' in docker_image:
+    return docker_image
+  if not is_google_registry_image(docker_image):
+    return None
+  result = await run_command_async(
+      f'gcloud container images describe {docker_image}'
+      f' --project {args.project}'
+      ' --format="value(image_summary.fully_qualified_digest)"',
+      'Get Docker Image Digest',
+      args,
+      dry_run_return_val='',
+  )
+  pinned_docker_image = result.stdout.strip()
+  if result.return_code != 0 or '@sha256:' not in pinned_docker_image:
+    return None
+  return pinned_docker_image
+
+
 def validate_docker_image(docker_image, args) -> int:
   """Validates that the user provided docker image exists in your project.
 
@@ -1859,9 +6323,165 @@ def validate_docker_image(docker_image, args) -> int:
     return 0
 
 
+def docker_ignore_pattern_to_regex(pattern) -> str:
+  """Returns a regex for a `.dockerignore` pattern.
+
+  `*` and `?` do not match `/`, `**` matches any number of directories and
+  `\\` escapes the next character, as in `docker build`.
+
+  Args:
+    pattern: cleaned pattern, relative to the root of the context.
+
+  Returns:
+    The regex, to be matched against whole `/` separated paths.
+  """
+  regex = ''
+  i = 0
+  while i < len(pattern):
+    char = pattern[i]
+    if pattern.startswith('**/', i):
+      regex += '(.*/)?'
+      i += 3
+      continue
+    if pattern.startswith('**', i):
+      regex += '.*'
+      i += 2
+      continue
+    if char == '*':
+      regex += '[^/]*'
+    elif char == '?':
+      regex += '[^/]'
+    elif char == '[' and ']' in pattern[i + 1 :]:
+      end = pattern.index(']', i + 1)
+      regex += f'[{pattern[i + 1 : end]}]'
+      i = end
+    elif char == '\\' and i + 1 < len(pattern):
+      i += 1
+      regex += re.escape(pattern[i])
+    else:
+      regex += re.escape(char)
+    i += 1
+  return regex
+
+
+def get_docker_ignore_patterns(script_dir) -> list[tuple[bool, re.Pattern]]:
+  """Returns the patterns of the `.dockerignore` of a build context.
+
+  Args:
+    script_dir: directory of the build context.
+
+  Returns:
+    List of (is exception, compiled pattern), in the order of the file.
+  """
+  try:
+    with open(
+        os.path.join(script_dir, '.dockerignore'), encoding='utf-8'
+    ) as f:
+      lines = f.read().splitlines()
+  except OSError:
+    return []
+  patterns = []
+  for line in lines:
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    is_exception = line.startswith('!')
+    if is_exception:
+      line = line[1:].strip()
+    line = posixpath.normpath(line).lstrip('/')
+    if line in ('', '.'):
+      continue
+    patterns.append(
+        (is_exception, re.compile(docker_ignore_pattern_to_regex(line)))
+    )
+  return patterns
+
+
+def is_docker_ignored(relative_path, patterns) -> bool:
+  """Returns whether `docker build` leaves a path out of its context.
+
+  As in `docker build`, a pattern that matches a directory also matches
+  everything in it, and the last matching pattern wins.
+
+  Args:
+    relative_path: `/` separated path, relative to the root of the context.
+    patterns: patterns returned by `get_docker_ignore_patterns`.
+
+  Returns:
+    True if the path is ignored.
+  """
+  parts = relative_path.split('/')
+  paths = ['/'.join(parts[: i + 1]) for i in range(len(parts))]
+  ignored = False
+  for is_exception, pattern in patterns:
+    if any(pattern.fullmatch(path) for path in paths):
+      ignored = not is_exception
+  return ignored
+
+
+def get_docker_context_hash(script_dir, docker_file) -> str:
+  """Returns a SHA-256 of a docker build, given its context and Dockerfile.
+
+  The hash covers the Dockerfile, which names the base image, and the path,
+  mode and content of every file of the context that `.dockerignore` does not
+  leave out. Symbolic links, including links to directories, are hashed by
+  their target, as `docker build` sends them as links. The xpk logs are left
+  out in case they are written inside the context.
+
+  Args:
+    script_dir: directory of the build context.
+    docker_file: content of the Dockerfile.
+
+  Returns:
+    The hex digest.
+  """
+  digest = hashlib.sha256(docker_file.encode())
+  patterns = get_docker_ignore_patterns(script_dir)
+  # Without exceptions nothing below an ignored directory can be included.
+  has_exceptions = any(is_exception for is_exception, _ in patterns)
+  for root, dirs, files in os.walk(script_dir):
+    relative_root = os.path.relpath(root, script_dir)
+    entries = list(files)
+    walked_dirs = []
+    for name in dirs:
+      path = os.path.join(root, name)
+      if os.path.islink(path):
+        entries.append(name)
+      elif os.path.abspath(path) != xpk_log_root and (
+          has_exceptions
+          or not is_docker_ignored(
+              posixpath.normpath(
+                  posixpath.join(relative_root.replace(os.sep, '/'), name)
+              ),
+              patterns,
+          )
+      ):
+        walked_dirs.append(name)
+    dirs[:] = sorted(walked_dirs)
+    for name in sorted(entries):
+      path = os.path.join(root, name)
+      relative_path = os.path.relpath(path, script_dir).replace(os.sep, '/')
+      if is_docker_ignored(relative_path, patterns):
+        continue
+      stat = os.lstat(path)
+      digest.update(f'\0{relative_path}\0{stat.st_mode:o}\0'.encode())
+      if os.path.islink(path):
+        digest.update(os.readlink(path).encode())
+        continue
+      with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+          digest.update(chunk)
+  return digest.hexdigest()
+
+
 def build_docker_image_from_base_image(args, verbose=True) -> tuple[int, str]:
   """Adds script dir to the base docker image and uploads the image.
 
+  The image is tagged with a hash of the script dir and base image, so it is
+  only built and uploaded if the registry does not have that tag yet. Base
+  images in Container Registry or Artifact Registry are pinned to their
+  digest, so the tag changes when their tag is pushed again.
+
   Args:
     args: user provided arguments for running the command.
 
@@ -1875,12 +6495,33 @@ def build_docker_image_from_base_image(args, verbose=True) -> tuple[int, str]:
   docker_image_prefix = os.getenv('USER', 'unknown')
   docker_name = f'{docker_image_prefix}-runner'
 
+  base_docker_image = run_concurrently(
+      get_docker_image_digest_async(args.base_docker_image, args)
+  )[0]
   docker_file = script_dir_dockerfile.format(
-      base_docker_image=args.base_docker_image,
+      base_docker_image=base_docker_image or args.base_docker_image,
   )
+  tag_name = get_docker_context_hash(args.script_dir, docker_file)[
+      :docker_context_tag_length
+  ]
+  cloud_docker_image = f'gcr.io/{args.project}/{docker_name}:{tag_name}'
+
+  # Content addressed tags never move, so an existing one can be reused.
+  pinned_docker_image = run_concurrently(
+      get_docker_image_digest_async(cloud_docker_image, args)
+  )[0]
+  if pinned_docker_image is not None:
+    xpk_print(
+        f'Docker image {cloud_docker_image} of {args.script_dir} already'
+        ' exists, skipping the build and upload.'
+    )
+    return 0, pinned_docker_image
+
   tmp = write_temporary_file(docker_file)
+  # Built under its content addressed name, so that concurrent builds never
+  # share a local tag.
   docker_build_command = (
-      f'docker build -f {str(tmp.file.name)} -t {docker_name}'
+      f'docker build -f {str(tmp.file.name)} -t {cloud_docker_image}'
       f' {args.script_dir}'
   )
   xpk_print(f'Building {args.script_dir} into docker image.')
@@ -1894,32 +6535,10 @@ def build_docker_image_from_base_image(args, verbose=True) -> tuple[int, str]:
         f' You should be able to navigate to the URL {args.base_docker_image}'
         f' in {args.project}.'
     )
-    xpk_exit(1)
+    return 1, ''
 
-  # Pick a randomly generated `tag_length` character docker tag.
-  tag_length = 4
-  tag_random_prefix = ''.join(random.choices(string.ascii_lowercase, k=tag_length))
-  tag_datetime = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-  tag_name = f'{tag_random_prefix}-{tag_datetime}'
-  cloud_docker_image = f'gcr.io/{args.project}/{docker_name}:{tag_name}'
   xpk_print(f'Adding Docker Image: {cloud_docker_image} to {args.project}')
 
-  # Tag the docker image.
-  tag_docker_image_command = (
-      f'docker tag {docker_name} {cloud_docker_image}'
-  )
-  return_code = run_command_with_updates(
-      tag_docker_image_command, 'Tag Docker Image', args,
-      verbose=verbose
-  )
-  if return_code != 0:
-    xpk_print(
-        f'Failed to tag docker image with tag: {tag_name}.'
-        f' You should be able to navigate to the URL {cloud_docker_image} in'
-        f' {args.project}.'
-    )
-    xpk_exit(1)
-
   # Upload image to Artifact Registry.
   upload_docker_image_command = (
       f'docker push {cloud_docker_image}'
@@ -1934,44 +6553,48 @@ def build_docker_image_from_base_image(args, verbose=True) -> tuple[int, str]:
         f' You should be able to navigate to the URL {cloud_docker_image} in'
         f' {args.project}.'
     )
-    xpk_exit(1)
-  return return_code, cloud_docker_image
+    return 1, ''
+  pinned_docker_image = run_concurrently(
+      get_docker_image_digest_async(cloud_docker_image, args)
+  )[0]
+  return return_code, pinned_docker_image or cloud_docker_image
 
 
-def check_if_workload_exists(args) -> bool:
+async def check_if_workload_exists_async(args) -> tuple[int, bool]:
   """Check if workload exists.
 
+  Looks the JobSet of the workload up by name, so the cost does not grow with
+  the number of workloads in the cluster.
+
   Args:
      args: user provided arguments for running the command.
 
   Returns:
-    returns true if workload exist, otherwise returns false.
+    Tuple of:
+      0 if successful and 1 otherwise.
+      True if the workload exists, otherwise False.
   """
-  columns = {
-      'Jobset': '.metadata.ownerReferences[0].name',
-  }
-
-  s = ','.join([key + ':' + value for key, value in columns.items()])
-
-  command = f"kubectl get workloads -o=custom-columns='{s}'"
-  return_code, return_msg = run_command_for_value(
-      command, 'Check if Workload Already Exists', args
-  )
+  task = 'Check if Workload Already Exists'
+  if use_native_kubernetes_client(args):
+    return_code, jobset = await kubernetes_call_async(
+        task, args, 'get', 'JobSet', args.workload, ignore_not_found=True
+    )
+    workload_exists = jobset is not None
+  else:
+    command = f'kubectl get jobset {args.workload} --ignore-not-found -o=name'
+    return_code, return_msg = await run_command_for_value_async(
+        command, task, args, dry_run_return_val=''
+    )
+    workload_exists = bool(return_msg.strip())
 
   if return_code != 0:
-    xpk_print(f'List Job request returned ERROR {return_code}')
-    xpk_exit(return_code)
-
-  lines = return_msg.split('\n')
-  new_workload_name = args.workload
-  for line in lines:
-    if line == new_workload_name:
-      return True
-  return False
+    xpk_print(f'Get JobSet request returned ERROR {return_code}')
+    return return_code, False
+  return 0, workload_exists
 
 
 # TODO: Update when GPU support is enabled
-def check_if_workload_can_schedule(args, system):
+async def check_if_workload_can_schedule_async(args, system):
   """Check if workload can schedule based on the cluster resources (tpu_type and maximum VM in cluster).
 
   Args:
@@ -1981,7 +6604,7 @@ def check_if_workload_can_schedule(args, system):
   Returns:
     returns true if workload can schedule, otherwise returns false.
   """
-  cluster_config_map = get_cluster_configmap(args)
+  cluster_config_map = await get_cluster_configmap_async(args)
 
   # Prevents workload creation failure for existing clusters with no ConfigMap
   if cluster_config_map is None:
@@ -2047,7 +6670,7 @@ def setup_docker_image(args) -> tuple[int, str]:
   Returns:
     tuple:
       0 if successful and 1 otherwise.
-      Name of the docker image to use.
+      Name of the docker image to use, pinned to a digest when possible.
   """
   use_base_docker_image = use_base_docker_image_or_docker_image(args)
 
@@ -2057,22 +6680,29 @@ def setup_docker_image(args) -> tuple[int, str]:
         docker_image, args
     )
     if validate_docker_image_code != 0:
-      xpk_exit(validate_docker_image_code)
+      return validate_docker_image_code, docker_image
     build_docker_image_code, docker_image = build_docker_image_from_base_image(args)
     if build_docker_image_code != 0:
-      xpk_exit(build_docker_image_code)
+      return build_docker_image_code, docker_image
   else:
     docker_image = args.docker_image
+    # Finding the digest also validates the image.
+    pinned_docker_image = run_concurrently(
+        get_docker_image_digest_async(docker_image, args)
+    )[0]
+    if pinned_docker_image is not None:
+      xpk_print(f'Using {docker_image} as {pinned_docker_image}.')
+      return 0, pinned_docker_image
     validate_docker_image_code = validate_docker_image(
         args.docker_image, args
     )
     if validate_docker_image_code != 0:
-      xpk_exit(validate_docker_image_code)
+      return validate_docker_image_code, docker_image
 
   return 0, docker_image
 
-def get_main_and_sidecar_container(args, system, docker_image, command) -> str:
-  """Generate yaml for main and sidecar container.
+def get_main_and_sidecar_container(args, system, docker_image, command) -> list[dict]:
+  """Generate the main and sidecar containers.
   Args:
     args: user provided arguments for running the command.
     system: system characteristics
@@ -2080,79 +6710,129 @@ def get_main_and_sidecar_container(args, system, docker_image, command) -> str:
     command: command to run in the main container
 
   Returns:
-    str:
-      yaml for main and sidecar container
+    list[dict]:
+      sidecar and main container
   """
   resource_type = AcceleratorTypeToAcceleratorCharacteristics[system.accelerator_type].resource_type
   main_container = get_main_container(args, system, docker_image, command, resource_type)
-  yaml = """- name: stacktrace-explorer
-                image: busybox:1.28
-                args: [/bin/sh, -c, "while [ ! -d /tmp/debugging ]; do sleep 60; done; while [ ! -e /tmp/debugging/* ]; do sleep 60; done; tail -n+1 -f /tmp/debugging/*"]
-                volumeMounts:
-                - name: tpu-stack-trace
-                  readOnly: true
-                  mountPath: /tmp/debugging
-              {main_container}
-                volumeMounts:
-                - name: tpu-stack-trace
-                  mountPath: /tmp/debugging
-              volumes:
-              - name: tpu-stack-trace
-  """
-  return yaml.format(main_container=main_container)
-
-def get_main_container(args, system, docker_image, command, resource_type) -> str:
-  """Generate yaml for main container.
+  main_container['volumeMounts'].append(
+      {'name': 'tpu-stack-trace', 'mountPath': '/tmp/debugging'}
+  )
+  sidecar_container = {
+      'name': 'stacktrace-explorer',
+      'image': 'busybox:1.28',
+      'args': [
+          '/bin/sh',
+          '-c',
+          'while [ ! -d /tmp/debugging ]; do sleep 60; done; while [ ! -e'
+          ' /tmp/debugging/* ]; do sleep 60; done; tail -n+1 -f'
+          ' /tmp/debugging/*',
+      ],
+      'volumeMounts': [{
+          'name': 'tpu-stack-trace',
+          'readOnly': True,
+          'mountPath': '/tmp/debugging',
+      }],
+  }
+  return [sidecar_container, main_container]
+
+def get_main_container(args, system, docker_image, command, resource_type) -> dict:
+  """Generate the main container.
   Args:
     args: user provided arguments for running the command.
     system: system characteristics
     docker_image: docker image
     command: command to run in the main container
 
+  Returns:
+    dict:
+      main container
+  """
+  container = {
+      'name': args.docker_name,
+      'image': docker_image,
+  }
+  image_pull_policy = get_image_pull_policy(args, docker_image)
+  if image_pull_policy is not None:
+    container['imagePullPolicy'] = image_pull_policy
+  # Variables set by the user replace JOBSET_NAME, and the CPU variables
+  # replace theirs.
+  env = {'JOBSET_NAME': {'name': 'JOBSET_NAME', 'value': args.workload}}
+  env.update((variable['name'], variable) for variable in args.env)
+  env.update(
+      (variable['name'], variable)
+      for variable in get_cpu_env(args.num_slices, system)
+  )
+  container.update({
+      'env': list(env.values()),
+      'ports': [
+          {'containerPort': 8471},
+          {'containerPort': 8080},
+          *add_jax_coordinator_port(system),
+      ],
+      'securityContext': {'privileged': True},
+      'command': [
+          'bash',
+          '-c',
+          'echo XPK Start: $(date) ; _sigterm() ( kill -SIGTERM $!;); trap'
+          f' _sigterm SIGTERM; ({command}) & PID=$!; while kill -0 $PID'
+          ' 2>/dev/null; do sleep 5; done; EXIT_CODE=$? ; echo XPK End:'
+          ' $(date); echo EXIT_CODE=$EXIT_CODE\n',
+      ],
+      'resources': {'limits': {resource_type: system.chips_per_vm}},
+      'volumeMounts': [{'mountPath': '/dev/shm', 'name': 'dshm-2'}],
+  })
+  return container
+
+def get_image_pull_policy(args, docker_image) -> str | None:
+  """Returns the imagePullPolicy of a container.
+
+  Images pinned to a digest never change, so by default nodes that already
+  have them do not ask the registry again.
+
+  Args:
+    args: user provided arguments for running the command.
+    docker_image: docker image of the container.
+
+  Returns:
+    str:
+      imagePullPolicy, None for the Kubernetes default.
+  """
+  if args.image_pull_policy is None and '@sha256:' in docker_image:
+    return 'IfNotPresent'
+  return args.image_pull_policy
+
+def get_image_pull_policy_yaml(args, docker_image) -> str:
+  """Returns the imagePullPolicy of a container as a YAML string.
+
+  Args:
+    args: user provided arguments for running the command.
+    docker_image: docker image of the container.
+
   Returns:
     str:
-      yaml for main container
-  """
-  yaml = """- name: {args.docker_name}
-                image: {docker_image}
-                env: {args.env}
-                ports:
-                - containerPort: 8471
-                - containerPort: 8080
-                {jax_coordinator_port}
-                securityContext:
-                  privileged: true
-                command:
-                - bash
-                - -c
-                - |
-                  echo XPK Start: $(date) ; _sigterm() ( kill -SIGTERM $!;); trap _sigterm SIGTERM; ({command}) & PID=$!; while kill -0 $PID 2>/dev/null; do sleep 5; done; EXIT_CODE=$? ; echo XPK End: $(date); echo EXIT_CODE=$EXIT_CODE
-                resources:
-                  limits:
-                    {resource_type}: {system.chips_per_vm}
-  """
-  return yaml.format(args=args,
-                   system=system,
-                   jax_coordinator_port=add_jax_coordinator_port(system),
-                   docker_image=docker_image,
-                   command=command,
-                   resource_type=resource_type)
-
-def add_jax_coordinator_port(system):
+      imagePullPolicy as a YAML string, empty for the Kubernetes default.
+  """
+  image_pull_policy = get_image_pull_policy(args, docker_image)
+  if image_pull_policy is None:
+    return ''
+  return f'imagePullPolicy: {image_pull_policy}'
+
+def add_jax_coordinator_port(system) -> list[dict]:
   """Add jax coordinator port only for CPUs
 
   Args:
     system: system characteristics.
 
   Returns:
-    str:
-      jax coordinator port as a YAML string
+    list[dict]:
+      jax coordinator port, if any
   """
   if system.accelerator_type == AcceleratorType['CPU']:
-    return '- containerPort: 1234'
-  return ""
+    return [{'containerPort': 1234}]
+  return []
 
-def get_gke_dashboard(args, dashboard_filter):
+async def get_gke_dashboard_async(args, dashboard_filter):
   """Get the identifier of GKE dashboard deployed in the project.
 
   Args:
@@ -2167,12 +6847,35 @@ def get_gke_dashboard(args, dashboard_filter):
       identifier of dashboard if deployed in project,
       None otherwise.
   """
-  command = (
-      'gcloud monitoring dashboards list'
-      f' --project={args.project} --filter="{dashboard_filter}" --format="value(name)" --verbosity=error'
-  )
+  cache = get_context_cache(args)
+  if cache is not None:
+    entry = cache.load(cache.cluster_key(args)) or {}
+    dashboard_id = entry.get('dashboards', {}).get(dashboard_filter)
+    if dashboard_id:
+      return False, dashboard_id
+
+  if use_gcp_rest_client(args):
+    return_code, dashboards = await gcp_call_async(
+        'GKE Dashboard List', args, 'list_dashboards', args.project
+    )
+    # The filters are gcloud `displayName:'<text>'` substring matches.
+    display_name = re.fullmatch(
+        r"displayName:'(.*)'", dashboard_filter
+    ).group(1).lower()
+    return_value = '\n'.join(
+        dashboard['name']
+        for dashboard in dashboards or []
+        if display_name in dashboard.get('displayName', '').lower()
+    )
+  else:
+    command = (
+        'gcloud monitoring dashboards list'
+        f' --project={args.project} --filter="{dashboard_filter}" --format="value(name)" --verbosity=error'
+    )
 
-  return_code, return_value = run_command_for_value(command, 'GKE Dashboard List', args)
+    return_code, return_value = await run_command_for_value_async(
+        command, 'GKE Dashboard List', args
+    )
 
   if return_code != 0:
     xpk_print(f'GKE Dashboard List request returned ERROR {return_code}. '
@@ -2196,11 +6899,16 @@ def get_gke_dashboard(args, dashboard_filter):
     return True, None
 
   if dashboards[0]:
-    return False, dashboards[0].strip().split('/')[-1]
+    dashboard_id = dashboards[0].strip().split('/')[-1]
+    if cache is not None:
+      cache.add_dashboard(
+          cache.cluster_key(args), dashboard_filter, dashboard_id
+      )
+    return False, dashboard_id
 
   return True, None
 
-def get_gke_outlier_dashboard(args):
+async def get_gke_outlier_dashboard_async(args):
   """Get the identifier of GKE outlier dashboard deployed in the project.
 
   Args:
@@ -2212,7 +6920,9 @@ def get_gke_outlier_dashboard(args):
       None otherwise.
   """
   outlier_dashboard_filter = "displayName:'GKE - TPU Monitoring Dashboard'"
-  is_error, dashboard_id = get_gke_dashboard(args, outlier_dashboard_filter)
+  is_error, dashboard_id = await get_gke_dashboard_async(
+      args, outlier_dashboard_filter
+  )
 
   # 'gcloud monitoring dashboards list' returned an error or multiple dashboards with same filter exist in the project
   if is_error:
@@ -2228,7 +6938,7 @@ def get_gke_outlier_dashboard(args):
 
   return dashboard_id
 
-def get_gke_debugging_dashboard(args):
+async def get_gke_debugging_dashboard_async(args):
   """Get the identifier of GKE debugging dashboard deployed in the project.
 
   Args:
@@ -2240,7 +6950,9 @@ def get_gke_debugging_dashboard(args):
       None otherwise.
   """
   debugging_dashboard_filter = "displayName:'GKE - TPU Logging Dashboard'"
-  is_error, dashboard_id = get_gke_dashboard(args, debugging_dashboard_filter)
+  is_error, dashboard_id = await get_gke_dashboard_async(
+      args, debugging_dashboard_filter
+  )
 
   # 'gcloud monitoring dashboards list' returned an error or multiple dashboards with same filter exist in the project
   if is_error:
@@ -2256,7 +6968,7 @@ def get_gke_debugging_dashboard(args):
 
   return dashboard_id
 
-def create_accelerator_label(accelerator_type, system) -> str:
+def create_accelerator_label(accelerator_type, system) -> dict:
   """Generates accelerator label.
 
   Args:
@@ -2264,13 +6976,13 @@ def create_accelerator_label(accelerator_type, system) -> str:
     system: system characteristics.
 
   Returns:
-    The accelerator label.
+    The accelerator label, empty for CPUs.
   """
   if accelerator_type == AcceleratorType['CPU']:
-    return ""
-  return f"{AcceleratorTypeToAcceleratorCharacteristics[accelerator_type].accelerator_label}: {system.gke_accelerator}"
+    return {}
+  return {AcceleratorTypeToAcceleratorCharacteristics[accelerator_type].accelerator_label: system.gke_accelerator}
 
-def create_machine_label(accelerator_type, system) -> str:
+def create_machine_label(accelerator_type, system) -> dict:
   """Generates machine label.
 
   Args:
@@ -2278,11 +6990,11 @@ def create_machine_label(accelerator_type, system) -> str:
     system: system characteristics.
 
   Returns:
-    The machine label.
+    The machine label, empty for GPUs and CPUs.
   """
   if accelerator_type == AcceleratorType['TPU']:
-    return f"{AcceleratorTypeToAcceleratorCharacteristics[accelerator_type].machine_label}: {system.topology}"
-  return ""
+    return {AcceleratorTypeToAcceleratorCharacteristics[accelerator_type].machine_label: system.topology}
+  return {}
 
 def calculate_process_count(num_slices, vms_per_slice) -> str:
   """ Calculates the total number of processes in the workload.
@@ -2296,66 +7008,199 @@ def calculate_process_count(num_slices, vms_per_slice) -> str:
   num_processes = int(num_slices) * int(vms_per_slice)
   return f"{num_processes}"
 
-def get_cpu_env(num_slices, system) -> str:
+def get_cpu_env(num_slices, system) -> list[dict]:
   """Generate environment variables for CPU nodepools
   Args:
-    num_slices: Number of slices to be used in the workload.
-    system: system characteristics
+    num_slices: Number of slices to be used in the workload.
+    system: system characteristics
+
+  Returns:
+    list[dict]: env variables, empty for TPUs and GPUs
+  """
+  if system.accelerator_type != AcceleratorType['CPU']:
+    return []
+
+  def field_env(name, field_path):
+    return {
+        'name': name,
+        'valueFrom': {'fieldRef': {'fieldPath': field_path}},
+    }
+
+  return [
+      field_env(
+          'REPLICATED_JOB_NAME',
+          "metadata.annotations['jobset.sigs.k8s.io/replicatedjob-name']",
+      ),
+      field_env(
+          'JOBSET_NAME',
+          "metadata.annotations['jobset.sigs.k8s.io/jobset-name']",
+      ),
+      {
+          'name': 'JAX_COORDINATOR_ADDRESS',
+          'value': '$(JOBSET_NAME)-$(REPLICATED_JOB_NAME)-0-0.$(JOBSET_NAME)',
+      },
+      field_env(
+          'JOB_INDEX', "metadata.annotations['jobset.sigs.k8s.io/job-index']"
+      ),
+      field_env(
+          'JOB_COMPLETION_INDEX',
+          "metadata.annotations['batch.kubernetes.io/job-completion-index']",
+      ),
+      {'name': 'PROCESSES_IN_JOB', 'value': str(system.vms_per_slice)},
+      {
+          'name': 'JAX_PROCESS_COUNT',
+          'value': calculate_process_count(num_slices, system.vms_per_slice),
+      },
+  ]
+
+def get_cpu_affinity(accelerator_type) -> dict:
+  """Generate affinity rules for CPU nodepools, so that workload pods are 
+  not scheduled on the default pool machines.
+  Args:
+    accelerator_type: TPU / GPU / CPU
+
+  Returns:
+    dict: affinity constraints, empty for TPUs and GPUs
+  """
+  if accelerator_type != AcceleratorType['CPU']:
+    return {}
+  return {
+      'nodeAffinity': {
+          'requiredDuringSchedulingIgnoredDuringExecution': {
+              'nodeSelectorTerms': [{
+                  'matchExpressions': [{
+                      'key': 'cloud.google.com/gke-nodepool',
+                      'operator': 'NotIn',
+                      'values': ['default-pool'],
+                  }]
+              }]
+          }
+      }
+  }
+
+def get_workload_manifest(args, system, docker_image, command) -> dict:
+  """Generates the JobSet of a workload.
+
+  Args:
+    args: user provided arguments for running the command.
+    system: system characteristics.
+    docker_image: docker image of the main container.
+    command: command to run in the main container.
 
   Returns:
-    str: yaml containing env variables 
-  """
-  yaml = """env:
-                - name: REPLICATED_JOB_NAME
-                  valueFrom:
-                    fieldRef:
-                      fieldPath: metadata.annotations['jobset.sigs.k8s.io/replicatedjob-name']
-                - name: JOBSET_NAME
-                  valueFrom:
-                    fieldRef:
-                      fieldPath: metadata.annotations['jobset.sigs.k8s.io/jobset-name']
-                - name: JAX_COORDINATOR_ADDRESS
-                  value: "$(JOBSET_NAME)-$(REPLICATED_JOB_NAME)-0-0.$(JOBSET_NAME)"
-                - name: JOB_INDEX
-                  valueFrom:
-                    fieldRef:
-                      fieldPath: metadata.annotations['jobset.sigs.k8s.io/job-index']
-                - name: JOB_COMPLETION_INDEX
-                  valueFrom:
-                    fieldRef:
-                      fieldPath: metadata.annotations['batch.kubernetes.io/job-completion-index']
-                - name: PROCESSES_IN_JOB
-                  value: "{processes_in_job}"
-                - name: JAX_PROCESS_COUNT
-                  value: "{process_count}"
+    dict: the JobSet.
   """
-  if system.accelerator_type == AcceleratorType['CPU']:
-    return yaml.format(processes_in_job = system.vms_per_slice,
-                      process_count=calculate_process_count(num_slices,system.vms_per_slice))
-  return ""
+  resource_type = AcceleratorTypeToAcceleratorCharacteristics[system.accelerator_type].resource_type
+  volumes = [{'emptyDir': {'medium': 'Memory'}, 'name': 'dshm-2'}]
+  if system.accelerator_type == AcceleratorType['TPU'] and args.deploy_stacktrace_sidecar:
+    containers = get_main_and_sidecar_container(args, system, docker_image, command)
+    volumes.append({'name': 'tpu-stack-trace', 'emptyDir': {}})
+  else:
+    containers = [get_main_container(args, system, docker_image, command, resource_type)]
+
+  pod_spec = {
+      'schedulerName': args.scheduler,
+      'restartPolicy': 'Never',
+  }
+  affinity = get_cpu_affinity(system.accelerator_type)
+  if affinity:
+    pod_spec['affinity'] = affinity
+  node_selector = {
+      **create_accelerator_label(system.accelerator_type, system),
+      **create_machine_label(system.accelerator_type, system),
+  }
+  if node_selector:
+    pod_spec['nodeSelector'] = node_selector
+  pod_spec.update({
+      'priorityClassName': args.priority,
+      'hostNetwork': True,
+      'dnsPolicy': 'ClusterFirstWithHostNet',
+      'terminationGracePeriodSeconds': args.termination_grace_period_seconds,
+      'containers': containers,
+      'volumes': volumes,
+  })
+  return {
+      'apiVersion': 'jobset.x-k8s.io/v1alpha2',
+      'kind': 'JobSet',
+      'metadata': {
+          'name': args.workload,
+          'labels': {
+              # Name of the LocalQueue.
+              'kueue.x-k8s.io/queue-name': 'multislice-queue',
+              'xpk.google.com/workload': args.workload,
+          },
+          'annotations': get_workload_annotations(),
+      },
+      'spec': {
+          'failurePolicy': {'maxRestarts': args.max_restarts},
+          'replicatedJobs': [{
+              'name': 'slice-job',
+              'replicas': args.num_slices,
+              'template': {
+                  'spec': {
+                      # One pod per VM of the slice.
+                      'parallelism': system.vms_per_slice,
+                      'completions': system.vms_per_slice,
+                      # When any pod fails, the job is failed.
+                      'backoffLimit': 0,
+                      'template': {
+                          'metadata': {
+                              'labels': {
+                                  'xpk.google.com/workload': args.workload
+                              }
+                          },
+                          'spec': pod_spec,
+                      },
+                  }
+              },
+          }],
+      },
+  }
+
+def get_workload_manifest_template(
+    args, system, docker_image, command
+) -> ManifestTemplate:
+  """Returns the JobSet of a workload with its name as the field `workload`.
+
+  Submitting many workloads that only differ by their name, for example one
+  per hyperparameter set, then costs one render each instead of building
+  and serializing the whole JobSet again.
 
-def get_cpu_affinity(accelerator_type) -> str:
-  """Generate affinity rules for CPU nodepools, so that workload pods are 
-  not scheduled on the default pool machines.
   Args:
-    accelerator_type: TPU / GPU / CPU
+    args: user provided arguments for running the command.
+    system: system characteristics.
+    docker_image: docker image of the main container.
+    command: command to run in the main container.
 
   Returns:
-    str: yaml containing affinity constraints 
-  """
-  yaml = """affinity:
-                nodeAffinity:
-                  requiredDuringSchedulingIgnoredDuringExecution:
-                    nodeSelectorTerms:
-                    - matchExpressions:
-                      - key: cloud.google.com/gke-nodepool
-                        operator: NotIn
-                        values:
-                        - default-pool
+    ManifestTemplate of the JobSet.
   """
-  if accelerator_type == AcceleratorType['CPU']:
-    return yaml
-  return ""
+  template_args = argparse.Namespace(
+      **{**vars(args), 'workload': ManifestTemplate.field('workload')}
+  )
+  return ManifestTemplate(
+      get_workload_manifest(template_args, system, docker_image, command)
+  )
+
+def get_workload_annotations() -> dict:
+  """Returns the annotations of the JobSet of a workload."""
+  # 1:1 job replica to node pool assignment.
+  return {
+      'alpha.jobset.sigs.k8s.io/exclusive-topology': (
+          'cloud.google.com/gke-nodepool'
+      )
+  }
+
+def get_workload_delete_template() -> ManifestTemplate:
+  """Returns the JobSet to delete, with the workload name as a field."""
+  return ManifestTemplate({
+      'apiVersion': 'jobset.x-k8s.io/v1alpha2',
+      'kind': 'JobSet',
+      'metadata': {
+          'name': ManifestTemplate.field('workload'),
+          'annotations': get_workload_annotations(),
+      },
+  })
 
 def get_system_characteristics(args) -> tuple[SystemCharacteristics|None, int]:
   """Get system characteristics based on user provided arguments.
@@ -2373,6 +7218,61 @@ def get_system_characteristics(args) -> tuple[SystemCharacteristics|None, int]:
   else:
     return None, 1
 
+def get_workload_preflight_steps(args, system, preflight) -> list[Step]:
+  """Returns the checks of workload create, as a graph of steps.
+
+  The docker image is built and uploaded while the cluster is checked, and
+  the cluster checks only wait for the cluster credentials.
+
+  Args:
+    args: user provided arguments for running the command.
+    system: system characteristics.
+    preflight: dict that receives the `docker_image` to run.
+
+  Returns:
+    List of Step.
+  """
+
+  def check_workload_name() -> int:
+    return_code, workload_exists = run_concurrently(
+        check_if_workload_exists_async(args)
+    )[0]
+    if return_code != 0:
+      return return_code
+    if workload_exists:
+      xpk_print(
+          f'{args.workload} already exist, XPK will not create this workload.'
+          ' Please pick a new workload name'
+      )
+      return 1
+    return 0
+
+  def check_cluster_capacity() -> int:
+    workload_can_schedule = run_concurrently(
+        check_if_workload_can_schedule_async(args, system)
+    )[0]
+    return 0 if workload_can_schedule else 1
+
+  def prepare_docker_image() -> int:
+    return_code, preflight['docker_image'] = setup_docker_image(args)
+    return return_code
+
+  return [
+      Step('Set Cluster', lambda: set_cluster_command(args)),
+      Step(
+          'Check Workload Name',
+          check_workload_name,
+          ('Set Cluster',),
+      ),
+      Step(
+          'Check Cluster Capacity',
+          check_cluster_capacity,
+          ('Set Cluster',),
+      ),
+      Step('Prepare Docker Image', prepare_docker_image),
+  ]
+
+
 def workload_create(args) -> int:
   """Run jobset apply command for a file.
 
@@ -2384,75 +7284,59 @@ def workload_create(args) -> int:
   """
   add_zone_and_project(args)
 
-  set_cluster_command_code = set_cluster_command(args)
-  if set_cluster_command_code != 0:
-    xpk_exit(set_cluster_command_code)
-
-  workload_exists = check_if_workload_exists(args)
-
-  if workload_exists:
-    xpk_print(
-        f'{args.workload} already exist, XPK will not create this workload.'
-        ' Please pick a new workload name'
-    )
-    xpk_exit(1)
-
-  xpk_print('Starting workload create', flush=True)
   system, return_code = get_system_characteristics(args)
 
   if return_code > 0:
     xpk_print('Fetching system characteristics failed!')
     xpk_exit(return_code)
 
-  if not check_if_workload_can_schedule(args, system):
-    xpk_exit(1)
+  # Exits on conflicting docker arguments before any check starts.
+  use_base_docker_image_or_docker_image(args)
+  preflight = {}
+  preflight_code = run_step_graph(
+      get_workload_preflight_steps(args, system, preflight),
+      'Workload Create Preflight',
+      fail_fast=True,
+  )
+  if preflight_code != 0:
+    xpk_exit(preflight_code)
+  docker_image = preflight['docker_image']
 
   xpk_print('Starting workload create', flush=True)
 
-  setup_docker_image_code, docker_image = setup_docker_image(args)
-  if setup_docker_image_code != 0:
-    xpk_exit(setup_docker_image_code)
-
   add_env_config(args)
   command = args.command
   if args.debug_dump_gcs:
     command += ('; WORKER_ID=$HOSTNAME;'
                 f'gsutil cp -r /tmp/xla_dump/ {args.debug_dump_gcs}/$WORKER_ID')
 
-  debugging_dashboard_id = None
-  resource_type = AcceleratorTypeToAcceleratorCharacteristics[system.accelerator_type].resource_type
-  if system.accelerator_type == AcceleratorType['TPU'] and args.deploy_stacktrace_sidecar:
+  is_tpu = system.accelerator_type == AcceleratorType['TPU']
+  deploy_sidecar = is_tpu and args.deploy_stacktrace_sidecar
+  if deploy_sidecar:
     xpk_print('Sidecar container to display stack traces for TPU workloads will also be deployed.')
-    container = get_main_and_sidecar_container(args, system, docker_image, command)
-    # Get GKE debugging dashboard only when sidecar container is deployed for TPU workloads
-    debugging_dashboard_id = get_gke_debugging_dashboard(args)
-  else:
-    container = get_main_container(args, system, docker_image, command, resource_type)
-
-  yml_string = workload_create_yaml.format(args=args,
-                                           system=system,
-                                           docker_image=docker_image,
-                                           command=command,
-                                           container=container,
-                                           affinity=get_cpu_affinity(system.accelerator_type),
-                                           env=get_cpu_env(args.num_slices,system),
-                                           accelerator_label=create_accelerator_label(system.accelerator_type, system),
-                                           machine_label=create_machine_label(system.accelerator_type, system),
-                                           resource_type=resource_type)
-  tmp = write_temporary_file(yml_string)
-  command = f'kubectl apply -f {str(tmp.file.name)}'
 
-  return_code = run_command_with_updates(command, 'Creating Workload', args)
+  manifest = get_workload_manifest(args, system, docker_image, command)
+  manifest_errors = get_manifest_errors(manifest)
+  if manifest_errors:
+    xpk_print('The workload is invalid:')
+    for error in manifest_errors:
+      xpk_print(f'  {error}')
+    xpk_exit(1)
+  yml_string = serialize_manifests(manifest)
+
+  # The dashboards are only needed for the final message, so look them up
+  # while the workload is applied. Get GKE outlier dashboard for TPU, and the
+  # debugging dashboard only when the sidecar container is deployed.
+  return_code, outlier_dashboard_id, debugging_dashboard_id = run_concurrently(
+      apply_manifests_async(yml_string, 'Creating Workload', args),
+      get_gke_outlier_dashboard_async(args) if is_tpu else None,
+      get_gke_debugging_dashboard_async(args) if deploy_sidecar else None,
+  )
 
   if return_code != 0:
     xpk_print(f'Create Workload request returned ERROR {return_code}')
     xpk_exit(return_code)
 
-  # Get GKE outlier dashboard for TPU
-  outlier_dashboard_id = None
-  if system.accelerator_type == AcceleratorType['TPU']:
-    outlier_dashboard_id = get_gke_outlier_dashboard(args)
-
   xpk_print(
       'Follow your workload here:'
       # pylint: disable=line-too-long
@@ -2515,12 +7399,11 @@ def workload_delete(args) -> int:
   elif not will_delete:
     xpk_print("Skipping delete command.")
   else:
+    template = get_workload_delete_template()
     for workload in workloads:
       args.workload = workload
-      yml_string = workload_delete_yaml.format(args=args)
-      tmp = write_temporary_file(yml_string)
-      command = f'kubectl delete -f {str(tmp.file.name)}'
-      return_code = run_command_with_updates(command, 'Delete Workload', args)
+      yml_string = template.render(workload=workload)
+      return_code = delete_manifests(yml_string, 'Delete Workload', args)
 
       if return_code != 0:
         xpk_print(f'Delete Workload request returned ERROR {return_code}')
@@ -2528,72 +7411,119 @@ def workload_delete(args) -> int:
   xpk_exit(0)
 
 
-def workload_list_awk_command(filter_key) -> str:
-  """Function returns the awk command needed from the filter specified.
+def get_workload_list_column(fields, position) -> str:
+  """Returns a column of a workload list row, like awk's `$position`.
 
   Args:
-    filter_key: workload list filter to awk against
+    fields: whitespace separated fields of the row.
+    position: position of the column, starting at 1.
 
   Returns:
-    awk command to use in filtering workload list.
+    The column, or an empty string if the row is shorter.
   """
+  return fields[position - 1] if len(fields) >= position else ''
+
 
-  return f' | awk -e \'NR == 1 || {filter_key} {{print $0}}\''
+def filter_workload_list(output, row_filters) -> str:
+  """Keeps the header and the rows of a workload list matching all filters.
+
+  Args:
+    output: output of the workload list command.
+    row_filters: functions taking the whitespace separated fields of a row
+      and returning True to keep it.
+
+  Returns:
+    The filtered workload list.
+  """
+  lines = output.splitlines()
+  if not row_filters or not lines:
+    return output
+  return '\n'.join(
+      lines[:1]
+      + [
+          line
+          for line in lines[1:]
+          if all(row_filter(line.split()) for row_filter in row_filters)
+      ]
+  )
 
 
-def determine_workload_list_filter_by_status(args) -> str:
+def determine_workload_list_filter_by_status(args) -> Callable | None:
   """Function to create the filtered view of workload list.
 
   Args:
     args: user provided arguments for running the command.
 
   Returns:
-    the argument needed to filter by status of jobs in workload list.
+    the row filter needed to filter by status of jobs in workload list, None
+    to keep every row.
   """
-  # Argument positions related to columns created by workload list command.
-  status_arg='$7'
-  running_vms_arg='$5'
-  status_verbose_arg='$9'
+  # Column positions related to columns created by workload list command.
+  status_arg = 7
+  running_vms_arg = 5
+  status_verbose_arg = 9
+
+  def column(fields, position):
+    return get_workload_list_column(fields, position)
+
+  def is_admitted_or_evicted(fields):
+    return re.search('Admitted|Evicted', column(fields, status_arg)) is not None
+
+  def running_vms(fields):
+    value = column(fields, running_vms_arg)
+    return int(value) if re.fullmatch('[0-9]+', value) else None
+
   if args.filter_by_status == 'EVERYTHING':
-    return ''
+    return None
   elif args.filter_by_status == 'RUNNING':
     # Running includes the status Admitted or Evicted, and when the number of
     # vms running is > 0.
-    return workload_list_awk_command(
-        f'({status_arg} ~ \"Admitted|Evicted\" && {running_vms_arg} ~ /^[0-9]+$/ && {running_vms_arg} > 0)'
+    return lambda fields: (
+        is_admitted_or_evicted(fields) and (running_vms(fields) or 0) > 0
     )
   elif args.filter_by_status == 'QUEUED':
     # Queued includes the status Admitted or Evicted, and when the number of
     # vms running is 0.
-    return workload_list_awk_command(
-        f'({status_arg} ~ \"Admitted|Evicted\" && ({running_vms_arg} ~ \"<none>\" || {running_vms_arg} == 0))'
+    return lambda fields: is_admitted_or_evicted(fields) and (
+        '<none>' in column(fields, running_vms_arg) or running_vms(fields) == 0
     )
   elif args.filter_by_status == 'FINISHED':
-    return workload_list_awk_command(f'{status_arg} == \"Finished\"')
+    return lambda fields: column(fields, status_arg) == 'Finished'
   elif args.filter_by_status == 'FAILED':
     # Failed includes the status Finished, and when the verbose reason is failed.
-    return workload_list_awk_command(f'({status_arg} == \"Finished\" && {status_verbose_arg} ~ \"failed\")')
+    return lambda fields: (
+        column(fields, status_arg) == 'Finished'
+        and 'failed' in column(fields, status_verbose_arg)
+    )
   elif args.filter_by_status == 'SUCCESSFUL':
     # Failed includes the status Finished, and when the verbose reason is finished/success.
-    return workload_list_awk_command(f'({status_arg} == \"Finished\" && {status_verbose_arg} ~ \"finished\")')
+    return lambda fields: (
+        column(fields, status_arg) == 'Finished'
+        and 'finished' in column(fields, status_verbose_arg)
+    )
   raise RuntimeError(f'Can not find filter type: {args.filter_by_status}')
 
 
-def determine_workload_list_filter_by_job(args) -> str:
+def determine_workload_list_filter_by_job(args) -> Callable | None:
   """Function to filter view of workload list based on job name.
 
   Args:
     args: user provided arguments for running the command.
 
   Returns:
-    the argument needed to filter job names from workload list
+    the row filter needed to filter job names from workload list, None to keep
+    every row.
   """
-  # Argument positions related to columns created by workload list command.
+  # Column positions related to columns created by workload list command.
   if not args.filter_by_job:
-    return ''
+    return None
   else:
-    job_name_arg="$1"
-    return workload_list_awk_command(f'{job_name_arg} ~ \"{args.filter_by_job}\"')
+    job_name_arg = 1
+    job_name_pattern = re.compile(args.filter_by_job)
+    return lambda fields: (
+        job_name_pattern.search(get_workload_list_column(fields, job_name_arg))
+        is not None
+    )
 
 
 def get_workload_list(args) -> None:
@@ -2619,14 +7549,29 @@ def get_workload_list(args) -> None:
     }
   s = ','.join([key + ':' + value for key, value in columns.items()])
 
-  workload_list_filter_status_cmd = determine_workload_list_filter_by_status(args)
-  workload_list_filter_job_cmd = determine_workload_list_filter_by_job(args)
-  command = (f'kubectl get workloads -o=custom-columns="{s}" '
-             f'{workload_list_filter_status_cmd} {workload_list_filter_job_cmd}'
-             )
-
-  return_code, return_value = run_command_for_value(command, 'List Jobs', args)
-  return return_code, return_value
+  row_filters = [
+      row_filter
+      for row_filter in (
+          determine_workload_list_filter_by_status(args),
+          determine_workload_list_filter_by_job(args),
+      )
+      if row_filter is not None
+  ]
+  if use_native_kubernetes_client(args):
+    return_code, workloads = asyncio.run(
+        kubernetes_call_async('List Jobs', args, 'list', 'Workload')
+    )
+    return_value = '' if workloads is None else format_custom_columns(
+        columns, workloads
+    )
+  else:
+    command = f'kubectl get workloads -o=custom-columns="{s}"'
+    return_code, return_value = run_command_for_value(
+        command, 'List Jobs', args
+    )
+  if return_code != 0:
+    return return_code, return_value
+  return return_code, filter_workload_list(return_value, row_filters)
 
 
 def workload_list(args) -> None:
@@ -2655,6 +7600,27 @@ def workload_list(args) -> None:
   xpk_exit(0)
 
 
+def add_image_pull_policy_argument(custom_parser):
+  """Add the imagePullPolicy argument of containers to the parser.
+
+  Args:
+    custom_parser: parser to add the argument to.
+  """
+  custom_parser.add_argument(
+      '--image-pull-policy',
+      type=str,
+      choices=['Always', 'IfNotPresent', 'Never'],
+      default=None,
+      help=(
+          'imagePullPolicy of the containers running the docker image. xpk'
+          ' pins images in Container Registry or Artifact Registry to their'
+          ' digest, and defaults to IfNotPresent for them so that nodes that'
+          ' already have the image do not ask the registry again. Other'
+          ' images default to the Kubernetes default.'
+      ),
+  )
+
+
 def add_shared_arguments(custom_parser):
   """Add shared arguments to the parser.
 
@@ -2688,6 +7654,75 @@ def add_shared_arguments(custom_parser):
           ' branch based on the output of commands'
       ),
   )
+  custom_parser.add_argument(
+      '--context-cache-ttl',
+      type=int,
+      default=default_context_cache_ttl_seconds,
+      help=(
+          'Seconds for which the gcloud default project and zone, the cluster'
+          ' credentials and the dashboard IDs resolved by a command are reused'
+          ' by the next commands, from ~/.xpk/contexts. The credentials are'
+          ' kept in a private kubeconfig per cluster. 0 disables the cache and'
+          ' sets the current context of the default kubeconfig instead. The'
+          f' default is {default_context_cache_ttl_seconds}.'
+      ),
+  )
+  custom_parser.add_argument(
+      '--kube-client',
+      type=str,
+      default='kubectl',
+      choices=['kubectl', 'native'],
+      help=(
+          'How xpk reads and writes Kubernetes objects. `kubectl` launches'
+          ' kubectl for every call, `native` uses a built-in client that'
+          ' reuses one connection to the API server for the whole run.'
+      ),
+  )
+  custom_parser.add_argument(
+      '--gcp-client',
+      type=str,
+      default='gcloud',
+      choices=['gcloud', 'rest'],
+      help=(
+          'How xpk looks up clusters, node pools, reservations and dashboards'
+          ' and creates and deletes node pools. `gcloud` launches gcloud for'
+          ' every call, `rest` calls the GKE, Compute Engine and Cloud'
+          ' Monitoring REST APIs over pooled connections and tracks node pool'
+          ' operations by ID.'
+      ),
+  )
+  custom_parser.add_argument(
+      '--gcp-api-endpoint',
+      type=str,
+      default=None,
+      help=(
+          'Base URL that replaces the Google Cloud API hosts with'
+          ' `--gcp-client=rest`, e.g. http://127.0.0.1:8002 for a local'
+          ' stand-in server.'
+      ),
+  )
+  custom_parser.add_argument(
+      '--profile',
+      type=bool,
+      action=argparse.BooleanOptionalAction,
+      default=False,
+      help=(
+          'If given `--profile`, xpk prints a table at exit with the time'
+          ' spent per step and task, the number of processes spawned, the'
+          ' bytes read from their pipes and the time spent sleeping in poll'
+          ' loops.'
+      ),
+  )
+  custom_parser.add_argument(
+      '--trace-file',
+      type=str,
+      default=None,
+      help=(
+          'Writes a Chrome trace-event JSON file with a span for each step'
+          ' and external command of the run, which can be opened in'
+          ' https://ui.perfetto.dev or chrome://tracing.'
+      ),
+  )
 
 
 ############### Define flags ###############
@@ -2720,6 +7755,29 @@ def directory_path_type(value):
   return value
 
 
+def int_or_percent_type(value, pat=re.compile(r'[0-9]+%?')):
+  """Validate that the value is a count or a percentage up to `100%`."""
+  if not pat.fullmatch(value) or (
+      value.endswith('%') and int(value[:-1]) > 100
+  ):
+    raise argparse.ArgumentTypeError(
+        'Value must be a number or a percentage of at most 100%. User'
+        f' provided `{value}`'
+    )
+  return value
+
+
+def regex_type(value):
+  """Validate that the value is a valid regular expression."""
+  try:
+    re.compile(value)
+  except re.error as e:
+    raise argparse.ArgumentTypeError(
+        f'Regular expression is invalid. User provided `{value}`: {e}'
+    ) from e
+  return value
+
+
 #### "cluster" command parser. ####
 cluster_parser = xpk_subcommands.add_parser(
     'cluster',
@@ -2878,6 +7936,135 @@ cluster_create_optional_arguments.add_argument(
       ' approval.'
     ),
 )
+cluster_create_optional_arguments.add_argument(
+    '--node-pool-retries',
+    type=int,
+    default=3,
+    help=(
+        'Number of times a node pool create or delete command that failed with'
+        ' a transient error (concurrent operations, rate limiting or'
+        ' stockouts) is retried with exponential backoff. Other node pool'
+        ' commands keep running while it waits. Set to 0 to disable retries.'
+        ' The default is 3.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--restart',
+    action='store_true',
+    help=(
+        'Run every cluster create step again. By default, steps that already'
+        ' completed for this project, zone and cluster with the same'
+        ' arguments are skipped.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--from-step',
+    type=str,
+    default=None,
+    help=(
+        'Run the given cluster create step and every step depending on it'
+        ' again, e.g. --from-step="Enable Kueue CRDs". Steps are: Create'
+        ' Cluster, Create Node Pools, Set Cluster, Set JobSet On Cluster, Set'
+        ' Kueue On Cluster, Enable Kueue CRDs, Create Cluster ConfigMap.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--node-pool-concurrency',
+    type=int,
+    default=10,
+    help=(
+        'Number of node pool create and delete commands run in parallel at'
+        ' the start. It grows by one after each success, up to'
+        ' `--max-node-pool-concurrency`, and is halved, down to'
+        ' `--min-node-pool-concurrency`, when GKE reports concurrent'
+        ' operations or rate limiting. The default is 10.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--min-node-pool-concurrency',
+    type=int,
+    default=1,
+    help='Lower bound of the node pool parallelism. The default is 1.',
+)
+cluster_create_optional_arguments.add_argument(
+    '--max-node-pool-concurrency',
+    type=int,
+    default=32,
+    help='Upper bound of the node pool parallelism. The default is 32.',
+)
+cluster_create_optional_arguments.add_argument(
+    '--node-pool-poll-interval',
+    type=float,
+    default=gcp_operation_poll_seconds,
+    help=(
+        'Seconds between status checks of the node pool operations submitted'
+        ' with `--node-pool-async` or `--gcp-client=rest`. Each check lists'
+        ' all the operations in flight at once. The default is'
+        f' {gcp_operation_poll_seconds}.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--node-pool-timeout',
+    type=float,
+    default=node_pool_operation_timeout_seconds,
+    help=(
+        'Seconds after which the node pool operations submitted with'
+        ' `--node-pool-async` or `--gcp-client=rest` that are not done fail'
+        ' cluster create. They keep running in GKE. The default is'
+        f' {node_pool_operation_timeout_seconds}.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--node-pool-async',
+    type=bool,
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help=(
+        'If given `--node-pool-async`, node pool creates and deletes are'
+        ' submitted with `gcloud --async` and tracked by their operation ID,'
+        ' instead of keeping a gcloud process open for each of them until it'
+        ' completes. Always on with `--gcp-client=rest`.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--registry-mirror',
+    type=bool,
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help=(
+        'If given `--registry-mirror`, deploys a pull-through cache of'
+        ' `--registry-mirror-upstream` in the cluster and configures'
+        ' containerd on every node to pull images of that registry through'
+        ' it, so that thousands of hosts starting the same workload or'
+        ' `cluster cacheimage` do not each download the image from the'
+        ' registry. Pulls fall back to the registry when the mirror fails.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--registry-mirror-upstream',
+    type=str,
+    default='gcr.io',
+    help=(
+        'Registry cached by `--registry-mirror`, gcr.io by default. The'
+        ' mirror authenticates with the service account of its node.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--registry-mirror-replicas',
+    type=int,
+    default=4,
+    help=(
+        'Number of replicas of the `--registry-mirror`, each with its own'
+        ' cache. More replicas serve more nodes at once, each replica'
+        ' downloads an image from the registry once.'
+    ),
+)
+cluster_create_optional_arguments.add_argument(
+    '--registry-mirror-cache-size',
+    type=str,
+    default='50Gi',
+    help='Disk space of the cache of each `--registry-mirror` replica.',
+)
 add_shared_arguments(cluster_create_optional_arguments)
 
 cluster_create_parser.set_defaults(func=cluster_create)
@@ -2951,13 +8138,19 @@ cluster_cacheimage_required_arguments.add_argument(
 cluster_cacheimage_required_arguments.add_argument(
     '--docker-image',
     type=str,
+    nargs='+',
     default=None,
-    help='The docker-image to cache.',
+    help=(
+        'The docker images to cache. Several images, for example the base'
+        ' and code images of upcoming workloads, are cached by the same pod'
+        ' on each node.'
+    ),
     required=True,
 )
 
 ### Optional Arguments
 add_shared_arguments(cluster_cacheimage_optional_arguments)
+add_image_pull_policy_argument(cluster_cacheimage_optional_arguments)
 cluster_cacheimage_optional_arguments.add_argument(
     '--cache-key',
     type=str,
@@ -2965,8 +8158,96 @@ cluster_cacheimage_optional_arguments.add_argument(
     help='The key to cache the docker image under.',
     required=False,
 )
+cluster_cacheimage_optional_arguments.add_argument(
+    '--max-unavailable',
+    type=int_or_percent_type,
+    default=None,
+    help=(
+        'Number or percentage of nodes whose cached image pod may be stopped'
+        ' at the same time while the image is updated, at most 100%%. 0 by'
+        ' default. Giving a non-zero value sets `--max-surge` to 0 unless it'
+        ' is given too.'
+    ),
+)
+cluster_cacheimage_optional_arguments.add_argument(
+    '--max-surge',
+    type=int_or_percent_type,
+    default=None,
+    help=(
+        'Number or percentage of nodes that pull the new image while still'
+        ' running the pod of the previous one, at most 100%%. 100%% by'
+        ' default, or 0 when `--max-unavailable` is non-zero. Lower it to'
+        ' spread the pulls over time. Exactly one of `--max-unavailable` and'
+        ' `--max-surge` must be non-zero.'
+    ),
+)
+cluster_cacheimage_optional_arguments.add_argument(
+    '--wait',
+    type=bool,
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help=(
+        'If given `--wait`, waits until every targeted node cached the image,'
+        ' printing how many nodes are done and how long each node took to'
+        ' pull it. Fails with the list of nodes still pulling after'
+        ' `--wait-timeout` seconds.'
+    ),
+)
+cluster_cacheimage_optional_arguments.add_argument(
+    '--wait-timeout',
+    type=int,
+    default=1800,
+    help='Seconds that `--wait` waits for the nodes, 1800 by default.',
+)
 cluster_cacheimage_parser.set_defaults(func=cluster_cacheimage)
 
+### "cluster cacheimage-gc" command parser ###
+cluster_cacheimage_gc_parser = cluster_subcommands.add_parser(
+    'cacheimage-gc',
+    help='Delete stale cached images.',
+)
+cluster_cacheimage_gc_required_arguments = (
+    cluster_cacheimage_gc_parser.add_argument_group(
+        'Required Arguments',
+        'Arguments required for cluster cacheimage-gc.',
+    )
+)
+cluster_cacheimage_gc_optional_arguments = (
+    cluster_cacheimage_gc_parser.add_argument_group(
+        'Optional Arguments', 'Arguments optional for cluster cacheimage-gc.'
+    )
+)
+
+### Required arguments
+cluster_cacheimage_gc_required_arguments.add_argument(
+    '--cluster',
+    type=str,
+    default=None,
+    help='The name of the cluster to delete the stale cached images of.',
+    required=True,
+)
+
+### Optional Arguments
+add_shared_arguments(cluster_cacheimage_gc_optional_arguments)
+cluster_cacheimage_gc_optional_arguments.add_argument(
+    '--max-age',
+    type=int,
+    default=7 * 24 * 3600,
+    help=(
+        'Cache keys that `cluster cacheimage` last updated more than this many'
+        ' seconds ago are deleted, 7 days by default. With 0, every cache key'
+        ' not kept by `--keep-cache-key` is deleted.'
+    ),
+)
+cluster_cacheimage_gc_optional_arguments.add_argument(
+    '--keep-cache-key',
+    type=str,
+    action='append',
+    default=[],
+    help='A cache key to keep whatever its age. Can be given several times.',
+)
+cluster_cacheimage_gc_parser.set_defaults(func=cluster_cacheimage_gc)
+
 ### "cluster describe" command parser ###
 cluster_describe_parser = cluster_subcommands.add_parser(
     'describe',
@@ -3100,6 +8381,7 @@ workload_device_group.add_argument(
 
 ### Workload Optional Arguments
 add_shared_arguments(workload_create_parser_optional_arguments)
+add_image_pull_policy_argument(workload_create_parser_optional_arguments)
 
 workload_create_parser_optional_arguments.add_argument(
     '--docker-name',
@@ -3142,7 +8424,7 @@ workload_base_docker_image_arguments.add_argument(
 )
 workload_create_parser_optional_arguments.add_argument(
     '--num-slices',
-    type=str,
+    type=int,
     default=1,
     help='The number of slices to use, default=1.',
 )
@@ -3161,7 +8443,7 @@ workload_create_parser_optional_arguments.add_argument(
     '--priority',
     type=str,
     default='medium',
-    choices=['very-low', 'low', 'medium', 'high', 'very-high'],
+    choices=[name for name, _, _ in workload_priority_classes],
     help=(
         'A priority, one of `very-low`, `low`, `medium`, `high` or `very-high`.'
         ' Defaults to `medium`.'
@@ -3179,8 +8461,8 @@ workload_create_parser_optional_arguments.add_argument(
 )
 workload_create_parser_optional_arguments.add_argument(
     '--max-restarts',
-    type=str,
-    default='0',
+    type=int,
+    default=0,
     help=(
         'Maximum number of times the JobSet will be restarted upon failure. '
         'Defaults to 0.'
@@ -3208,8 +8490,8 @@ workload_create_parser_optional_arguments.add_argument(
 
 workload_create_parser_optional_arguments.add_argument(
     '-tgps', '--termination-grace-period-seconds', 
-    type=str,
-    default='30',
+    type=int,
+    default=30,
     help=(
         'Maximum wait time for a workload Pod to wrap up after a disruption event or deletion request.'
         'Defaults to 30 seconds.'
@@ -3254,7 +8536,7 @@ workload_delete_parser_optional_arguments.add_argument(
 )
 workload_delete_parser_optional_arguments.add_argument(
     '--filter-by-job',
-    type=str,
+    type=regex_type,
     help='Filters the arguments based on job name. Provide a regex expression'
           'to parse jobs that match the pattern or provide a job name to delete a single job.',
 )
@@ -3302,7 +8584,7 @@ workload_list_parser.add_argument(
 
 workload_list_parser.add_argument(
     '--filter-by-job',
-    type=str,
+    type=regex_type,
     help='Filters the arguments based on job name. Provide a regex expression'
           'to parse jobs that match the pattern or provide a job name to view a single job.',
     required=False,
@@ -3314,6 +8596,10 @@ workload_list_parser.set_defaults(func=workload_list)
 
 xpk_print('Starting xpk', flush=True)
 main_args = parser.parse_args()
+if getattr(main_args, 'trace_file', None):
+  start_tracing(main_args.trace_file, main_args.func.__name__)
+if getattr(main_args, 'profile', False):
+  start_profiling(main_args.func.__name__)
 main_args.func(main_args)
 
 